@@ -27,10 +27,11 @@ def grabIm(det1,Sdir,Udir,thresh1):
     fig,ax = plt.subplots()
     
     bxCnt = 0
-    for bb in det1['meta']['bboxes'][0][0]:
+    bbs = det1['meta']['bboxes'][0]
+    for bb in zip(bbs['label'], bbs['score'], zip(bbs['ymin'], bbs['xmin'], bbs['ymax'], bbs['xmax'])):
         if bb[1] >= thresh1:
-            xy1 = (bb[2][0]*sz1[0],bb[2][1]*sz1[1])
-            xy2 = (bb[2][2]*sz1[0],bb[2][3]*sz1[1])
+            xy1 = (bb[2][0],bb[2][1])  # frame pixels
+            xy2 = (bb[2][2],bb[2][3])
             h1 = xy2[0]-xy1[0]
             w1 = xy2[1]-xy1[1]
             
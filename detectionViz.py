@@ -19,10 +19,11 @@ sz1 = np.shape(image1)
 fig,ax = plt.subplots()
 
 
-for bb in det['meta']['bboxes'][0][0]:
+bbs = det['meta']['bboxes'][0]
+for bb in zip(bbs['label'], bbs['score'], zip(bbs['ymin'], bbs['xmin'], bbs['ymax'], bbs['xmax'])):
     if bb[1] > 0.35:
-        xy1 = (bb[2][0]*sz1[0],bb[2][1]*sz1[1])
-        xy2 = (bb[2][2]*sz1[0],bb[2][3]*sz1[1])
+        xy1 = (bb[2][0],bb[2][1])  # frame pixels
+        xy2 = (bb[2][2],bb[2][3])
         h1 = xy2[0]-xy1[0]
         w1 = xy2[1]-xy1[1]
         
@@ -53,10 +54,11 @@ sz1 = np.shape(image1)
 fig,ax = plt.subplots()
 
 
-for bb in det['meta']['bboxes'][0][0]:
+bbs = det['meta']['bboxes'][0]
+for bb in zip(bbs['label'], bbs['score'], zip(bbs['ymin'], bbs['xmin'], bbs['ymax'], bbs['xmax'])):
     if bb[1] > 0.35:
-        xy1 = (bb[2][0]*sz1[0],bb[2][1]*sz1[1])
-        xy2 = (bb[2][2]*sz1[0],bb[2][3]*sz1[1])
+        xy1 = (bb[2][0],bb[2][1])  # frame pixels
+        xy2 = (bb[2][2],bb[2][3])
         h1 = xy2[0]-xy1[0]
         w1 = xy2[1]-xy1[1]
         
@@ -1,23 +1,45 @@
 import sys
 
-from . import dahuacam
-from . import discover
-from . import grabber
-from . import ui
+# commands are imported when run so each only pays for it's own imports
 
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         if sys.argv[1] == 'discover':
             sys.argv.pop(1)
+            from . import discover
             discover.cmdline_run()
         elif sys.argv[1] == 'configure':
             sys.argv.pop(1)
+            from . import dahuacam
             dahuacam.cmdline_run()
         elif sys.argv[1] == 'ui':
             sys.argv.pop(1)
+            from . import ui
             ui.cmdline_run()
+        elif sys.argv[1] == 'hub':
+            sys.argv.pop(1)
+            from . import hub
+            hub.cmdline_run()
+        elif sys.argv[1] == 'broker':
+            sys.argv.pop(1)
+            from . import broker
+            broker.cmdline_run()
+        elif sys.argv[1] == 'replay':
+            sys.argv.pop(1)
+            from . import replay
+            replay.cmdline_run()
+        elif sys.argv[1] == 'benchmark':
+            sys.argv.pop(1)
+            from . import benchmark
+            benchmark.cmdline_run()
+        elif sys.argv[1] == 'microbench':
+            sys.argv.pop(1)
+            from . import microbench
+            microbench.cmdline_run()
         else:
+            from . import grabber
             grabber.cmdline_run()
     else:
+        from . import grabber
         grabber.cmdline_run()
@@ -0,0 +1,326 @@
+"""
+End-to-end throughput benchmark
+
+Cameras are replaced by synthetic capture threads (generated frames or
+a looping video, see cvcapture.SyntheticCaptureThread), the model by
+the fake engine (with an optional inference delay) and the data
+directory by a temporary directory. Everything else (Grabber.update,
+the analysis pipeline, trigger and meta writing) is the real code.
+
+Each scenario (number of cameras x number of rois x csv/json output)
+runs in a fresh process for duration seconds (after warmup seconds)
+and reports:
+    - throughput: frames analyzed per second (all cameras)
+    - stage latency percentiles (see timing) for all cameras
+    - cpu: process cpu time / wall time (1.0 = one core)
+    - rss: peak and final resident memory (MB)
+Results are saved as json so versions can be compared.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+
+from . import config
+from . import grabber
+from . import timing
+
+
+def roi_layout(n_rois, width, height):
+    """n_rois side by side square rois [left, top, size] (see build_crop)
+
+    left and top are fractions of the frame width and height, size is a
+    fraction of the shorter side
+    """
+    short = min(width, height)
+    # as large as fits in a row
+    dim = min(short, width // n_rois)
+    top = (height - dim) / 2. / height
+    step = width / n_rois
+    return [
+        [(i * step + (step - dim) / 2.) / width, top, dim / short]
+        for i in range(n_rois)]
+
+
+def scenario_cfg(options, n_rois):
+    cfg = copy.deepcopy(grabber.default_cfg)
+    cfg['engine'] = {
+        'type': 'fake', 'model_type': 'detector',
+        'delay': options['delay']}
+    cfg['rois'] = roi_layout(n_rois, options['width'], options['height'])
+    cfg['properties'] = {
+        'frame_width': options['width'],
+        'frame_height': options['height'],
+        'fps': options['fps'],
+    }
+    # analyze every frame
+    rate = options['fps']
+    cfg['recording'].update({
+        'base_rate': rate,
+        'min_rate': rate,
+        'max_rate': rate,
+        'periodic_still': 0,
+    })
+    return cfg
+
+
+def current_rss():
+    # resident memory (bytes) from /proc, None if unavailable
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def summarize_stages(grabbers):
+    """Percentiles per stage using samples from all grabbers"""
+    samples = {}
+    for g in grabbers:
+        t = g.timing
+        for stage in t.samples:
+            n = min(t.n_samples[stage], t.window)
+            samples.setdefault(stage, []).append(t.samples[stage][:n])
+    stages = {}
+    for stage in samples:
+        a = numpy.concatenate(samples[stage]) * 1000.
+        if not len(a):
+            continue
+        s = {'n': len(a), 'mean_ms': float(numpy.mean(a))}
+        for (p, v) in zip(
+                timing.percentiles, numpy.percentile(a, timing.percentiles)):
+            s['p%i_ms' % p] = float(v)
+        stages[stage] = s
+    return stages
+
+
+def wait_for_pipelines(grabbers, timeout=10.0):
+    # let queued jobs finish writing before the directory is removed
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        n = sum(g.n_persisted for g in grabbers)
+        time.sleep(0.5)
+        if (
+                n == sum(g.n_persisted for g in grabbers) and
+                all(q.empty() for g in grabbers
+                    for q in g.stage_queues.values())):
+            return
+
+
+def run_scenario(scenario, options):
+    """Run one scenario (in this process), returns a result dict"""
+    directory = tempfile.mkdtemp(prefix='pcam_benchmark_')
+    # redirect all output to the temporary directory
+    config.data_dir = directory
+    config.log_dir = os.path.join(directory, 'logs')
+    config.working_cfg_dir = os.path.join(directory, 'working_configs')
+    config.thumbnail_dir = os.path.join(directory, 'thumbnails')
+    # used instead of loading site settings (see grabber.load_settings)
+    grabber.settingsL = {
+        'save_all_detections': 1,
+        'csv': int(scenario['output'] == 'csv'),
+        'hostname': 'benchmark',
+    }
+
+    loc = options['video'] or 'synthetic'
+    grabbers = []
+    for i in range(scenario['cameras']):
+        name = 'bench%i' % i
+        config.save_config(scenario_cfg(options, scenario['rois']), name)
+        grabbers.append(grabber.Grabber(
+            loc, name=name, backend='synthetic', capture_stills=False))
+
+    running = True
+
+    errors = []
+
+    def run(g):
+        g.start_pipeline()
+        try:
+            while running and g.pipeline_error is None:
+                g.update()
+        except Exception as e:
+            errors.append('%s: %r' % (g.name, e))
+
+    threads = [
+        threading.Thread(target=run, args=(g, ), daemon=True)
+        for g in grabbers]
+    for t in threads:
+        t.start()
+    time.sleep(options['warmup'])
+
+    # measure only after warmup
+    start = []
+    for g in grabbers:
+        g.timing = timing.StageTimes(g.name, window=options['window'])
+        start.append((
+            g.n_persisted, g.frames.dropped, g.capture_thread.frame_count))
+    t0 = time.monotonic()
+    c0 = cpu_time()
+    time.sleep(options['duration'])
+    wall = time.monotonic() - t0
+    cpu = cpu_time() - c0
+
+    n_analyzed = 0
+    n_stale = 0
+    n_dropped = 0
+    n_captured = 0
+    for (g, s) in zip(grabbers, start):
+        n_stale += g.timing.counters.get('stale_frames', 0)
+        n_analyzed += g.n_persisted - s[0]
+        n_dropped += g.frames.dropped - s[1]
+        n_captured += g.capture_thread.frame_count - s[2]
+        if g.pipeline_error is not None:
+            errors.append('%s: %r' % (g.name, g.pipeline_error))
+    n_analyzed -= n_stale
+    result = dict(scenario)
+    result.update({
+        'duration': wall,
+        'frames_analyzed': n_analyzed,
+        'throughput': n_analyzed / wall,
+        'capture_rate': n_captured / wall,
+        'dropped_frames': n_dropped,
+        'stale_frames': n_stale,
+        'cpu': cpu / wall,
+        'max_rss_mb': resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.,
+        'rss_mb': (current_rss() or 0) / (1024. * 1024.),
+        'stages': summarize_stages(grabbers),
+        'errors': errors,
+    })
+
+    running = False
+    for t in threads:
+        t.join()
+    for g in grabbers:
+        g.capture_thread.stop()
+        g.trigger.stop()
+    wait_for_pipelines(grabbers)
+    if not options['keep']:
+        shutil.rmtree(directory, ignore_errors=True)
+    else:
+        result['directory'] = directory
+    return result
+
+
+def run_isolated(scenario, options):
+    # fresh process per scenario so memory and threads don't carry over
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(run_scenario, (scenario, options))
+
+
+def scenarios(cameras=(1, 2, 4), rois=(1, 4), outputs=('json', 'csv')):
+    return [
+        {'cameras': c, 'rois': r, 'output': o}
+        for c in cameras for r in rois for o in outputs]
+
+
+def benchmark(scenario_list, options):
+    results = []
+    for scenario in scenario_list:
+        logging.info("Running scenario: %s", scenario)
+        r = run_isolated(scenario, options)
+        logging.info(
+            "%i camera(s), %i roi(s), %s: %.1f fps, cpu %.2f, rss %.0f MB",
+            r['cameras'], r['rois'], r['output'], r['throughput'],
+            r['cpu'], r['max_rss_mb'])
+        for e in r['errors']:
+            logging.error("Scenario error: %s", e)
+        results.append(r)
+    return {
+        'time': time.time(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'options': options,
+        'scenarios': results,
+    }
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--cameras', default='1,2,4',
+        help='comma separated numbers of cameras')
+    parser.add_argument(
+        '-d', '--duration', default=10.0, type=float,
+        help='seconds to measure each scenario')
+    parser.add_argument(
+        '-D', '--delay', default=0.01, type=float,
+        help='fake inference time (seconds) per batch')
+    parser.add_argument(
+        '-f', '--fps', default=10.0, type=float,
+        help='camera frame (and analysis) rate')
+    parser.add_argument(
+        '-k', '--keep', default=False, action='store_true',
+        help='keep the temporary data directories')
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help='results filename (default: benchmark_<date>.json)')
+    parser.add_argument(
+        '-O', '--outputs', default='json,csv',
+        help='comma separated meta outputs (json, csv)')
+    parser.add_argument(
+        '-r', '--rois', default='1,4',
+        help='comma separated numbers of rois')
+    parser.add_argument(
+        '-R', '--resolution', default='1280x720',
+        help='generated frame size (WxH)')
+    parser.add_argument(
+        '-V', '--video', default=None,
+        help='loop this video file instead of generating frames')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    parser.add_argument(
+        '-w', '--warmup', default=2.0, type=float,
+        help='seconds to run before measuring')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    width, height = (int(v) for v in args.resolution.lower().split('x'))
+    options = {
+        'duration': args.duration,
+        'warmup': args.warmup,
+        'delay': args.delay,
+        'fps': args.fps,
+        'width': width,
+        'height': height,
+        'video': args.video,
+        'keep': args.keep,
+        # enough samples to keep every frame of a scenario
+        'window': max(1024, int(args.fps * args.duration * 2)),
+    }
+    results = benchmark(scenarios(
+        [int(v) for v in args.cameras.split(',')],
+        [int(v) for v in args.rois.split(',')],
+        args.outputs.split(',')), options)
+
+    fn = args.output
+    if fn is None:
+        fn = datetime.datetime.now().strftime('benchmark_%y%m%d_%H%M%S.json')
+    with open(fn, 'w') as f:
+        json.dump(results, f, indent=True)
+    logging.info("Saved results to %s", fn)
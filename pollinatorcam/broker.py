@@ -0,0 +1,259 @@
+"""
+Share one model between several camera processes
+
+The broker is the only process talking to the model (engine). Camera
+processes (pcam@ services) connect with a BrokerClient (a drop in
+replacement for tfliteserve.Client) over a unix socket. Requests from
+all cameras are collected into micro-batches:
+    - a batch is run when it's full (max_batch) or when the oldest
+      request has waited max_wait seconds
+    - requests are picked round-robin across cameras (round_robin) or
+      higher priority (triggered) cameras first (priority)
+Per-camera queue depth and wait time are saved (see timing) to:
+    <log_dir>/broker_timing.json
+"""
+
+import argparse
+import collections
+import logging
+import multiprocessing.connection
+import os
+import threading
+import time
+
+from . import config
+from . import engine
+from . import timing
+
+
+default_address = os.path.join(config.working_cfg_dir, 'broker.sock')
+
+
+class Request:
+    __slots__ = ('name', 'image', 'priority', 'time', 'output', 'done')
+
+    def __init__(self, name, image, priority, done):
+        self.name = name
+        self.image = image
+        self.priority = priority
+        self.time = time.monotonic()
+        self.output = None
+        # shared by all requests from one client message
+        self.done = done
+
+
+class Scheduler:
+    """Per-camera request queues and batch selection"""
+    policies = ('round_robin', 'priority')
+
+    def __init__(self, policy='round_robin', max_batch=8, max_wait=0.01):
+        if policy not in self.policies:
+            raise ValueError("Unknown scheduling policy: %s" % (policy, ))
+        self.policy = policy
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queues = collections.OrderedDict()
+        self.n_pending = 0
+        self.condition = threading.Condition()
+
+    def put(self, requests):
+        with self.condition:
+            for r in requests:
+                if r.name not in self.queues:
+                    self.queues[r.name] = collections.deque()
+                self.queues[r.name].append(r)
+            self.n_pending += len(requests)
+            self.condition.notify()
+
+    def depths(self):
+        with self.condition:
+            return {n: len(q) for (n, q) in self.queues.items()}
+
+    def oldest_time(self):
+        return min(q[0].time for q in self.queues.values() if len(q))
+
+    def wait_for_batch(self, timeout=None):
+        """Block until a batch is ready, returns a list of requests"""
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.n_pending > 0, timeout=timeout):
+                return []
+            # wait for the batch to fill or the oldest request to expire
+            while self.n_pending < self.max_batch:
+                remaining = self.oldest_time() + self.max_wait - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.select()
+
+    def select(self):
+        # called with condition held
+        names = [n for n in self.queues if len(self.queues[n])]
+        if self.policy == 'priority':
+            # stable sort keeps round-robin order within a priority
+            names.sort(key=lambda n: -self.queues[n][0].priority)
+        batch = []
+        while len(batch) < self.max_batch and len(names):
+            # take one request from each camera per round
+            for n in list(names):
+                batch.append(self.queues[n].popleft())
+                if not len(self.queues[n]):
+                    names.remove(n)
+                if len(batch) == self.max_batch:
+                    break
+        # rotate so the next batch starts with the next camera
+        for r in batch[:1]:
+            self.queues.move_to_end(r.name)
+        self.n_pending -= len(batch)
+        return batch
+
+
+class Broker:
+    def __init__(
+            self, engine, address=default_address, policy='round_robin',
+            max_batch=8, max_wait=0.01, log_dir=None):
+        self.engine = engine
+        self.address = address
+        self.scheduler = Scheduler(policy, max_batch, max_wait)
+        self.timing = timing.StageTimes('broker', directory=log_dir)
+
+        d = os.path.dirname(self.address)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = multiprocessing.connection.Listener(
+            self.address, family='AF_UNIX')
+        logging.info("Broker listening on %s", self.address)
+
+    def serve_client(self, conn):
+        # first message is the camera name
+        try:
+            name = conn.recv()
+            conn.send(self.engine.buffers.meta)
+            logging.info("Client connected: %s", name)
+            while True:
+                priority, images = conn.recv()
+                done = threading.Semaphore(0)
+                requests = [Request(name, im, priority, done) for im in images]
+                self.scheduler.put(requests)
+                for _ in requests:
+                    done.acquire()
+                conn.send([r.output for r in requests])
+        except (EOFError, OSError) as e:
+            logging.info("Client disconnected: %s", e)
+        finally:
+            conn.close()
+
+    def accept(self):
+        while True:
+            conn = self.listener.accept()
+            threading.Thread(
+                target=self.serve_client, args=(conn, ),
+                daemon=True).start()
+
+    def run_batch(self, batch):
+        t = time.monotonic()
+        self.timing.start_frame()
+        for r in batch:
+            self.timing.add('wait_%s' % r.name, t - r.time)
+        for (n, d) in self.scheduler.depths().items():
+            self.timing.counters['depth_%s' % n] = d
+        self.timing.add('batch_size', len(batch))
+        try:
+            with self.timing.time('inference'):
+                outputs = self.engine.run_many([r.image for r in batch])
+        except Exception as e:
+            logging.error("Engine error: %s", e)
+            outputs = [e] * len(batch)
+        for (r, o) in zip(batch, outputs):
+            r.output = o
+            r.done.release()
+        self.timing.end_frame()
+        self.timing.maybe_save()
+
+    def run(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        while True:
+            batch = self.scheduler.wait_for_batch(timeout=1.0)
+            if len(batch):
+                self.run_batch(batch)
+
+
+class BrokerClient(engine.Engine):
+    """Engine that runs images through a Broker
+
+    Set priority > 0 to be scheduled first (when the broker
+    uses the priority policy)
+    """
+    def __init__(self, name, address=default_address):
+        self.name = name
+        self.priority = 0
+        logging.info("Connecting to broker at %s as %s", address, name)
+        self.conn = multiprocessing.connection.Client(
+            address, family='AF_UNIX')
+        self.conn.send(name)
+        super(BrokerClient, self).__init__(self.conn.recv())
+
+    def run_many(self, images):
+        self.conn.send((self.priority, list(images)))
+        outputs = self.conn.recv()
+        for o in outputs:
+            if isinstance(o, Exception):
+                raise o
+        return outputs
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--address', default=default_address,
+        help='unix socket path clients connect to')
+    parser.add_argument(
+        '-b', '--max_batch', default=8, type=int,
+        help='maximum requests per batch')
+    parser.add_argument(
+        '-e', '--engine', default='tfliteserve',
+        choices=sorted(engine.engine_types),
+        help='inference engine, local runs the model in this process')
+    parser.add_argument(
+        '-f', '--fake', default=False, action='store_true',
+        help='use a fake model (see fake_server.py), same as -e fake')
+    parser.add_argument(
+        '-L', '--labels', default=None,
+        help='labels file for the local engine')
+    parser.add_argument(
+        '-m', '--model', default=None,
+        help='model file for the local engine')
+    parser.add_argument(
+        '-n', '--name', default='broker',
+        help='name used to connect to tfliteserve')
+    parser.add_argument(
+        '-p', '--policy', default='round_robin', choices=Scheduler.policies,
+        help='scheduling policy, priority runs triggered cameras first')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    parser.add_argument(
+        '-w', '--max_wait', default=0.01, type=float,
+        help='maximum seconds a request waits for a batch to fill')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.fake:
+        args.engine = 'fake'
+    kwargs = {}
+    if args.engine == 'local':
+        kwargs = {'model': args.model, 'labels': args.labels}
+    e = engine.build(args.name, args.engine, **kwargs)
+
+    b = Broker(
+        e, address=args.address, policy=args.policy,
+        max_batch=args.max_batch, max_wait=args.max_wait,
+        log_dir=config.log_dir)
+    try:
+        b.run()
+    except KeyboardInterrupt:
+        pass
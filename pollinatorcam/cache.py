@@ -0,0 +1,94 @@
+"""
+Reuse inference results for (nearly) unchanged rois
+
+Each preprocessed roi patch is reduced to a difference hash (dhash):
+a small grayscale copy where each bit is set if a pixel is brighter
+than it's right neighbor. Patches with hashes within max_distance bits
+(hamming distance) of a cached patch for the same roi reuse the cached
+model output instead of running inference.
+
+Entries are dropped when older than max_age seconds (so a static roi
+is still analyzed every max_age seconds) or when the cache holds more
+than max_size entries (least recently used first).
+"""
+
+import collections
+import time
+
+import cv2
+import numpy
+
+
+# number of set bits for each byte value
+bit_counts = numpy.array(
+    [bin(i).count('1') for i in range(256)], dtype='u1')
+
+
+def dhash(image, size=16):
+    """Difference hash of an image as size * size bits (packed bytes)"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return numpy.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming(h, hashes):
+    """Bits differing between hash h and each row of hashes"""
+    return bit_counts[numpy.bitwise_xor(hashes, h)].sum(axis=-1)
+
+
+class ResultCache:
+    def __init__(self, max_size=64, max_distance=4, max_age=10.0, hash_size=16):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.max_age = max_age
+        self.hash_size = hash_size
+
+        # key -> (hash, time, output), ordered by last use
+        self.entries = collections.OrderedDict()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def hash(self, image):
+        return dhash(image, self.hash_size)
+
+    @property
+    def hit_rate(self):
+        n = self.n_hits + self.n_misses
+        if n == 0:
+            return 0.
+        return self.n_hits / n
+
+    def expire(self, t=None):
+        if t is None:
+            t = time.monotonic()
+        for k in [
+                k for (k, e) in self.entries.items()
+                if t - e[1] > self.max_age]:
+            del self.entries[k]
+
+    def get(self, roi, h, t=None):
+        """Return the cached output for roi with a hash close to h or None"""
+        self.expire(t)
+        keys = [k for k in self.entries if k[0] == roi]
+        if len(keys):
+            distances = hamming(
+                h, numpy.stack([self.entries[k][0] for k in keys]))
+            i = numpy.argmin(distances)
+            if distances[i] <= self.max_distance:
+                self.n_hits += 1
+                self.entries.move_to_end(keys[i])
+                return self.entries[keys[i]][2]
+        self.n_misses += 1
+        return None
+
+    def put(self, roi, h, output, t=None):
+        if t is None:
+            t = time.monotonic()
+        # copy as outputs may be reused by the client
+        self.entries[(roi, h.tobytes())] = (h, t, numpy.copy(output))
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
@@ -2,6 +2,7 @@
 Loaded/saved by camera name (ip)
 Working copy in /dev/shm (for interaction with UI/running grabber)
 Non-volitile copy in ~/.pcam/ (load if no working copy, save manually)
+Nothing is created on import, directories are made when first written.
 
 Config should contain
 - trigger mask & other settings
@@ -14,22 +15,32 @@ Might also be used for discovery with
 - ips of known cameras and not cameras
 - service statuses
 - likely cameras (that aren't configured)
+
+Changes to working copies are noticed by a ConfigWatcher (inotify, or
+polling modification times if inotify isn't available) that counts
+changes per config in the background so checking for a change is a
+dict lookup (see Grabber.reload_config).
 """
 
+import ctypes
+import ctypes.util
 import json
 import logging
 import os
+import select
 import shutil
+import struct
+import threading
+import time
 
 
 static_cfg_dir = os.path.expanduser('~/.pcam/')
 working_cfg_dir = '/dev/shm/pcam/'  # should be on a tmpfs
 thumbnail_dir = '/dev/shm/pcam_thumbnails/'
 
-
-for d in (thumbnail_dir, ):
-    if not os.path.exists(d):
-        os.makedirs(d)
+# videos, stills, detections and logs (see grabber)
+data_dir = '/mnt/data/'
+log_dir = os.path.join(data_dir, 'logs')
 
 
 class ConfigLoadError(Exception):
@@ -77,5 +88,138 @@ def save_config(config, name, static=False):
     if not os.path.exists(dn):
         logging.debug("Making directory for config: %s", fn)
         os.makedirs(dn)
-    with open(fn, 'w') as f:
+    # write then move so readers (and watchers) never see a partial file
+    tfn = os.path.join(dn, '.%s.tmp' % os.path.basename(fn))
+    with open(tfn, 'w') as f:
         json.dump(config, f)
+    os.replace(tfn, fn)
+
+
+# inotify constants (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie, len (followed by len bytes of name)
+inotify_event = struct.Struct('iIII')
+
+
+def inotify_init(directory):
+    """inotify file descriptor watching directory, None if unavailable"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError) as e:
+        logging.debug("inotify not available: %s", e)
+        return None
+    if fd < 0:
+        logging.debug(
+            "inotify_init1 failed: %s", os.strerror(ctypes.get_errno()))
+        return None
+    wd = libc.inotify_add_watch(
+        fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE)
+    if wd < 0:
+        logging.debug(
+            "inotify_add_watch failed: %s", os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+class ConfigWatcher:
+    """Count changes to working configs (in a background thread)
+
+    Configs are watched by name (see watch). versions[name] increases
+    each time the config changes so a reader can compare it to the
+    version it last loaded without any syscalls.
+    """
+    def __init__(self, directory=None, poll_period=1.0, use_inotify=True):
+        if directory is None:
+            directory = working_cfg_dir
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.poll_period = poll_period
+
+        self.versions = {}
+        # last modified times (only used when polling)
+        self.mtimes = {}
+
+        self.fd = None
+        if use_inotify:
+            self.fd = inotify_init(self.directory)
+        if self.fd is None:
+            logging.info(
+                "Polling %s for config changes every %s seconds",
+                self.directory, self.poll_period)
+
+        self.keep_running = True
+        self.thread = threading.Thread(
+            target=self.run, name='config_watcher', daemon=True)
+        self.thread.start()
+
+    def watch(self, name):
+        if name in self.versions:
+            return
+        self.mtimes[name] = self.modified_time(name)
+        self.versions[name] = 0
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def changed(self, name):
+        if name in self.versions:
+            logging.debug("Config changed: %s", name)
+            self.versions[name] += 1
+
+    def modified_time(self, name):
+        fn = os.path.join(self.directory, name)
+        if not os.path.exists(fn):
+            return None
+        return os.path.getmtime(fn)
+
+    def poll(self):
+        for name in list(self.versions):
+            mtime = self.modified_time(name)
+            if mtime != self.mtimes.get(name):
+                self.mtimes[name] = mtime
+                self.changed(name)
+
+    def read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        i = 0
+        while i + inotify_event.size <= len(data):
+            _, _, _, n = inotify_event.unpack_from(data, i)
+            i += inotify_event.size
+            name = data[i:i + n].rstrip(b'\0')
+            i += n
+            self.changed(os.fsdecode(name))
+
+    def run(self):
+        while self.keep_running:
+            if self.fd is None:
+                time.sleep(self.poll_period)
+                self.poll()
+                continue
+            r, _, _ = select.select([self.fd], [], [], self.poll_period)
+            if r:
+                self.read_events()
+
+    def stop(self):
+        self.keep_running = False
+        self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# shared by all grabbers in a process (see get_watcher)
+watcher = None
+
+
+def get_watcher():
+    """ConfigWatcher for working_cfg_dir (started on first use)"""
+    global watcher
+    if watcher is None:
+        watcher = ConfigWatcher()
+    return watcher
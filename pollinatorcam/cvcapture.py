@@ -1,11 +1,367 @@
+import collections
 import logging
+import os
 import threading
 import time
 
 import cv2
+import numpy
 
 
-class CVCaptureThread(threading.Thread):
+class FrameBuffer:
+    """Ring buffer of timestamped frames for pre-trigger recording
+
+    Slots are allocated once (max_frames) and frames are held by reference
+    so reading them back (see last) does not copy. Frames older than
+    pre_time seconds (relative to the newest frame) are dropped as are
+    the oldest frames when more than max_bytes are held. If compress is
+    True frames are stored jpeg encoded.
+    """
+    def __init__(
+            self, pre_time=2.0, max_bytes=256 * 1024 * 1024, max_frames=300,
+            period=0.0, compress=False, quality=90):
+        self.pre_time = pre_time
+        self.max_bytes = max_bytes
+        # seconds between buffered frames (within half a frame interval)
+        self.period = period
+        self.last_offer_time = None
+        self.frame_interval = 0.0
+        self.compress = compress
+        self.quality = quality
+
+        self.frames = [None] * max_frames
+        self.timestamps = numpy.zeros(max_frames)
+        self.sizes = numpy.zeros(max_frames, dtype='i8')
+        self.head = 0  # index of oldest frame
+        self.count = 0
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _drop_oldest(self):
+        self.frames[self.head] = None
+        self.nbytes -= self.sizes[self.head]
+        self.head = (self.head + 1) % len(self.frames)
+        self.count -= 1
+
+    def newest_timestamp(self):
+        if self.count == 0:
+            return None
+        return self.timestamps[(self.head + self.count - 1) % len(self.frames)]
+
+    def wants(self, timestamp):
+        # should a frame at this timestamp be buffered?
+        if self.last_offer_time is not None:
+            dt = timestamp - self.last_offer_time
+            if self.frame_interval:
+                self.frame_interval += 0.1 * (dt - self.frame_interval)
+            else:
+                self.frame_interval = dt
+        self.last_offer_time = timestamp
+        if self.count == 0 or self.period <= 0:
+            return True
+        return (
+            timestamp - self.newest_timestamp() >=
+            self.period - self.frame_interval / 2.)
+
+    def push(self, timestamp, im):
+        if self.compress and im.ndim != 1:
+            r, im = cv2.imencode(
+                '.jpg', im, (cv2.IMWRITE_JPEG_QUALITY, self.quality))
+            if not r:
+                raise Exception("Failed to encode frame for buffer")
+        n = len(self.frames)
+        with self.lock:
+            if self.count == n:
+                self._drop_oldest()
+            while self.count and (
+                    (self.nbytes + im.nbytes > self.max_bytes) or
+                    (timestamp - self.timestamps[self.head] > self.pre_time)):
+                self._drop_oldest()
+            i = (self.head + self.count) % n
+            self.frames[i] = im
+            self.timestamps[i] = timestamp
+            self.sizes[i] = im.nbytes
+            self.nbytes += im.nbytes
+            self.count += 1
+
+    def since(self, timestamp):
+        """Return [(timestamp, frame), ...] for frames newer than timestamp
+
+        Frames are returned oldest first and are not copied. Compressed
+        frames are 1d uint8 arrays of jpeg bytes (see decode_frame).
+        """
+        n = len(self.frames)
+        with self.lock:
+            frames = []
+            for o in range(self.count):
+                i = (self.head + o) % n
+                if self.timestamps[i] > timestamp:
+                    frames.append((float(self.timestamps[i]), self.frames[i]))
+            return frames
+
+    def last(self, duration=None):
+        if duration is None:
+            duration = self.pre_time
+        ts = self.newest_timestamp()
+        if ts is None:
+            return []
+        return self.since(ts - duration)
+
+
+def decode_frame(im):
+    # jpeg bytes (from a compressed FrameBuffer or passthrough capture) to BGR
+    if im.ndim == 1:
+        return cv2.imdecode(im, cv2.IMREAD_COLOR)
+    return im
+
+
+# start of frame markers (excluding DHT, JPG and DAC)
+sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_shape(data):
+    """Read (height, width, 3) from the frame header of jpeg bytes"""
+    b = memoryview(data)
+    if len(b) < 4 or b[0] != 0xFF or b[1] != 0xD8:
+        raise ValueError("Invalid jpeg, missing start of image")
+    i = 2
+    while i + 9 < len(b):
+        if b[i] != 0xFF:
+            raise ValueError("Invalid jpeg, missing marker at %s" % (i, ))
+        marker = b[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in sof_markers:
+            h = (b[i + 5] << 8) | b[i + 6]
+            w = (b[i + 7] << 8) | b[i + 8]
+            return (h, w, 3)
+        i += 2 + ((b[i + 2] << 8) | b[i + 3])
+    raise ValueError("Invalid jpeg, missing start of frame")
+
+
+def reduce_level(scale):
+    """Largest supported Frame.reduced factor that is <= scale"""
+    levels = [n for n in sorted(Frame.reduce_flags) if n <= scale]
+    if not levels:
+        return 1
+    return levels[-1]
+
+
+class Frame:
+    """A captured frame and its capture metadata
+
+    Holds either the native BGR image or (for passthrough capture) the
+    jpeg bytes. Other forms are handed out on demand and memoized so
+    each is computed at most once:
+        bgr: full resolution BGR image (decoded if needed)
+        rgb: contiguous RGB copy of bgr
+        reduced(n): 1/n scale BGR image, n in (1, 2, 4, 8), for jpegs
+            this is a DCT domain reduced decode, otherwise levels form a
+            pyramid (each level is computed from the next finer one)
+        crop(slices, n): view of reduced(n)
+        patch(slices, size, n): crop resized to size (w, h) as RGB
+    """
+    reduce_flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def __init__(self, bgr=None, jpeg=None, timestamp=None, index=None):
+        if bgr is None and jpeg is None:
+            raise ValueError("Frame requires a bgr image or jpeg bytes")
+        self.jpeg = jpeg
+        self.timestamp = timestamp
+        self.index = index
+        self._reduced = {}
+        self._rgb = None
+        # seconds spent decoding jpeg bytes
+        self.decode_time = 0.
+        if bgr is not None:
+            self._reduced[1] = bgr
+            self.shape = bgr.shape
+        else:
+            try:
+                self.shape = jpeg_shape(jpeg)
+            except ValueError as e:
+                logging.warning("Failed to parse jpeg header: %s", e)
+                self.shape = self.bgr.shape
+
+    @property
+    def bgr(self):
+        return self.reduced(1)
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    def reduced(self, reduce=1):
+        if reduce not in self._reduced:
+            if reduce not in self.reduce_flags:
+                raise ValueError(
+                    "Unsupported reduce factor %s (see reduce_level)" % (
+                        reduce, ))
+            if self.jpeg is not None:
+                t0 = time.perf_counter()
+                im = cv2.imdecode(self.jpeg, self.reduce_flags[reduce])
+                self.decode_time += time.perf_counter() - t0
+                if im is None:
+                    raise Exception("Failed to decode jpeg frame")
+            else:
+                # 2x downscale of the next finer level
+                src = self.reduced(reduce // 2)
+                h, w = src.shape[:2]
+                im = cv2.resize(
+                    src, (-(-w // 2), -(-h // 2)),
+                    interpolation=cv2.INTER_AREA)
+            self._reduced[reduce] = im
+        return self._reduced[reduce]
+
+    def crop(self, slices, reduce=1):
+        return self.reduced(reduce)[slices]
+
+    def patch(self, slices, size, reduce=1):
+        # resize before color conversion so only the small patch is copied
+        return cv2.cvtColor(
+            cv2.resize(
+                self.crop(slices, reduce), size,
+                interpolation=cv2.INTER_AREA),
+            cv2.COLOR_BGR2RGB)
+
+    def write(self, fn):
+        if self.jpeg is not None and fn.endswith('.jpg'):
+            # already jpeg encoded, write without re-encoding
+            with open(fn, 'wb') as f:
+                f.write(self.jpeg.data)
+            return
+        cv2.imwrite(fn, self.bgr)
+
+
+class CaptureError(Exception):
+    pass
+
+
+class FrameSubscription:
+    """Delivers frames from a capture thread to one consumer
+
+    Modes:
+        latest: only the newest undelivered frame is kept (for analysis)
+        all: frames are queued, up to maxsize (for recording)
+    Frames are offered about once every period seconds (0 = every
+    frame, within half a frame interval so capture jitter doesn't skip
+    frames) and not at all while paused. Frames that are replaced
+    (latest) or pushed out of a full queue (all) are counted as dropped.
+    Frame.index is a sequence number that increases with every frame
+    read from the device.
+
+    A subscription can outlive (and be moved between) capture threads.
+    """
+    def __init__(
+            self, mode='latest', period=0.0, maxsize=30, event=None,
+            paused=False):
+        if mode not in ('latest', 'all'):
+            raise ValueError("Invalid subscription mode: %s" % (mode, ))
+        self.mode = mode
+        self.period = period
+        self.maxsize = 1 if mode == 'latest' else maxsize
+        self.paused = paused
+        # optional threading.Event set for every new frame (or error)
+        # so one thread can wait on several subscriptions (see hub)
+        self.event = event
+
+        self.frames = collections.deque()
+        self.error = None
+        self.ready = threading.Condition()
+        self.last_put_time = None
+        # smoothed time between frames offered by the capture thread
+        self.last_offer_time = None
+        self.frame_interval = 0.0
+        self.last_index = None
+        self.delivered = 0
+        self.dropped = 0
+
+    def wants(self, t):
+        if self.last_offer_time is not None:
+            dt = t - self.last_offer_time
+            if self.frame_interval:
+                self.frame_interval += 0.1 * (dt - self.frame_interval)
+            else:
+                self.frame_interval = dt
+        self.last_offer_time = t
+        if self.paused:
+            return False
+        return (
+            self.last_put_time is None or
+            (t - self.last_put_time) >= self.period - self.frame_interval / 2.)
+
+    def put(self, frame, t=None):
+        if t is None:
+            t = time.monotonic()
+        with self.ready:
+            self.last_put_time = t
+            while len(self.frames) >= self.maxsize:
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(frame)
+            self.ready.notify()
+        if self.event is not None:
+            self.event.set()
+
+    def put_error(self, error):
+        with self.ready:
+            self.error = error
+            self.ready.notify()
+        if self.event is not None:
+            self.event.set()
+
+    def _pop(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise CaptureError(error)
+        frame = self.frames.popleft()
+        self.last_index = frame.index
+        self.delivered += 1
+        return frame
+
+    def get(self, timeout=None):
+        """Return the next Frame
+
+        Raises RuntimeError if no frame arrives within timeout and
+        CaptureError if the capture failed.
+        """
+        with self.ready:
+            if not self.ready.wait_for(
+                    lambda: len(self.frames) or self.error is not None,
+                    timeout=timeout):
+                raise RuntimeError("No new image within timeout")
+            return self._pop()
+
+    def get_nowait(self):
+        # return the next Frame or None if none is available
+        with self.ready:
+            if not len(self.frames) and self.error is None:
+                return None
+            return self._pop()
+
+    def clear(self):
+        with self.ready:
+            self.frames.clear()
+            self.error = None
+
+
+class CaptureThread(threading.Thread):
+    """Base capture thread: frame sequencing, buffering and delivery
+
+    Subclasses read frames from a device and pass them to publish.
+    """
     def __init__(self, *args, **kwargs):
         self.cam = kwargs.pop('cam')
         if 'retry' in kwargs:
@@ -13,11 +369,75 @@ class CVCaptureThread(threading.Thread):
         else:
             self.retry = False
         kwargs['daemon'] = kwargs.get('daemon', True)
-        properties = kwargs.pop('properties', {})
 
-        # limit capture rate to at most N seconds
-        self.capture_period = kwargs.pop('capture_period', 0)
-        self.last_capture_time = time.monotonic() - self.capture_period
+        # optional FrameBuffer filled with (BGR) frames between analyses
+        self.buffer = kwargs.pop('buffer', None)
+
+        # if True, request undecoded (mjpeg) frames from the device
+        # frames are then handed out as 1d arrays of jpeg bytes
+        self.passthrough = kwargs.pop('passthrough', False)
+
+        # FrameSubscriptions to deliver frames to (see subscribe)
+        self.subscriptions = list(kwargs.pop('subscriptions', []))
+
+        # sequence number of the last frame read
+        self.frame_count = kwargs.pop('first_index', 0) - 1
+
+        super(CaptureThread, self).__init__(*args, **kwargs)
+
+        self.keep_running = True
+
+    def subscribe(self, subscription):
+        # replace (rather than append to) the list so iteration is safe
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [
+            s for s in self.subscriptions if s is not subscription]
+
+    def wanted(self, t):
+        """Return (subscriptions, buffer) that want a frame at time t
+
+        if neither want a frame, the frame does not need to be read
+        """
+        subscriptions = [s for s in self.subscriptions if s.wants(t)]
+        buffer = self.buffer is not None and self.buffer.wants(time.time())
+        return subscriptions, buffer
+
+    def publish(self, im, ts, t, subscriptions, buffer):
+        # im is BGR or (undecoded) 1d jpeg bytes
+        self.frame_count += 1
+        if buffer:
+            self.buffer.push(ts, im)
+        if not subscriptions:
+            return
+        if im.ndim == 1:
+            frame = Frame(jpeg=im, timestamp=ts, index=self.frame_count)
+        else:
+            frame = Frame(bgr=im, timestamp=ts, index=self.frame_count)
+        for s in subscriptions:
+            s.put(frame, t)
+
+    def publish_error(self, error):
+        for s in self.subscriptions:
+            s.put_error(error)
+
+    def set_properties(self, properties):
+        raise NotImplementedError("Abstract base class")
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            self.join()
+
+    def __del__(self):
+        self.stop()
+
+
+class CVCaptureThread(CaptureThread):
+    def __init__(self, *args, **kwargs):
+        properties = kwargs.pop('properties', {})
 
         super(CVCaptureThread, self).__init__(*args, **kwargs)
 
@@ -27,14 +447,6 @@ class CVCaptureThread(threading.Thread):
             self.url = self.cam
         self._start_cap(properties)
 
-        self.error = None
-        self.keep_running = True
-
-        self.timestamp = None
-        self.image = None
-        self.image_ready = threading.Condition() 
-
-
     def _start_cap(self, properties=None):
         if hasattr(self, 'cap'):
             del self.cap
@@ -45,6 +457,11 @@ class CVCaptureThread(threading.Thread):
         # TODO settings should be dynamic to allow focus adjustment
         if properties is not None:
             self.set_properties(properties)
+        if self.passthrough:
+            # must be set after fourcc
+            if not self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+                logging.warning(
+                    "Failed to disable frame conversion for %s", self.url)
 
     def set_properties(self, properties, retries=5):
         # reorder list of property names to have some elements first
@@ -100,51 +517,117 @@ class CVCaptureThread(threading.Thread):
 
     def _read_frame(self):
         t = time.monotonic()
-        if (t - self.last_capture_time) < self.capture_period:
+        subscriptions, buffer = self.wanted(t)
+        if not (subscriptions or buffer):
             # grab (and throw out) frame
             self.cap.grab()
+            self.frame_count += 1
             return
         r, im = self.cap.read()
-        self.last_capture_time = t
         #r, im = self.cap.read()
         # convert to rgb
         if not r or im is None:
             raise Exception("Failed to capture: %s, %s" % (r, im))
-        with self.image_ready:
-            #if self.timestamp is not None:
-            #    print("Frame dt:", time.time() - self.timestamp)
-            self.timestamp = time.time()
-            self.image = im[:, :, ::-1]  # BGR to RGB
-            self.error = None
-            self.image_ready.notify()
+        ts = time.time()
+        if im.ndim == 2 and im.shape[0] == 1:
+            # undecoded frame, flatten to jpeg bytes
+            im = im.reshape(-1)
+        elif self.passthrough:
+            logging.warning(
+                "Requested undecoded frames but received %s, disabling",
+                im.shape)
+            self.passthrough = False
+        self.publish(im, ts, t, subscriptions, buffer)
 
     def run(self):
         while self.keep_running:
             try:
                 self._read_frame()
             except Exception as e:
-                with self.image_ready:
-                    self.error = e
-                    self.timestamp = time.time()
-                    self.image = None
-                    self.image_ready.notify()
+                self.publish_error(e)
                 if not self.retry:
                     break
                 logging.info("Restarting capture: %s[%s]", self.url, e)
                 self._start_cap()
 
-    def next_image(self, timeout=None):
-        with self.image_ready:
-            if not self.image_ready.wait(timeout=timeout):
-                raise RuntimeError("No new image within timeout")
-            if self.error is None:
-                return True, self.image, self.timestamp
-            return False, self.error, self.timestamp
 
-    def stop(self):
-        if self.is_alive():
-            self.keep_running = False
-            self.join()
+class SyntheticCaptureThread(CaptureThread):
+    """Frames without a camera (for benchmarking)
 
-    def __del__(self):
-        self.stop()
+    cam is a video filename (looped) or None to generate frames, a
+    textured background with a dark square moving across it. Generated
+    frames are properties frame_width x frame_height and all frames
+    are delivered at properties fps. With passthrough, frames are
+    delivered as jpeg bytes (like an mjpeg camera).
+    """
+    def __init__(self, *args, **kwargs):
+        properties = kwargs.pop('properties', {})
+
+        super(SyntheticCaptureThread, self).__init__(*args, **kwargs)
+
+        self.cap = None
+        if self.cam is not None and os.path.isfile(self.cam):
+            self.cap = cv2.VideoCapture(self.cam)
+        self.background = None
+        self.set_properties(properties)
+        self.next_time = time.monotonic()
+
+    def set_properties(self, properties):
+        self.width = properties.get('frame_width', 640)
+        self.height = properties.get('frame_height', 480)
+        self.period = 1. / properties.get('fps', 30)
+
+    def generate(self):
+        if self.background is None or self.background.shape[:2] != (
+                self.height, self.width):
+            rng = numpy.random.default_rng(0)
+            self.background = cv2.GaussianBlur(
+                rng.integers(
+                    0, 256, (self.height, self.width, 3), dtype='u1'),
+                (5, 5), 0)
+        im = self.background.copy()
+        # dark square crossing the frame every 10 seconds
+        s = max(self.height, self.width) // 8
+        x = int(
+            (self.frame_count * self.period % 10.) / 10. *
+            (self.width - s))
+        y = (self.height - s) // 2
+        im[y:y + s, x:x + s] //= 4
+        return im
+
+    def read(self):
+        if self.cap is None:
+            return self.generate()
+        r, im = self.cap.read()
+        if not r:
+            # loop
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            r, im = self.cap.read()
+            if not r:
+                raise Exception("Failed to read: %s" % (self.cam, ))
+        return im
+
+    def _read_frame(self):
+        # pace frames to fps
+        dt = self.next_time - time.monotonic()
+        if dt > 0:
+            time.sleep(dt)
+        self.next_time = max(self.next_time + self.period, time.monotonic())
+        t = time.monotonic()
+        subscriptions, buffer = self.wanted(t)
+        im = self.read()
+        if not (subscriptions or buffer):
+            self.frame_count += 1
+            return
+        if self.passthrough:
+            im = cv2.imencode('.jpg', im)[1].reshape(-1)
+        self.publish(im, time.time(), t, subscriptions, buffer)
+
+    def run(self):
+        while self.keep_running:
+            try:
+                self._read_frame()
+            except Exception as e:
+                self.publish_error(e)
+                if not self.retry:
+                    break
@@ -3,15 +3,16 @@
 
 import subprocess
 import sys
-import time
 import threading
 
 import cv2
 
+from . import cvcapture
 
+
+# the frame size is taken from the first written frame
 video_settings = {
     'fourcc': 'mp4v',
-    'framesize': (2592, 1944),  #TODO?
     'fps': 5,  # TODO?
 }
 
@@ -21,35 +22,112 @@ class CVRecorder(threading.Thread):
         self.filename = None
         self.writer = None
         url = kwargs.pop('url')
+        # optional cvcapture.FrameBuffer to pull pre-record frames from
+        self.buffer = kwargs.pop('buffer', None)
+        # optional cvcapture.FrameSubscription ('all' mode) to record from
+        # if None, frames are written as they are passed to new_image
+        self.frames = kwargs.pop('frames', None)
+        if self.frames is not None:
+            self.frames.paused = True
+        self.last_frame_time = None
+        # set by start_saving until run has written the buffered frames
+        self.preroll = threading.Event()
+        self.lock = threading.Lock()
+        self.keep_running = True
+        kwargs['daemon'] = kwargs.get('daemon', True)
         super().__init__(*args, **kwargs)
 
     def run(self):
-        # TODO thread run function
-        # wait for new image (signal, pipe, etc) from new_image
-        # write new_image to filename
-        while True:
-            time.sleep(1)
-            pass
+        # write the pre-record frames then frames from the subscription
+        # while saving (so the triggering thread isn't blocked)
+        while self.keep_running:
+            if self.frames is None:
+                if self.preroll.wait(1.0):
+                    with self.lock:
+                        self.write_preroll()
+                continue
+            try:
+                frame = self.frames.get(timeout=1.0)
+            except (RuntimeError, cvcapture.CaptureError):
+                with self.lock:
+                    self.write_preroll()
+                continue
+            with self.lock:
+                if self.filename is None:
+                    continue
+                self.write_preroll()
+                self.write_frames([(frame.timestamp, frame)])
+
+    def write_preroll(self):
+        # called with lock held
+        if not self.preroll.is_set():
+            return
+        self.preroll.clear()
+        if self.filename is not None:
+            self.write_frames(self.buffer.last())
+
+    def stop(self):
+        self.keep_running = False
+        if self.filename is not None:
+            self.stop_saving()
+        if self.is_alive():
+            self.join()
 
     def start_saving(self, fn):
-        # TODO write in thread
-        self.filename = fn
-        # fn, fourcc, fps, framesize, iscolor
-        self.writer = cv2.VideoWriter(
-            fn, cv2.VideoWriter_fourcc(*video_settings['fourcc']),
-            video_settings['fps'],
-            video_settings['framesize'],
-            True)
+        with self.lock:
+            # the writer is opened by the first write_frames
+            self.filename = fn
+            if self.buffer is not None:
+                # pre record period is written in run
+                self.preroll.set()
+        if self.frames is not None:
+            self.frames.paused = False
+
+    def write_frames(self, frames):
+        # frames are (timestamp, Frame or buffered image)
+        for ts, im in frames:
+            if self.last_frame_time is not None and ts <= self.last_frame_time:
+                # already written (from the buffer)
+                continue
+            if isinstance(im, cvcapture.Frame):
+                im = im.bgr
+            im = cvcapture.decode_frame(im)
+            if self.writer is None:
+                # fn, fourcc, fps, framesize, iscolor
+                self.writer = cv2.VideoWriter(
+                    self.filename,
+                    cv2.VideoWriter_fourcc(*video_settings['fourcc']),
+                    video_settings['fps'],
+                    (im.shape[1], im.shape[0]),
+                    True)
+            self.writer.write(im)
+            self.last_frame_time = ts
 
     def stop_saving(self):
-        # TODO write in thread
-        self.filename = None
-        self.writer.release()
-        self.writer = None
+        if self.frames is not None:
+            self.frames.paused = True
+            self.frames.clear()
+        with self.lock:
+            self.filename = None
+            self.preroll.clear()
+            if self.writer is not None:
+                self.writer.release()
+            self.writer = None
+            self.last_frame_time = None
 
-    def new_image(self, im):
-        # TODO write in thread
-        # TODO pre record period?
-        if self.writer is not None:
-            # TODO swap rgb to bgr
-            self.writer.write(im)
+    def new_image(self, frame):
+        if self.frames is not None:
+            # frames are written in run
+            return
+        with self.lock:
+            if self.filename is None or self.preroll.is_set():
+                return
+            if self.buffer is not None:
+                # write all buffered frames since the last write
+                if self.last_frame_time is None:
+                    frames = self.buffer.last()
+                else:
+                    frames = self.buffer.since(self.last_frame_time)
+                self.write_frames(frames)
+            else:
+                self.write_frames([(frame.timestamp, frame)])
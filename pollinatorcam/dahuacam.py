@@ -9,8 +9,6 @@ import os
 import urllib
 import socket
 
-import requests
-
 
 def build_camera_url(
         ip, user=None, password=None, channel=1, subtype=0):
@@ -253,6 +251,9 @@ class DahuaCamera:
         self.password = password
         self.ip = ip
 
+        # requests is slow to import, only import it when used
+        import requests
+        import requests.auth
         self.session = requests.Session()
         self.session.auth = requests.auth.HTTPDigestAuth(
             self.user, self.password)
@@ -500,6 +501,7 @@ class DahuaCamera:
                 new_password=password, password=self.password))
         r = self.session.get(url)
         if r.ok:
+            import requests.auth
             self.password = password
             self.session.auth = requests.auth.HTTPDigestAuth(
                 self.user, self.password)
@@ -0,0 +1,157 @@
+"""
+Detection records
+
+Detector (ssd/efficientdet) outputs are rows of:
+    label, score, ymin, xmin, ymax, xmax
+These are converted (without python loops) to a structured array with
+one record per detection (see detection_dtype) that is passed as-is
+to meta, the csv writer and logger.MetaJSONEncoder.
+
+Detector bboxes are normalized (0-1) to the roi patch. When roi
+coordinates are provided they are mapped to frame pixels so detections
+from overlapping rois (or tiles) can be merged with nms.
+"""
+
+import logging
+
+import numpy
+
+
+detection_dtype = numpy.dtype([
+    ('label', 'i4'),
+    ('score', 'f4'),
+    ('ymin', 'f4'),
+    ('xmin', 'f4'),
+    ('ymax', 'f4'),
+    ('xmax', 'f4'),
+    ('roi', 'i2'),
+    ('track', 'i4'),  # -1 if not tracked (see tracker)
+])
+
+bbox_fields = ('ymin', 'xmin', 'ymax', 'xmax')
+
+
+def empty():
+    return numpy.empty(0, dtype=detection_dtype)
+
+
+def scores(records, n_classes):
+    """1 x n_classes array of the max score per label (like a classifier)"""
+    s = numpy.zeros((1, n_classes))
+    # scatter-max scores into classifier-like output
+    numpy.maximum.at(s[0], records['label'], records['score'])
+    return s
+
+
+def from_output(output, n_classes, roi=0, coords=None):
+    """Convert detector output rows to (scores, records)
+
+    scores is a 1 x n_classes array of the max score per label
+    (as a classifier would output) and records are the detections.
+    If coords (top, bottom, left, right) of the roi are provided
+    bboxes are converted to frame pixels.
+    """
+    output = numpy.asarray(output, dtype='f4')
+    if output.ndim != 2 or output.shape[0] == 0:
+        return numpy.zeros((1, n_classes)), empty()
+    labels = output[:, 0].astype('i4')
+    invalid = labels >= n_classes
+    if numpy.any(invalid):
+        if n_classes == 2:
+            # Conditional for new FPN models 1-class behavior
+            labels[invalid] = 0
+        else:
+            logging.warning(
+                "Invalid label_ids[%s] > number of classes[%s]",
+                labels[invalid], n_classes)
+            output = output[~invalid]
+            labels = labels[~invalid]
+
+    records = numpy.zeros(len(labels), dtype=detection_dtype)
+    records['label'] = labels
+    records['score'] = output[:, 1]
+    for (i, f) in enumerate(bbox_fields[:output.shape[1] - 2]):
+        records[f] = output[:, 2 + i]
+    records['roi'] = roi
+    records['track'] = -1
+    if coords is not None:
+        to_frame(records, coords)
+    return scores(records, n_classes), records
+
+
+def select(records, labels):
+    """Records with a label in labels, ordered by labels then score"""
+    if not len(records) or not len(labels):
+        return records[:0]
+    labels = numpy.asarray(labels)
+    rank = numpy.full(
+        max(int(labels.max()), int(records['label'].max())) + 1, -1)
+    rank[labels] = numpy.arange(len(labels))
+    r = rank[records['label']]
+    keep = r >= 0
+    selected = records[keep]
+    return selected[numpy.lexsort((-selected['score'], r[keep]))]
+
+
+def bboxes(records):
+    """N x 4 (ymin, xmin, ymax, xmax) array"""
+    return numpy.stack([records[f] for f in bbox_fields], axis=-1)
+
+
+def to_frame(records, coords):
+    """Map normalized roi bboxes (in place) to frame pixels"""
+    t, b, l, r = coords
+    for (f, o, d) in (
+            ('ymin', t, b - t), ('xmin', l, r - l),
+            ('ymax', t, b - t), ('xmax', l, r - l)):
+        records[f] = o + records[f] * d
+    return records
+
+
+def area(boxes):
+    return (
+        (boxes[:, 2] - boxes[:, 0]).clip(0) *
+        (boxes[:, 3] - boxes[:, 1]).clip(0))
+
+
+def iou(a, b):
+    """N x M intersection over union of N x 4 and M x 4 boxes"""
+    tl = numpy.maximum(a[:, None, :2], b[None, :, :2])
+    br = numpy.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = numpy.prod((br - tl).clip(0), axis=2)
+    union = area(a)[:, None] + area(b)[None, :] - inter
+    return inter / numpy.maximum(union, 1e-12)
+
+
+def iou_matrix(boxes):
+    """N x N intersection over union for N x 4 (ymin, xmin, ymax, xmax)"""
+    return iou(boxes, boxes)
+
+
+def nms(records, iou=0.5, max_records=256):
+    """Greedy non-maximum suppression per label (across rois)
+
+    Returns the kept records sorted by descending score. Only the
+    max_records highest scoring records are considered (the overlap
+    matrix is max_records x max_records).
+    """
+    if len(records) < 2:
+        return records
+    records = records[numpy.argsort(-records['score'], kind='stable')]
+    if len(records) > max_records:
+        logging.debug(
+            "nms: dropping %i lowest scoring of %i records",
+            len(records) - max_records, len(records))
+        records = records[:max_records]
+    boxes = bboxes(records).astype('f8')
+    # offset boxes by label so different labels never overlap
+    span = boxes.max() - boxes.min() + 1
+    boxes += records['label'][:, None] * span
+    # suppress[i, j]: higher scoring i overlaps lower scoring j
+    suppress = numpy.triu(iou_matrix(boxes) > iou, k=1)
+    keep = numpy.ones(len(records), dtype=bool)
+    # only records that overlap a lower scoring one can suppress
+    for i in numpy.flatnonzero(suppress.any(axis=1)):
+        if keep[i]:
+            keep[suppress[i]] = False
+    return records[keep]
@@ -161,7 +161,7 @@ def status_of_all_camera_services():
     return cams
 
 
-def check_cameras(cidr=None):
+def check_cameras(cidr=None, start_services=True):
     # dictionary where keys=ips, value=dict
     #   is_camera=True/False
     #   is_configured=True/False
@@ -207,7 +207,7 @@ def check_cameras(cidr=None):
         # verify nas config
         if is_camera and is_configured:
             verify_nas_config(ip)
-            if not cam['service']['Active']:
+            if start_services and not cam['service']['Active']:
                 try:
                     start_camera_service(ip)
                     rescan_services = True
@@ -228,7 +228,7 @@ def check_cameras(cidr=None):
     config.save_config(new_cfg, cfg_name)
 
 
-def check_v4l2_cameras():
+def check_v4l2_cameras(start_services=True):
     # load old config
     logging.debug("Loading old config from %s", cfg_name)
     cfg = config.load_config(cfg_name, {})
@@ -272,7 +272,9 @@ def check_v4l2_cameras():
         }
 
         # start service if not running
-        if cam_cfg['is_camera'] and not cam_cfg['service']['Active']:
+        if (
+                start_services and cam_cfg['is_camera'] and
+                not cam_cfg['service']['Active']):
             logging.debug("Starting service for %s", name)
             try:
                 start_camera_service(name)
@@ -305,6 +307,9 @@ def cmdline_run():
     parser.add_argument(
         '-p', '--print', action='store_true',
         help="print last discover results")
+    parser.add_argument(
+        '-s', '--no_services', action='store_true',
+        help="don't start pcam@ services (when cameras run in pcam-hub)")
     parser.add_argument(
         '-u', '--usb', action='store_true',
         help="scan for usb (instead of ip) cameras")
@@ -355,10 +360,10 @@ def cmdline_run():
     t0 = time.monotonic()
     if args.usb:  # search for usb/v4l2 devices instead of ip
         logging.debug("Scanning for v4l2 devices")
-        check_v4l2_cameras()
+        check_v4l2_cameras(start_services=not args.no_services)
     else:
         logging.debug("Scanning for ip devices")
-        check_cameras(cidr)
+        check_cameras(cidr, start_services=not args.no_services)
     t1 = time.monotonic()
     logging.debug("check_cameras took %0.4f seconds", t1 - t0)
 
@@ -0,0 +1,301 @@
+"""
+Inference engines
+
+Engines run the model for Grabber (and the Broker) and all look like a
+tfliteserve.Client:
+    .buffers.meta: model info with 'input' ('shape', 'dtype'),
+        'labels' ({index: label}) and 'type' ('classifier' or 'detector')
+    .run(image): output for one image
+    .run_many(images): list of outputs, batched when the model allows
+Outputs are 1 x n_classes scores (classifier) or N x (label, score,
+ymin, xmin, ymax, xmax) rows (detector) as tfliteserve returns them.
+
+Types (see build):
+    tfliteserve: send images to a tfliteserve process (run_tfliteserve.sh)
+    local: run the model in this process on a thread pool with
+        tflite_runtime (or tensorflow.lite) or OpenCV DNN, this avoids
+        the second process for single camera systems
+    fake: deterministic stand in (see fake_server.py), dark images
+        output 1s (classifier) or a centered detection (detector)
+"""
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+import numpy
+
+
+class Buffers:
+    # mimics tfliteserve.Client.buffers
+    def __init__(self, meta):
+        self.meta = meta
+
+
+class Engine:
+    def __init__(self, meta):
+        self.buffers = Buffers(meta)
+
+    @property
+    def meta(self):
+        return self.buffers.meta
+
+    @property
+    def is_detector(self):
+        return self.meta.get('type', 'classifier') == 'detector'
+
+    def run_many(self, images):
+        raise NotImplementedError("Abstract base class")
+
+    def run(self, image):
+        return self.run_many([image])[0]
+
+    def close(self):
+        pass
+
+
+class TFLiteServeEngine(Engine):
+    """Run images through a tfliteserve server"""
+    def __init__(self, name):
+        import tfliteserve
+        logging.info("Connecting to tfliteserve as %s", name)
+        self.client = tfliteserve.Client(name)
+        # share (not copy) the client buffers
+        self.buffers = self.client.buffers
+        # input for batched inference (see run_many)
+        self.batch = None
+
+    def run_many(self, images):
+        """Run images stacked (and zero padded) into batches
+
+        If the model input has a batch size > 1 several images cost
+        one request, otherwise each image is run separately.
+        """
+        shape = self.meta['input']['shape']
+        if shape[0] <= 1:
+            # copy as outputs may be reused by the next run
+            return [numpy.copy(self.client.run(im)) for im in images]
+        if self.batch is None:
+            self.batch = numpy.zeros(
+                shape, dtype=self.meta['input'].get('dtype', 'uint8'))
+        outputs = []
+        for i in range(0, len(images), shape[0]):
+            chunk = images[i:i + shape[0]]
+            for (j, im) in enumerate(chunk):
+                self.batch[j] = im
+            self.batch[len(chunk):] = 0
+            o = numpy.copy(self.client.run(self.batch))
+            for j in range(len(chunk)):
+                # classifier outputs stay 1 x n_classes,
+                # detector outputs are N x (label, score, bbox...)
+                outputs.append(o[j] if self.is_detector else o[j:j + 1])
+        return outputs
+
+
+def load_labels(fn):
+    """Labels file with one label per line (line number = index)"""
+    with open(fn, 'r') as f:
+        return {
+            i: l.strip() for (i, l) in enumerate(f.readlines())
+            if l.strip()}
+
+
+class TFLiteRunner:
+    """One tflite interpreter (these are not thread safe)"""
+    def __init__(self, model, num_threads=1):
+        try:
+            import tflite_runtime.interpreter as tflite
+        except ImportError:
+            import tensorflow.lite as tflite
+        self.interpreter = tflite.Interpreter(
+            model_path=model, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.outputs = self.interpreter.get_output_details()
+        self.shape = tuple(self.input['shape'])
+        self.dtype = numpy.dtype(self.input['dtype']).name
+
+    def __call__(self, image):
+        self.interpreter.set_tensor(
+            self.input['index'],
+            image.reshape(self.shape).astype(self.dtype, copy=False))
+        self.interpreter.invoke()
+        outputs = []
+        for d in self.outputs:
+            o = self.interpreter.get_tensor(d['index'])
+            scale, zero_point = d.get('quantization', (0., 0))
+            if scale:
+                o = (o.astype('f4') - zero_point) * scale
+            outputs.append(numpy.copy(o))
+        return outputs
+
+
+class DNNRunner:
+    """One OpenCV DNN network, shape (h, w) is required"""
+    def __init__(self, model, shape=None, scale=1.0, mean=0.0):
+        import cv2
+        self.cv2 = cv2
+        if shape is None:
+            raise ValueError("OpenCV DNN engine requires an input shape")
+        if model.endswith('.tflite'):
+            self.net = cv2.dnn.readNetFromTFLite(model)
+        else:
+            self.net = cv2.dnn.readNet(model)
+        self.names = self.net.getUnconnectedOutLayersNames()
+        self.shape = (1, shape[0], shape[1], 3)
+        self.dtype = 'uint8'
+        self.scale = scale
+        self.mean = mean
+
+    def __call__(self, image):
+        self.net.setInput(self.cv2.dnn.blobFromImage(
+            image.reshape(self.shape[1:]), self.scale,
+            mean=(self.mean, ) * 3))
+        return list(self.net.forward(self.names))
+
+
+def to_detector_output(outputs):
+    """Convert ssd postprocess outputs to N x (label, score, bbox) rows
+
+    Outputs are boxes (1 x N x 4), classes (1 x N), scores (1 x N) and
+    count (1) in a model dependent order. Classes are told apart from
+    scores by being whole numbers.
+    """
+    boxes = None
+    count = None
+    vectors = []
+    for o in outputs:
+        if o.ndim == 3 and o.shape[-1] == 4:
+            boxes = o[0]
+        elif o.size == 1:
+            count = int(o.flat[0])
+        else:
+            vectors.append(o.reshape(-1))
+    if boxes is None or len(vectors) != 2:
+        raise ValueError(
+            "Unknown detector outputs: %s" % ([o.shape for o in outputs], ))
+    if numpy.all(numpy.mod(vectors[0], 1) == 0):
+        classes, scores = vectors
+    else:
+        scores, classes = vectors
+    if count is None:
+        count = len(scores)
+    return numpy.column_stack(
+        [classes[:count], scores[:count], boxes[:count]]).astype('f4')
+
+
+class LocalEngine(Engine):
+    """Run a model in this process on a pool of threads
+
+    Each thread has it's own interpreter (or network). tflite models use
+    tflite_runtime (or tensorflow.lite) if available, otherwise (and for
+    other model formats) OpenCV DNN is used.
+    """
+    def __init__(
+            self, model, labels=None, model_type='detector', threads=1,
+            num_threads=1, shape=None):
+        self.model = os.path.expanduser(model)
+        self.model_type = model_type
+        self.num_threads = num_threads
+        self.shape = shape
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='engine')
+
+        # interpreters are only made on pool threads (one per thread),
+        # the first one also provides the input shape
+        runner = self.pool.submit(self.runner).result()
+        if labels is None:
+            labels = os.path.splitext(self.model)[0] + '-labels.txt'
+        meta = {
+            'input': {'shape': runner.shape, 'dtype': runner.dtype},
+            'labels': load_labels(os.path.expanduser(labels)),
+            'type': model_type,
+        }
+        super(LocalEngine, self).__init__(meta)
+        logging.info(
+            "Loaded %s model %s with %s threads",
+            model_type, self.model, threads)
+
+    def runner(self):
+        # per-thread interpreter/network
+        if not hasattr(self.local, 'runner'):
+            if self.model.endswith('.tflite'):
+                try:
+                    self.local.runner = TFLiteRunner(
+                        self.model, self.num_threads)
+                except ImportError:
+                    logging.info("tflite_runtime not found, using OpenCV DNN")
+                    self.local.runner = DNNRunner(self.model, self.shape)
+            else:
+                self.local.runner = DNNRunner(self.model, self.shape)
+        return self.local.runner
+
+    def run_one(self, image):
+        outputs = self.runner()(image)
+        if self.is_detector:
+            return to_detector_output(outputs)
+        return outputs[0].reshape(1, -1).astype('f4', copy=False)
+
+    def run_many(self, images):
+        return list(self.pool.map(self.run_one, images))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class FakeEngine(Engine):
+    """Deterministic stand in model, see fake_server.py
+
+    delay (seconds) is added per run_many call to mimic inference time
+    """
+    def __init__(
+            self, n_classes=1024, shape=(224, 224), model_type='classifier',
+            delay=0.0):
+        self.delay = delay
+        meta = {
+            'input': {'shape': (1, shape[0], shape[1], 3), 'dtype': 'uint8'},
+            'output': {'shape': (1, n_classes), 'dtype': 'f8'},
+            'labels': {i: str(i) for i in range(n_classes)},
+            'type': model_type,
+        }
+        super(FakeEngine, self).__init__(meta)
+
+    def run_one(self, image):
+        dark = image.mean() < 50
+        if self.is_detector:
+            # one centered detection, confident if dark
+            return numpy.array(
+                [[0, 0.9 if dark else 0.1, 0.25, 0.25, 0.75, 0.75]],
+                dtype='f4')
+        a = numpy.zeros(
+            self.meta['output']['shape'], dtype=self.meta['output']['dtype'])
+        if dark:  # if dark, output 1s
+            a[:] = 1
+        return a
+
+    def run_many(self, images):
+        if self.delay:
+            time.sleep(self.delay)
+        return [self.run_one(im) for im in images]
+
+
+engine_types = {
+    'tfliteserve': TFLiteServeEngine,
+    'local': LocalEngine,
+    'fake': FakeEngine,
+}
+
+default_cfg = {'type': 'tfliteserve'}
+
+
+def build(name, type='tfliteserve', **kwargs):
+    """Build an engine of type, name is used to connect to tfliteserve"""
+    if type not in engine_types:
+        raise ValueError("Unknown engine type: %s" % (type, ))
+    logging.debug("Building %s engine: %s", type, kwargs)
+    if type == 'tfliteserve':
+        kwargs['name'] = name
+    return engine_types[type](**kwargs)
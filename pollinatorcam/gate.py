@@ -0,0 +1,150 @@
+"""
+Cheap checks run before inference
+
+Gates look at a small grayscale copy of the frame (see
+cvcapture.Frame.reduced) and decide, per roi, if inference should run.
+A roi is skipped if any gate returns a reason (a short string) and the
+reason is stored in the analysis meta. Every force_period seconds a
+roi is analyzed regardless so RunningThreshold statistics stay fresh.
+
+Gates (each disabled when it's config is None):
+    luminance: mean brightness outside [min_mean, max_mean]: 'dark'/'bright'
+    blur: variance of the laplacian below min_var: 'blur'
+    motion: fraction of pixels differing from a running background
+        by more than threshold is below min_fraction: 'static'
+"""
+
+import logging
+import time
+
+import cv2
+import numpy
+
+
+class Gate:
+    name = None
+
+    def update(self, gray):
+        # called once per frame before check
+        pass
+
+    def check(self, gray, slices):
+        # return None to run inference, or a reason to skip
+        raise NotImplementedError("Abstract base class")
+
+
+class LuminanceGate(Gate):
+    name = 'luminance'
+
+    def __init__(self, min_mean=50, max_mean=255):
+        self.min_mean = min_mean
+        self.max_mean = max_mean
+
+    def check(self, gray, slices):
+        v = gray[slices].mean()
+        if v < self.min_mean:
+            return 'dark'
+        if v > self.max_mean:
+            return 'bright'
+        return None
+
+
+class BlurGate(Gate):
+    name = 'blur'
+
+    def __init__(self, min_var=10.0):
+        self.min_var = min_var
+
+    def check(self, gray, slices):
+        if cv2.Laplacian(gray[slices], cv2.CV_32F).var() < self.min_var:
+            return 'blur'
+        return None
+
+
+class MotionGate(Gate):
+    name = 'motion'
+
+    def __init__(self, threshold=15, min_fraction=0.002, alpha=0.05):
+        self.threshold = threshold
+        self.min_fraction = min_fraction
+        # background learning rate
+        self.alpha = alpha
+        self.background = None
+        self.mask = None
+
+    def update(self, gray):
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype('f4')
+            # no background yet, everything is 'moving'
+            self.mask = numpy.ones(gray.shape, dtype=bool)
+            return
+        self.mask = (
+            cv2.absdiff(gray.astype('f4'), self.background) > self.threshold)
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+
+    def check(self, gray, slices):
+        if self.mask[slices].mean() < self.min_fraction:
+            return 'static'
+        return None
+
+
+gate_types = {
+    g.name: g for g in (LuminanceGate, BlurGate, MotionGate)}
+
+
+class Gates:
+    """Run all configured gates for a list of rois
+
+    rois are (top, bottom, left, right) in full resolution pixels
+    """
+    def __init__(self, rois, scale=8, force_period=60.0, **kwargs):
+        self.rois = rois
+        self.scale = scale
+        self.force_period = force_period
+        self.gates = []
+        for name in kwargs:
+            if name not in gate_types:
+                raise ValueError("Unknown gate: %s" % (name, ))
+            if kwargs[name] is None:
+                continue
+            logging.debug("Building %s gate: %s", name, kwargs[name])
+            self.gates.append(gate_types[name](**kwargs[name]))
+
+        # last time each roi was analyzed, start by analyzing all
+        self.last_run_times = [None] * len(rois)
+        self.slices = None
+
+    def build_slices(self, shape, small_shape):
+        sy = small_shape[0] / shape[0]
+        sx = small_shape[1] / shape[1]
+        self.slices = [
+            (
+                slice(int(t * sy), max(int(b * sy), int(t * sy) + 1)),
+                slice(int(l * sx), max(int(r * sx), int(l * sx) + 1)))
+            for (t, b, l, r) in self.rois]
+
+    def check(self, frame):
+        """Return a list of skip reasons (None = run inference) per roi"""
+        t = time.monotonic()
+        reasons = [None] * len(self.rois)
+        if len(self.gates):
+            small = frame.reduced(self.scale)
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            if self.slices is None:
+                self.build_slices(frame.shape, gray.shape)
+            for gate in self.gates:
+                gate.update(gray)
+            for (i, slices) in enumerate(self.slices):
+                for gate in self.gates:
+                    reasons[i] = gate.check(gray, slices)
+                    if reasons[i] is not None:
+                        break
+        for (i, reason) in enumerate(reasons):
+            lt = self.last_run_times[i]
+            if reason is not None and self.force_period is not None and (
+                    lt is None or t - lt >= self.force_period):
+                # periodically analyze so statistics stay fresh
+                reasons[i] = None
+            if reasons[i] is None:
+                self.last_run_times[i] = t
+        return reasons
@@ -5,6 +5,10 @@ Grab images from camera
 - every N seconds, analyze frame for potential triggering
 - if triggered, save buffer and continue saving frames
 - if not triggered, stop saving
+
+Importing this module does no I/O, site settings are read (see
+load_settings) when the first Grabber is made. pandas (csv output),
+systemd (watchdog) and gstreamer (gst backend) are imported when used.
 """
 
 import argparse
@@ -13,32 +17,78 @@ import datetime
 import json
 import logging
 import os
+import queue
+import socket
+import threading
 import time
 
-import cv2
 import numpy
-import systemd.daemon
-import pandas
-
-import tfliteserve
 
 from . import cvcapture
+from . import cvrecorder
+from . import broker
+from . import cache
 from . import config
 from . import dahuacam
-#from . import gstcapture
+from . import detection
+from . import engine
+from . import gate
 from . import logger
+from . import timing
+from . import tracker
 from . import trigger
 from . import v4l2ctl
 
 
 # cfg data:
+# - engine: inference engine type and kwargs (see engine.build)
+#  changes require a restart
 # - rois: [(left, top, size),...] if None, auto-compute 1
 #  left/top 0-1 scaled by width/height
 #  size 0-1 scaled by min(width, height)
 # - detector: kwargs used for making detector
 # - recording: kwargs used for making recorder
+#  and AnalysisRate (see analysis_rate_keys)
+# - buffer: kwargs used for making the pre-trigger frame buffer
+#  pre_time 0 disables the buffer
+# - gate: kwargs used for making pre-inference gates (see gate.Gates)
+#  each gate (luminance, blur, motion) is disabled when None
+# - tiles: if not None, cover the frame with overlapping square rois
+#  (replaces rois) see tile_coords
+# - cache: reuse model outputs for rois that look the same as a recently
+#  analyzed roi (see cache.ResultCache), None disables
+# - track: for detectors, follow detections with optical flow and skip
+#  the detector while tracks are confident (see tracker.Tracker),
+#  None disables
+# - nms: detections (in frame pixels) from all rois with the same label
+#  overlapping by more than iou are merged, None disables (except with
+#  tiles, see nms_kwargs)
+# - shed: kwargs used for making LoadShedder (frame deadlines and
+#  shedding work when overloaded), None disables
+# optional features (gate checks, tiles, cache, track, nms, shed) are off
+# unless configured so cameras with older saved configs (missing these
+# keys) behave the same as new ones
 default_cfg = {
+    'engine': {
+        'type': 'tfliteserve',
+        # 'type': 'local', 'model': '~/model.tflite', 'threads': 2,
+        # 'type': 'fake', 'model_type': 'detector',
+    },
     'rois': None,
+    'tiles': None,  # {'size': 0.5, 'overlap': 0.2}
+    'nms': None,  # {'iou': 0.5}
+    'track': None,  # {'detect_every': 10, 'min_confidence': 0.5}
+    # {
+    #     'max_size': 64,  # entries (for all rois)
+    #     'max_distance': 4,  # max differing dhash bits (of 256)
+    #     'max_age': 10.0,  # re-analyze rois at least every N seconds
+    # }
+    'cache': None,
+    # {
+    #     'max_latency': 5.0,  # drop frames older than N seconds
+    #     'hold_time': 10.0,  # seconds of over/under load to change level
+    # }
+    'shed': None,
     'detector': {
         'n_std': 3.0,
         'min_dev': 0.1,
@@ -53,12 +103,30 @@ default_cfg = {
         'min_time': 10.0,
         'max_time': 20.0,
         'periodic_still': 5,  # save every N seconds
+        # analysis rate (Hz) when...
+        'base_rate': 1.0,  # recently active
+        'min_rate': 0.2,  # quiet for more than quiet_time seconds
+        'max_rate': None,  # detecting or recording, None = camera fps
+        'quiet_time': 60.0,
+    },
+    'buffer': {
+        'pre_time': 0.0,  # seconds of frames to keep before a trigger
+        'max_bytes': 256 * 1024 * 1024,  # ~17 uncompressed 2592x1944 frames
+        'period': 0.0,  # minimum seconds between buffered frames (>= 1/video fps)
+        'compress': False,  # store frames as jpegs
+    },
+    'gate': {
+        'scale': 8,  # check on a 1/scale copy of the frame
+        'force_period': 60.0,  # analyze rois at least every N seconds
+        'luminance': None,  # {'min_mean': 50, 'max_mean': 255}
+        'blur': None,  # {'min_var': 10.0}
+        'motion': None,  # {'threshold': 15, 'min_fraction': 0.002}
     },
     'properties': {
-        'fourcc': cv2.VideoWriter_fourcc(*'MJPG'),
+        'fourcc': 'MJPG',
         'fps': 30,
 
-        #'fourcc': cv2.VideoWriter_fourcc(*'YUYV'),
+        #'fourcc': 'YUYV',
         #'fps': 20,  # for 480
         #'fps': 5,  # for 1080, 720
         #'fps': 3,  # for 1944
@@ -80,15 +148,33 @@ default_cfg = {
     },
 }
 
-data_dir = '/mnt/data/'
-
-# Loading in new config file settings
+# site settings file (see load_settings)
 customSetting = '/home/pi/Desktop/configs'
-if os.path.isfile(customSetting):
-    in1 = open(customSetting,'r')
-    settingsL = json.load(in1)
-    in1.close()
-	
+# loaded site settings, None until load_settings is called
+settingsL = None
+
+
+def load_settings(fn=None):
+    """Load site settings (once) and apply them to default_cfg
+
+    If the settings file exists it overrides some default_cfg values and
+    the hostname (appended to /etc/hostname if different). Without a
+    file, settings are csv output off and the current hostname.
+    """
+    global settingsL
+    if settingsL is not None:
+        return settingsL
+    if fn is None:
+        fn = customSetting
+    if not os.path.isfile(fn):
+        logging.info("No site settings found at %s, using defaults", fn)
+        settingsL = {
+            'save_all_detections': 1, 'csv': 0,
+            'hostname': socket.gethostname()}
+        return settingsL
+    with open(fn, 'r') as in1:
+        settingsL = json.load(in1)
+
     # Override default settings with config file
     default_cfg['properties']['autofocus'] = settingsL['autofocus']
     default_cfg['properties']['focus'] = settingsL['focus']
@@ -102,15 +188,253 @@ if os.path.isfile(customSetting):
     if names1[-1].split('\n')[0] != settingsL['hostname']:
         names = open('/etc/hostname','a')
         names.write(settingsL['hostname']+'\n')
-        names.close() 
+        names.close()
+    return settingsL
+
+
+def checked_scale(scale, key):
+    # round down to a level of the frame pyramid (see cvcapture.Frame)
+    level = cvcapture.reduce_level(scale)
+    if level != scale:
+        logging.warning(
+            "Unsupported %s scale %s, using %s", key, scale, level)
+    return level
+
+
+# nms for overlapping tiles when 'nms' isn't configured
+default_tile_nms = {'iou': 0.5}
+
+
+def nms_kwargs(cfg):
+    """nms kwargs for cfg or None to skip nms
+
+    Tiles overlap so always use nms (default_tile_nms if not configured)
+    """
+    kwargs = cfg.get('nms')
+    if kwargs is None and cfg.get('tiles') is not None:
+        return default_tile_nms
+    return kwargs
+
+
+def tile_coords(h, w, size=0.5, overlap=0.2):
+    """Square tiles (top, bottom, left, right) covering a h x w frame
+
+    size is the tile size as a fraction of min(h, w) (0 < size <= 1),
+    neighboring tiles overlap by at least overlap (fraction of size,
+    0 <= overlap < 1)
+    """
+    if h <= 0 or w <= 0:
+        raise ValueError("Invalid frame size for tiles: %s x %s" % (h, w))
+    if not (0 < size <= 1):
+        raise ValueError("Invalid tile size: %s" % (size, ))
+    if not (0 <= overlap < 1):
+        raise ValueError("Invalid tile overlap: %s" % (overlap, ))
+    dim = max(1, int(min(h, w) * size))
+    stride = max(1, dim * (1. - overlap))
+    coords = []
+    ny = int(numpy.ceil((h - dim) / stride)) + 1
+    nx = int(numpy.ceil((w - dim) / stride)) + 1
+    for t in numpy.linspace(0, h - dim, ny).round().astype(int):
+        for l in numpy.linspace(0, w - dim, nx).round().astype(int):
+            coords.append((int(t), int(t) + dim, int(l), int(l) + dim))
+    return coords
+
+
+# recording config items used for AnalysisRate (not the trigger)
+analysis_rate_keys = ('base_rate', 'min_rate', 'max_rate', 'quiet_time')
+
+
+class AnalysisRate:
+    """Analysis period that follows activity
+
+    While active (detector firing or trigger active) analyze at max_rate.
+    After quiet_time seconds of no activity drop to min_rate, in between
+    use base_rate. Rates are in Hz, period is in seconds.
+    """
+    def __init__(
+            self, base_rate=1.0, min_rate=0.2, max_rate=None,
+            quiet_time=60.0):
+        if max_rate is None:
+            max_rate = base_rate
+        if not (0 < min_rate <= base_rate <= max_rate):
+            raise ValueError(
+                "Invalid analysis rates, must be 0 < %s <= %s <= %s" % (
+                    min_rate, base_rate, max_rate))
+        self.base_rate = base_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.quiet_time = quiet_time
+        self.last_active_time = time.monotonic()
+        self.rate = base_rate
+
+    @property
+    def period(self):
+        return 1. / self.rate
+
+    def update(self, active):
+        t = time.monotonic()
+        if active:
+            self.last_active_time = t
+            rate = self.max_rate
+        elif t - self.last_active_time >= self.quiet_time:
+            rate = self.min_rate
+        else:
+            rate = self.base_rate
+        if rate != self.rate:
+            logging.info("Analysis rate changed to %s Hz", rate)
+            self.rate = rate
+        return self.period
+
+
+class LoadShedder:
+    """Drop stale frames and shed work when analysis can't keep up
+
+    A frame is stale (and dropped before inference) when it's older
+    (since capture) than max_latency seconds. Average frame latency
+    (alpha weighted) above overload * max_latency for hold_time seconds
+    raises the shedding level, below underload * max_latency for
+    hold_time lowers it. Levels shed (in addition to lower levels):
+        1: analyze only roi_fraction of rois per frame (rotating)
+        2: analyze at rate_scale * analysis rate
+        3: no thumbnails
+    """
+    levels = (None, 'rois', 'rate', 'thumbnails')
+
+    def __init__(
+            self, max_latency=5.0, hold_time=10.0, overload=0.5,
+            underload=0.2, alpha=0.1, roi_fraction=0.5, rate_scale=0.5):
+        self.max_latency = max_latency
+        self.hold_time = hold_time
+        self.overload = overload
+        self.underload = underload
+        self.alpha = alpha
+        self.roi_fraction = roi_fraction
+        self.rate_scale = rate_scale
+
+        self.level = 0
+        self.latency = None
+        # time load changed state (over or under)
+        self.last_change_time = time.monotonic()
+        self.state = None
+        # first roi to analyze (when shedding rois)
+        self.roi_offset = 0
+
+    def is_stale(self, frame):
+        if frame.timestamp is None:
+            return False
+        return time.time() - frame.timestamp > self.max_latency
+
+    def update(self, latency):
+        """Update load with the latency of a finished frame
+
+        Returns +1/-1 if the level was raised/lowered, otherwise 0
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        if self.latency > self.overload * self.max_latency:
+            state = 'over'
+        elif self.latency < self.underload * self.max_latency:
+            state = 'under'
+        else:
+            state = None
+        t = time.monotonic()
+        if state != self.state:
+            self.state = state
+            self.last_change_time = t
+            return 0
+        if state is None or t - self.last_change_time < self.hold_time:
+            return 0
+        # restart hold time for the next level
+        self.last_change_time = t
+        if state == 'over' and self.level < len(self.levels) - 1:
+            self.level += 1
+            logging.warning(
+                "Overloaded (latency %.2f s), shedding %s",
+                self.latency, self.levels[self.level])
+            return 1
+        if state == 'under' and self.level > 0:
+            logging.info(
+                "Load recovered (latency %.2f s), restoring %s",
+                self.latency, self.levels[self.level])
+            self.level -= 1
+            return -1
+        return 0
+
+    def shed_rois(self, skip):
+        """Mark rois that shouldn't be analyzed this frame as 'shed'"""
+        if self.level < 1:
+            return skip
+        run = [i for (i, r) in enumerate(skip) if r is None]
+        n = max(1, int(numpy.ceil(len(run) * self.roi_fraction)))
+        if n >= len(run):
+            return skip
+        self.roi_offset = (self.roi_offset + n) % len(run)
+        keep = set(
+            run[(self.roi_offset + i) % len(run)] for i in range(n))
+        return [
+            'shed' if (i in run and i not in keep) else r
+            for (i, r) in enumerate(skip)]
+
+    def scale_period(self, period):
+        if self.level < 2:
+            return period
+        return period / self.rate_scale
+
+    @property
+    def thumbnails(self):
+        return self.level < 3
+
+
+# stages run for each analyzed frame (see Grabber.start_pipeline)
+analysis_stages = ('preprocess', 'infer', 'persist')
+
+
+class AnalysisJob:
+    """A frame and it's analysis results as it moves through stages"""
+    def __init__(self, frame, times):
+        self.frame = frame
+        # per-frame stage times (see timing.StageTimes)
+        self.times = times
+        self.t0 = time.perf_counter()
+        self.crop = None
+        self.gates = None
+        self.trigger = None
+        self.cache = None
+        # roi patch hashes (see cache.dhash)
+        self.hashes = None
+        self.tracker = None
+        # small grayscale frame (see tracker.Tracker.prepare)
+        self.gray = None
+        self.shedder = None
+        self.meta = None
+        self.skip = None
+        self.patches = None
+        self.set_trigger = False
+        # too old to analyze (see LoadShedder)
+        self.dropped = False
+        # detection.detection_dtype records
+        self.records = None
+        self.last_meta = None
+        self.save = False
+
 
 class Grabber:
     def __init__(
             self, loc, name=None, retry=False,
             fake_detection=False, in_systemd=False,
-            capture_stills=True):
+            capture_stills=True, passthrough=False,
+            shared_engine=None, frame_event=None, backend='cv',
+            broker_address=None, pipelined=True, queue_size=2):
+        if backend == 'synthetic':
+            # no camera, loc is a video file or 'synthetic'
+            # (see cvcapture.SyntheticCaptureThread)
+            self.cam = loc if os.path.isfile(loc) else None
+            if name is None:
+                name = os.path.splitext(os.path.basename(loc))[0]
         # check if loc is an ip, if so, assume dahua camera
-        if '.' in loc:  # TODO use more robust ip detection
+        elif '.' in loc:  # TODO use more robust ip detection
             self.cam = dahuacam.DahuaCamera(loc)
             self.cam.set_current_time()
             if name is None:
@@ -130,6 +454,19 @@ class Grabber:
             logging.info("locator string[%s] matched usb camera %s at %s", loc, name, self.cam)
         self.loc = loc
 
+        # cv: opencv capture, usb video recorded from captured frames
+        # and rtsp video recorded from a second stream
+        # gst: one gstreamer pipeline shared by analysis and recording
+        # synthetic: generated or looped video frames (for benchmarks)
+        if backend not in ('cv', 'gst', 'synthetic'):
+            raise ValueError("Unknown capture backend: %s" % (backend, ))
+        self.backend = backend
+
+        # only usb cameras deliver mjpeg
+        self.passthrough = passthrough and not hasattr(self.cam, 'rtsp_url')
+        if passthrough and not self.passthrough:
+            logging.warning("mjpeg passthrough not supported for %s", loc)
+
         logging.info("Starting capture thread: %s", self.loc)
         self.retry = retry
         self.fake_detection = fake_detection
@@ -137,35 +474,46 @@ class Grabber:
             logging.info("Faking detection every N seconds")
             self.last_detection = time.monotonic() - 5.0
         self.crop = None
+        self.gates = None
+        # (crop, gates) per frame resolution, see start_job
+        self.crops = {}
 
         if '/' in name:
             self.name = name.split('/')[-1]
         else:
             self.name = name
-        logging.info("Connecting to tfliteserve as %s", self.name)
-        self.client = tfliteserve.Client(self.name)
         #self.periodic_name = 'NaN'
-        self.n_classes = len(self.client.buffers.meta['labels'])
-        # this updates the global mapping between class and index
-        trigger.set_mask_labels(self.client.buffers.meta['labels'])
+        # site settings (hostname, csv output...)
+        self.settings = load_settings()
 
-        self.vdir = os.path.join(data_dir, 'videos', self.name)
+        self.vdir = os.path.join(config.data_dir, 'videos', self.name)
         if not os.path.exists(self.vdir):
             os.makedirs(self.vdir)
 
-        self.sdir = os.path.join(data_dir, 'stills', self.name)
+        self.sdir = os.path.join(config.data_dir, 'stills', self.name)
         if not os.path.exists(self.sdir):
             os.makedirs(self.sdir)
 
-        self.mdir = os.path.join(data_dir, 'detections', self.name)
+        self.mdir = os.path.join(config.data_dir, 'detections', self.name)
         if not os.path.exists(self.mdir):
             os.makedirs(self.mdir)
 
-        self.cdir = os.path.join(data_dir, 'configs', self.name)
+        self.cdir = os.path.join(config.data_dir, 'configs', self.name)
         if not os.path.exists(self.cdir):
             os.makedirs(self.cdir)
 
-        # analyze frames only every N seconds
+        if not os.path.exists(config.thumbnail_dir):
+            os.makedirs(config.thumbnail_dir)
+
+        # per-frame stage timing, saved periodically to log_dir
+        self.timing = timing.StageTimes(self.name, directory=config.log_dir)
+
+        # per-camera cache of model outputs (see build_cache)
+        self.cache = None
+        # frame deadlines and load shedding (see build_shedder)
+        self.shedder = None
+
+        # analyze frames only every N seconds (see AnalysisRate)
         self.analysis_period = 1.0
         self.last_analysis_time = time.monotonic() - self.analysis_period
 
@@ -174,42 +522,99 @@ class Grabber:
 
         self.capture_stills = capture_stills
 
+        # run analysis stages in threads (see start_pipeline)
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.pipeline_error = None
+        self.n_queued = 0
+        self.n_persisted = 0
+        self.last_n_persisted = 0
+
+        # latest frame for analysis, frame_event is set on every
+        # new frame (see hub)
+        self.frames = cvcapture.FrameSubscription(
+            'latest', period=self.analysis_period, event=frame_event)
+        # every frame (at the video rate) for recording
+        if hasattr(self.cam, 'rtsp_url') or self.backend == 'gst':
+            # GSTRecorder records from a gstreamer pipeline
+            self.record_frames = None
+        else:
+            fps = cvrecorder.video_settings['fps']
+            # paused (no frames decoded or queued) until a recorder
+            # starts saving, see CVRecorder.start_saving
+            self.record_frames = cvcapture.FrameSubscription(
+                'all', period=1. / fps, maxsize=fps * 2, paused=True)
+
         self.in_systemd = in_systemd
         if self.in_systemd:
+            import systemd.daemon
             #systemd.daemon.notify(systemd.daemon.Notification.READY)
             systemd.daemon.notify('READY=1')
             self.reset_watchdog()
         logging.info("Process in systemd? %s", self.in_systemd)
 
-        self.cfg = default_cfg
-        self.cfg_mtime = None
+        # copied so changes don't leak into default_cfg (or other grabbers)
+        self.cfg = copy.deepcopy(default_cfg)
+        # config changes are noticed by the watcher, see reload_config
+        self.config_watcher = config.get_watcher()
+        self.config_watcher.watch(self.name)
+        self.cfg_version = None
+        self.frame_buffer = None
         self.reload_config(force=True)
+        self.build_engine(shared_engine, broker_address)
+        self.build_frame_buffer()
+        self.build_analysis_rate()
+        self.build_cache()
+        self.build_shedder()
 
         self.start_capture_thread()
 
         self.build_trigger()
 
     def reload_config(self, force=False):
-        mtime = config.get_modified_time(self.name)
-        if not force and mtime == self.cfg_mtime:
+        # called every frame, the version check is a dict lookup
+        version = self.config_watcher.version(self.name)
+        if not force and version == self.cfg_version:
             # config doesn't exist or was already loaded
             return
+        self.cfg_version = version
         logging.info("Reloading config...")
-        old_cfg = copy.deepcopy(self.cfg)
-        self.cfg = config.load_config(self.name, self.cfg)
-        self.cfg_mtime = mtime
-        if mtime is None:
+        # load_config returns a new dict (or old_cfg if there is no
+        # config) so old_cfg is not modified and doesn't need a copy
+        old_cfg = self.cfg
+        self.cfg = config.load_config(self.name, old_cfg)
+        if self.cfg is old_cfg:
             config.save_config(self.cfg, self.name)
-        if self.cfg == old_cfg:
             return
+        # top level sections that differ
+        changed = {
+            k for k in set(self.cfg) | set(old_cfg)
+            if self.cfg.get(k) != old_cfg.get(k)}
+        if not changed:
+            return
+        logging.debug("Config sections changed: %s", sorted(changed))
+        if changed & {'rois', 'tiles', 'detector', 'gate', 'track'}:
+            # force crops (and gates, tracker) to be regenerated
+            self.crops = {}
+        if hasattr(self, 'engine') and 'engine' in changed:
+            logging.warning("Engine config changed, restart to apply")
+        if 'cache' in changed:
+            self.build_cache()
+        if 'shed' in changed:
+            self.build_shedder()
+        if 'buffer' in changed:
+            if hasattr(self, 'capture_thread'):
+                self.build_frame_buffer()
+                self.build_trigger()
+        elif 'recording' in changed:
+            if hasattr(self, 'capture_thread'):
+                self.build_trigger()
         if (
-                (self.cfg['rois'] != old_cfg['rois']) or
-                (self.cfg['detector'] != old_cfg['detector'])):
-            # force crop to be regenerated
-            self.crop = None
-        if self.cfg['recording'] != old_cfg['recording']:
-            self.build_trigger()
-        if self.cfg.get('properties', {}) != old_cfg.get('properties', {}):
+                ('recording' in changed) or
+                (self.cfg.get('properties', {}).get('fps') !=
+                    old_cfg.get('properties', {}).get('fps'))):
+            self.build_analysis_rate()
+        if 'properties' in changed:
             if hasattr(self, 'capture_thread'):
                 self.capture_thread.set_properties(self.cfg.get('properties', {}))
         # re-save in 'log' directory
@@ -218,50 +623,172 @@ class Grabber:
         with open(fn, 'w') as f:
             json.dump(self.cfg, f)
 
+    def build_engine(self, shared=None, broker_address=None):
+        if shared is None and broker_address is not None:
+            # share the model with other cameras through a broker
+            shared = broker.BrokerClient(self.name, broker_address)
+        if shared is not None:
+            # engine shared between grabbers (see hub) or processes
+            self.engine = shared
+        else:
+            self.engine = engine.build(
+                self.name, **self.cfg.get('engine', default_cfg['engine']))
+        self.n_classes = len(self.engine.buffers.meta['labels'])
+        # this updates the global mapping between class and index
+        trigger.set_mask_labels(self.engine.buffers.meta['labels'])
+
+    def build_cache(self):
+        kwargs = self.cfg.get('cache')
+        if kwargs is None:
+            self.cache = None
+        else:
+            logging.debug("Building result cache: %s", kwargs)
+            self.cache = cache.ResultCache(**kwargs)
+
+    def build_shedder(self):
+        kwargs = self.cfg.get('shed')
+        if kwargs is None:
+            self.shedder = None
+        else:
+            logging.debug("Building load shedder: %s", kwargs)
+            self.shedder = LoadShedder(**kwargs)
+            self.timing.counters['shed_level'] = 0
+
+    def build_frame_buffer(self):
+        kwargs = dict(self.cfg.get('buffer', {}))
+        if (
+                kwargs.get('pre_time', 0) > 0 and
+                (hasattr(self.cam, 'rtsp_url') or self.backend == 'gst')):
+            # GSTRecorder pre-records in it's pipeline queue and never
+            # reads the buffer (see build_trigger)
+            logging.warning(
+                "Frame buffer is not used for gstreamer recording, ignoring")
+            kwargs['pre_time'] = 0
+        if kwargs.get('pre_time', 0) > 0:
+            # buffered frames are written at the video rate
+            kwargs['period'] = max(
+                kwargs.get('period', 0.0),
+                1. / cvrecorder.video_settings['fps'])
+            logging.debug("Building frame buffer: %s", kwargs)
+            self.frame_buffer = cvcapture.FrameBuffer(**kwargs)
+        else:
+            self.frame_buffer = None
+        # the buffer is owned here so it survives capture thread restarts
+        if hasattr(self, 'capture_thread'):
+            self.capture_thread.buffer = self.frame_buffer
+
+    def build_analysis_rate(self):
+        kwargs = {
+            k: self.cfg['recording'].get(k, default_cfg['recording'][k])
+            for k in analysis_rate_keys}
+        if kwargs['max_rate'] is None:
+            kwargs['max_rate'] = self.cfg.get('properties', {}).get(
+                'fps', kwargs['base_rate'])
+        kwargs['max_rate'] = max(kwargs['max_rate'], kwargs['base_rate'])
+        # analyze often enough to save periodic stills on time
+        periodic_still = self.cfg['recording'].get('periodic_still', 0)
+        if periodic_still:
+            kwargs['min_rate'] = min(
+                max(kwargs['min_rate'], 1. / periodic_still),
+                kwargs['base_rate'])
+        logging.debug("Building analysis rate: %s", kwargs)
+        self.analysis_rate = AnalysisRate(**kwargs)
+        self.set_analysis_period(self.analysis_rate.period)
+
+    def set_analysis_period(self, period):
+        self.analysis_period = period
+        self.frames.period = period
+
     def build_trigger(self):
         if hasattr(self, 'trigger'):
             logging.debug("existing trigger found, deleting")
+            # queued and in-flight jobs still use the old trigger
+            self.wait_for_pipeline()
+            self.trigger.stop()
             del self.trigger
         logging.debug("Building trigger")
+        kwargs = {
+            k: v for (k, v) in self.cfg['recording'].items()
+            if k not in analysis_rate_keys}
         # how to handle video recording?
-        if hasattr(self.cam, 'rtsp_url'):
+        if self.backend == 'gst':
+            # record from the capture pipeline
+            if hasattr(self.cam, 'rtsp_url'):
+                url = self.cam.rtsp_url(channel=1, subtype=0)
+            else:
+                url = self.cam
+            self.trigger = trigger.GSTTriggeredRecording(
+                url,
+                self.vdir, self.sdir, self.name,
+                pipeline=self.capture_thread.pipeline,
+                **kwargs)
+        elif hasattr(self.cam, 'rtsp_url'):
             url = self.cam.rtsp_url(channel=1, subtype=0)
             self.trigger = trigger.GSTTriggeredRecording(
                 url,
                 self.vdir, self.sdir, self.name,
-                **self.cfg['recording'])
+                **kwargs)
         else:
             url = self.cam
             self.trigger = trigger.CVTriggeredRecording(
                 url,
                 self.vdir, self.sdir, self.name,
-                **self.cfg['recording'])
+                frame_buffer=self.frame_buffer,
+                frames=self.record_frames,
+                **kwargs)
 
     def start_capture_thread(self):
+        first_index = 0
         if hasattr(self, 'capture_thread'):
             self.capture_thread.stop()
-        self.capture_thread = cvcapture.CVCaptureThread(
-            cam=self.cam, retry=self.retry, properties=self.cfg.get('properties', {}),
-            capture_period=self.analysis_period)
+            # keep frame sequence numbers increasing across restarts
+            first_index = self.capture_thread.frame_count + 1
+        subscriptions = [self.frames]
+        if self.record_frames is not None:
+            subscriptions.append(self.record_frames)
+        if self.backend == 'gst':
+            # gstreamer (gi) is only imported when used
+            from . import gstcapture
+            self.capture_thread = gstcapture.GstCaptureThread(
+                cam=self.cam, retry=self.retry,
+                properties=self.cfg.get('properties', {}),
+                buffer=self.frame_buffer,
+                subscriptions=subscriptions, first_index=first_index)
+        elif self.backend == 'synthetic':
+            self.capture_thread = cvcapture.SyntheticCaptureThread(
+                cam=self.cam, retry=self.retry,
+                properties=self.cfg.get('properties', {}),
+                buffer=self.frame_buffer, passthrough=self.passthrough,
+                subscriptions=subscriptions, first_index=first_index)
+        else:
+            self.capture_thread = cvcapture.CVCaptureThread(
+                cam=self.cam, retry=self.retry, properties=self.cfg.get('properties', {}),
+                buffer=self.frame_buffer, passthrough=self.passthrough,
+                subscriptions=subscriptions, first_index=first_index)
         #self.analyze_every_n = 10
         #self.analyze_every_n = self.cfg.get('properties', {}).get('fps', 10)
         #self.analyze_every_n = 1
-        #self.capture_thread = gstcapture.GstCaptureThread(
-        #    url=self.cam.rtsp_url(channel=1, subtype=1))
-        #self.analyze_every_n = 1
         self.capture_thread.start()
+        if self.backend == 'gst' and hasattr(self, 'trigger'):
+            # the recorder was attached to the old pipeline
+            self.build_trigger()
 
     def __del__(self):
         if hasattr(self, 'capture_thread'):
             self.capture_thread.stop()
 
-    def build_crop(self, example_image):
-        _, th, tw, _ = self.client.buffers.meta['input']['shape']
-        h, w = example_image.shape[:2]
+    def build_crop(self, example_frame):
+        _, th, tw, _ = self.engine.buffers.meta['input']['shape']
+        h, w = example_frame.shape[:2]
         logging.debug(
             "Building crop for image[%s, %s] to [%s, %s]", h, w, th, tw)
         coords = []
-        if self.cfg['rois'] is None:
+        if self.cfg.get('tiles') is not None:
+            # tile the full frame
+            coords = tile_coords(h, w, **self.cfg['tiles'])
+            for coord in coords:
+                logging.debug("Tile: %s, %s, %s, %s", *coord)
+        elif self.cfg['rois'] is None:
             # use 1 central roi
             if h > w:
                 t = (h // 2) - (w // 2)
@@ -295,36 +822,140 @@ class Grabber:
                 assert b > 0 and b <= h
                 coords.append((t, b, l, r))
 
+        # gates check rois before cropping
+        kwargs = dict(self.cfg.get('gate', default_cfg['gate']))
+        # gates and the tracker use a level of the frame pyramid
+        if 'scale' in kwargs:
+            kwargs['scale'] = checked_scale(kwargs['scale'], 'gate')
+        logging.debug("Building gates: %s", kwargs)
+        self.gates = gate.Gates(coords, **kwargs)
+
+        # tracks refer to rois so are rebuilt with them
+        kwargs = self.cfg.get('track')
+        self.tracker = None
+        if kwargs is not None:
+            if self.engine.buffers.meta.get('type', 'classifier') != 'detector':
+                logging.warning("Tracking requires a detector, disabling")
+            else:
+                kwargs = dict(kwargs)
+                if 'scale' in kwargs:
+                    kwargs['scale'] = checked_scale(kwargs['scale'], 'track')
+                logging.debug("Building tracker: %s", kwargs)
+                self.tracker = tracker.Tracker(**kwargs)
+
         # build rois and detectors
         rois = []
         for coord in coords:
             t, b, l, r = coord
+            # coarsest pyramid level (see cvcapture.Frame.reduced) that
+            # still covers this roi at the model input resolution
+            dim = min(b - t, r - l)
+            reduce = 1
+            for s in (8, 4, 2):
+                if dim // s >= max(th, tw):
+                    reduce = s
+                    break
+            logging.debug("ROI %s decode scale: 1/%s", coord, reduce)
             rois.append((
                 coord,
                 (slice(t, b), slice(l, r)),
+                reduce,
+                (
+                    slice(t // reduce, b // reduce),
+                    slice(l // reduce, r // reduce)),
                 trigger.RunningThreshold(self.n_classes, **self.cfg['detector']),
             ))
 
-        def cf(image):
-            for roi in rois:
-                coords, slices, detector = roi
-                yield (
-                    coords,
-                    cv2.resize(image[slices], (th, tw), interpolation=cv2.INTER_AREA),
-                    detector)
-        
+        def cf(frame, skip=None):
+            # each roi is cropped from it's level of the frame pyramid
+            # (shared by all rois), so overlapping rois are only
+            # downscaled once
+            # rois with a skip reason yield None for the patch
+            for (i, roi) in enumerate(rois):
+                coords, slices, reduce, reduced_slices, detector = roi
+                if skip is not None and skip[i] is not None:
+                    cim = None
+                else:
+                    cim = frame.patch(reduced_slices, (th, tw), reduce)
+                yield (coords, cim, detector)
+
         return cf
 
-    def analyze_frame(self, im,periName):
-        dt = datetime.datetime.now()
+    def run_inference(self, patches):
+        """Run the model on a list of patches, returns a list of outputs
+
+        Engines batch patches when the model allows so several rois
+        cost one request (see engine).
+        """
+        if not len(patches):
+            return []
+        return self.engine.run_many(patches)
+
+    def frame_datetime(self, frame):
+        # time used for meta and output filenames
+        return datetime.datetime.now()
+
+    def preprocess_frame(self, job):
+        """Gate and crop rois (preprocess stage)"""
+        frame = job.frame
+        dt = self.frame_datetime(frame)
         ts = dt.strftime('%y%m%d_%H%M%S_%f')
-        meta = {
+        job.meta = {
             'datetime': dt,
             'timestamp': ts,
         }
+        if job.shedder is not None and job.shedder.is_stale(frame):
+            self.drop_job(job, 'preprocess')
+            return
+        if self.fake_detection:
+            return
+        # gate and crop time exclude (lazy) jpeg decoding
+        t0 = time.perf_counter()
+        decode_time = frame.decode_time
+        job.skip = job.gates.check(frame)
+        if job.shedder is not None:
+            job.skip = job.shedder.shed_rois(job.skip)
+        t1 = time.perf_counter()
+        gate_decode_time = frame.decode_time
+        self.timing.accumulate(
+            'gate', t1 - t0 - (gate_decode_time - decode_time), job.times)
+        job.patches = list(job.crop(frame, job.skip))
+        self.timing.accumulate(
+            'crop', time.perf_counter() - t1 -
+            (frame.decode_time - gate_decode_time), job.times)
+        if job.tracker is not None:
+            with self.timing.time('track', job.times):
+                job.gray = job.tracker.prepare(frame)
+        if job.cache is not None:
+            with self.timing.time('cache', job.times):
+                job.hashes = [
+                    None if p[1] is None else job.cache.hash(p[1])
+                    for p in job.patches]
+
+    def infer_frame(self, job):
+        """Run inference, detectors and the trigger (infer stage)"""
+        if job.dropped:
+            return
+        if job.shedder is not None and job.shedder.is_stale(job.frame):
+            # don't spend inference time on a frame that's already late
+            self.drop_job(job, 'infer')
+            return
+        meta = job.meta
+
+        # triggered cameras go first (with a priority broker)
+        if hasattr(self.engine, 'priority'):
+            self.engine.priority = int(bool(job.trigger.active))
+
+        t = time.monotonic()
+        logging.debug("Analysis delay: %.4f", (t - self.last_analysis_time))
+        self.last_analysis_time = t
 
         #print("Analyze: %s" % ts)
         set_trigger = False
+        # detection.detection_dtype records for all rois
+        records = []
+        # (roi index, detected labels) for rois with detections
+        detected_rois = []
         if self.fake_detection:
             #print(im.mean())
             #t = im.mean() < 100
@@ -339,180 +970,331 @@ class Grabber:
             meta['bboxes'] = []
             meta['indices'] = []
             meta['rois'] = []
-            for patch in self.crop(im):
+            meta['skipped'] = []
+            meta['cached'] = []
+            patches = job.patches
+            is_detector = (
+                self.engine.buffers.meta.get('type', 'classifier') == 'detector')
+
+            # follow previous detections instead of running the detector
+            tracking = (
+                job.tracker is not None and
+                not job.tracker.needs_detection())
+            meta['tracking'] = tracking
+            if tracking:
+                with self.timing.time('track', job.times):
+                    track_records = job.tracker.track(
+                        job.gray, job.frame.shape)
+                self.timing.count('tracked_frames')
+
+            # reuse outputs for rois that haven't changed
+            cached = [None] * len(patches)
+            if job.cache is not None and not tracking:
+                with self.timing.time('cache', job.times):
+                    for (i, (patch, h)) in enumerate(zip(patches, job.hashes)):
+                        if h is not None:
+                            cached[i] = job.cache.get(
+                                (i, tuple(patch[0])), h)
+                self.timing.counters['cache_hits'] = job.cache.n_hits
+                self.timing.counters['cache_misses'] = job.cache.n_misses
+                self.timing.counters['cache_hit_rate'] = job.cache.hit_rate
+
+            # run classification on all (not skipped or cached) cropped images
+            run = [
+                i for (i, p) in enumerate(patches)
+                if p[1] is not None and cached[i] is None and not tracking]
+            with self.timing.time('inference', job.times):
+                outputs = self.run_inference([patches[i][1] for i in run])
+            for (i, o) in zip(run, outputs):
+                cached[i] = o
+                if job.cache is not None:
+                    job.cache.put((i, tuple(patches[i][0])), job.hashes[i], o)
+
+            for (roi_index, (patch, reason)) in enumerate(zip(patches, job.skip)):
                 coords, cim, detector = patch
+                meta['skipped'].append(reason)
+                meta['cached'].append(
+                    reason is None and roi_index not in run and not tracking)
+                if reason is not None and not tracking:
+                    # no inference, no detections
+                    self.timing.count('gate_%s' % reason)
+                    meta['detections'].append([])
+                    meta['indices'].append([])
+                    meta['rois'].append(coords)
+                    continue
 
-                # run classification on cropped image
-                ## Log inference time to a text file on desktop
-                #l1 = time.monotonic()
-                o = self.client.run(cim)
-                #import pickle
-                #in2 = open('/home/pi/Desktop/test','wb')
-                #pickle.dump(o,in2)
-                #in2.close()
-                #l2 = time.monotonic()
-                #d_ = l2-l1
-                #timeLogger = '~/Desktop/inferenceCam.txt'
-                #if os.path.isfile(timeLogger) == False:
-                #    tzFile = open(timeLogger,'w')
-                #else:
-                #    tzFile = open(timeLogger,'a')
-                #dt45 = datetime.datetime.now()
-                #tmp45 = '%s'%(dt45.strftime('%H%M%S_%f'))
-                #tzFile.write(str(d_)+' '+str(self.name)+' '+tmp45+' \n'
-                #tzFile.close()
-                bboxes = {}
-                if self.client.buffers.meta.get('type', 'classifier') == 'detector':
+                o = cached[roi_index]
+                dt0 = time.perf_counter()
+                roi_records = detection.empty()
+                if tracking:
+                    # synthesized scores from tracks started in this roi
+                    roi_records = track_records[
+                        track_records['roi'] == roi_index]
+                    o = detection.scores(roi_records, self.n_classes)
+                    records.append(roi_records)
+                elif is_detector:
                     # output is from a detection network
                     # remap scores to output similar to classifier output
                     # so something like a 1 x n_classes vector
-                    detector_output = o
-                    o = numpy.zeros((1, self.n_classes))
-                    for r in detector_output:
-                        label_id = int(r[0])
-                        score = r[1]
-                        if label_id >= self.n_classes:
-                            # Conditional for new FPN models 1-class behavior
-                            if self.n_classes != 2:
-                                print(
-                                    "Invliad label_id[%s] > number of classes[%s]" %
-                                    (label_id, self.n_classes))
-                                continue
-                            else:
-                                label_id = 0
-                        o[0, label_id] = max(o[0, label_id], score)
-                        if label_id not in bboxes:
-                            bboxes[label_id] = []
-                        bboxes[label_id].append((label_id, score, r[2:]))
+                    o, roi_records = detection.from_output(
+                        o, self.n_classes, roi_index, coords)
+                    records.append(roi_records)
                 #o[0, 100] = 1.0
 
                 # run detector on classification results
                 t, info = detector(o)
+                self.timing.accumulate(
+                    'detector', time.perf_counter() - dt0, job.times)
                 if t:
                     # classifier found something, set the trigger
                     set_trigger = True
 
                 detections = []
                 if len(info['indices']):
-                    lbls = self.client.buffers.meta['labels']
+                    lbls = self.engine.buffers.meta['labels']
                     sorted_indices = sorted(
                         info['indices'], key=lambda i: o[0, i], reverse=True)
                     detections = [
                         (str(lbls[i]), o[0, i]) for i in
                         sorted_indices]
-                    meta['bboxes'].append([bboxes.get(i, []) for i in sorted_indices])
+                    # filled after nms (below)
+                    detected_rois.append((roi_index, sorted_indices))
                 meta['detections'].append(detections)
                 meta['indices'].append(info['indices'])
                 meta['rois'].append(coords)
 
         #in2 = open('/home/pi/Desktop/test2','wb')
-        #pickle.dump([o,detector_output,info,bboxes,meta],in2)
+        #pickle.dump([o,detector_output,info,records,meta],in2)
         #in2.close()
         meta['still_filename'] = ''
         if set_trigger:
             logging.debug("Triggered!")
             #print(meta['detections'][0][:5])
             if self.capture_stills:
-                fn = self.trigger.save_image(im)
-                meta['still_filename'] = fn
+                # the still is written in the persist stage
+                meta['still_filename'] = job.trigger.still_filename(meta)
         meta['config'] = self.cfg
 
-        r = self.trigger(set_trigger, meta)
+        r = job.trigger(set_trigger, meta)
+        # meta and last_meta as of this frame (for save_meta)
+        job.last_meta = job.trigger.last_meta
 
-        if settingsL['save_all_detections'] == 1:
+        if self.settings['save_all_detections'] == 1:
             tempTrigger_1 = True
-        elif settingsL['save_all_detections'] == 0:
+        elif self.settings['save_all_detections'] == 0:
             tempTrigger_1 = False
-        
-        if set_trigger or r or tempTrigger_1:
-            # save trigger meta and last_meta
-            dt = self.trigger.meta['datetime']
-            d = os.path.join(self.mdir, dt.strftime('%y%m%d'))
-            if not os.path.exists(d):
-                os.makedirs(d)
-            if settingsL['csv'] == 0:
-                mfn = os.path.join(
-                    d,
-                    '%s-%s-%s-%s.json' % (settingsL['hostname'],dt.strftime('%y%m%d'),dt.strftime('%H%M%S_%f'), self.name))
-                with open(mfn, 'w') as f:
-                    json.dump(
-                        {
-                            'meta': self.trigger.meta,
-                            'last_meta': self.trigger.last_meta},
-                        f, indent=True, cls=logger.MetaJSONEncoder)
-            else:
-                #import pickle
-                #in2 = open('/home/pi/Desktop/test','wb')
-                #pickle.dump(detector_output,in2)
-                #in2.close()
-                x_1 = {}
-                x_1['hostname'] = [settingsL['hostname']]
-                x_1['timestamp'] = [meta['timestamp']]
-                x_1['camera_ID'] = [self.name]#[meta['still_filename'].split('-')[-1].split('.')[0]]
-                if set_trigger == False:
+
+        job.set_trigger = set_trigger
+        if len(records):
+            records = numpy.concatenate(records)
+        else:
+            records = detection.empty()
+        nms = nms_kwargs(self.cfg)
+        if nms is not None:
+            # merge overlapping detections across rois (and tiles)
+            dt0 = time.perf_counter()
+            records = detection.nms(records, **nms)
+            self.timing.accumulate(
+                'detector', time.perf_counter() - dt0, job.times)
+        if job.tracker is not None and 'tracking' in meta:
+            if not meta['tracking']:
+                # new detections (re)start tracks
+                with self.timing.time('track', job.times):
+                    records = job.tracker.update(
+                        job.gray, job.frame.shape, records)
+            meta['tracks'] = [t.id for t in job.tracker.tracks]
+        for (roi_index, sorted_indices) in detected_rois:
+            meta['bboxes'].append(detection.select(
+                records[records['roi'] == roi_index], sorted_indices))
+        job.records = records
+        job.save = bool(set_trigger or r or tempTrigger_1)
+
+        # speed up or slow down analysis based on activity
+        period = self.analysis_rate.update(
+            set_trigger or bool(job.trigger.active))
+        if job.shedder is not None:
+            period = job.shedder.scale_period(period)
+        self.set_analysis_period(period)
+
+    def drop_job(self, job, stage):
+        logging.debug(
+            "Dropping stale frame %s in %s stage", job.frame.index, stage)
+        job.dropped = True
+        self.timing.count('stale_frames')
+
+    def persist_frame(self, job):
+        """Write stills, thumbnails and meta (persist stage)"""
+        frame = job.frame
+        # allow trigger to buffer images
+        with self.timing.time('still', job.times):
+            periName = job.trigger.new_image(frame)
+
+        # TODO downsample and save image for ui to use
+        if job.shedder is None or job.shedder.thumbnails:
+            with self.timing.time('thumbnail', job.times):
+                self.generate_thumbnail(frame)
+
+        if job.meta.get('still_filename'):
+            with self.timing.time('still', job.times):
+                job.trigger.save_image(frame, job.meta['still_filename'])
+
+        if job.save:
+            with self.timing.time('meta', job.times):
+                self.save_meta(
+                    job.meta, job.last_meta, job.records, job.set_trigger,
+                    periName)
+
+        if frame.decode_time:
+            self.timing.accumulate('decode', frame.decode_time, job.times)
+        self.timing.accumulate(
+            'total', time.perf_counter() - job.t0, job.times)
+        if job.shedder is not None and frame.timestamp is not None:
+            change = job.shedder.update(time.time() - frame.timestamp)
+            if change:
+                self.timing.count('shed_up' if change > 0 else 'shed_down')
+            self.timing.counters['shed_level'] = job.shedder.level
+        self.timing.end_frame(job.times)
+        self.timing.maybe_save()
+
+    def meta_filename(self, d, meta):
+        dt = meta['datetime']
+        return os.path.join(
+            d,
+            '%s-%s-%s-%s.json' % (self.settings['hostname'],dt.strftime('%y%m%d'),dt.strftime('%H%M%S_%f'), self.name))
+
+    def save_meta(self, meta, last_meta, records, set_trigger, periName):
+        # save trigger meta and last_meta
+        dt = meta['datetime']
+        d = os.path.join(self.mdir, dt.strftime('%y%m%d'))
+        if not os.path.exists(d):
+            os.makedirs(d)
+        if self.settings['csv'] == 0:
+            mfn = self.meta_filename(d, meta)
+            with open(mfn, 'w') as f:
+                json.dump(
+                    {
+                        'meta': meta,
+                        'last_meta': last_meta},
+                    f, indent=True, cls=logger.MetaJSONEncoder)
+        else:
+            #import pickle
+            #in2 = open('/home/pi/Desktop/test','wb')
+            #pickle.dump(detector_output,in2)
+            #in2.close()
+            x_1 = {}
+            x_1['hostname'] = [self.settings['hostname']]
+            x_1['timestamp'] = [meta['timestamp']]
+            x_1['camera_ID'] = [self.name]#[meta['still_filename'].split('-')[-1].split('.')[0]]
+            if set_trigger == False:
  
-                    x_1['still_filename'] = periName#[self.periodic_name]#[numpy.nan]
-                    x_1['detection'] = False
-                else:
-                    x_1['still_filename'] = [meta['still_filename']]
-                    x_1['detection'] = True
-                for detX1 in range(0,3):
-                    tempDet = 'class_%s'%detX1
-                    #x_1[tempDet] = [meta['bboxes'][0][0][detX1][0]]
-                    x_1[tempDet] = [bboxes[0][detX1][0]]
-                    tempDet = 'detect_%s'%detX1
-                    #x_1[tempDet] = [meta['bboxes'][0][0][detX1][1]]
-                    x_1[tempDet] = [bboxes[0][detX1][1]]
-                    tempDet = 'bbox_%s'%detX1
-                    #x_1[tempDet] = [meta['bboxes'][0][0][detX1][2]*numpy.array([1944,2592,1944,2592])]
-                    x_1[tempDet] = [bboxes[0][detX1][2]*numpy.array([1944,2592,1944,2592])]
-                df = pandas.DataFrame.from_dict(x_1)
-                tempMn = '%02d'%((int(dt.strftime('%M'))//5)*5)
-                mfn = os.path.join(
-                    d,
-                    '%s-%s-%s_%s-%s.csv' % (settingsL['hostname'],dt.strftime('%y%m%d'),dt.strftime('%H'),tempMn,self.name))
-                if os.path.isfile(mfn) == False:
-                    df.to_csv(mfn,index=False)
-                else:
-                    df.to_csv(mfn, mode='a', index=False, header=False)	
-		    
+                x_1['still_filename'] = periName#[self.periodic_name]#[numpy.nan]
+                x_1['detection'] = False
+            else:
+                x_1['still_filename'] = [meta['still_filename']]
+                x_1['detection'] = True
+            # top 3 label 0 detections (all rois), bboxes in frame pixels
+            top = detection.select(records, [0])[:3]
+            bbs = detection.bboxes(top)
+            for detX1 in range(0,3):
+                if detX1 >= len(top):
+                    # fewer than 3 detections
+                    x_1['class_%s'%detX1] = [numpy.nan]
+                    x_1['detect_%s'%detX1] = [numpy.nan]
+                    x_1['bbox_%s'%detX1] = [numpy.nan]
+                    continue
+                tempDet = 'class_%s'%detX1
+                #x_1[tempDet] = [meta['bboxes'][0][0][detX1][0]]
+                x_1[tempDet] = [top['label'][detX1]]
+                tempDet = 'detect_%s'%detX1
+                #x_1[tempDet] = [meta['bboxes'][0][0][detX1][1]]
+                x_1[tempDet] = [top['score'][detX1]]
+                tempDet = 'bbox_%s'%detX1
+                #x_1[tempDet] = [meta['bboxes'][0][0][detX1][2]*numpy.array([1944,2592,1944,2592])]
+                x_1[tempDet] = [bbs[detX1]]
+            import pandas
+            df = pandas.DataFrame.from_dict(x_1)
+            tempMn = '%02d'%((int(dt.strftime('%M'))//5)*5)
+            mfn = os.path.join(
+                d,
+                '%s-%s-%s_%s-%s.csv' % (self.settings['hostname'],dt.strftime('%y%m%d'),dt.strftime('%H'),tempMn,self.name))
+            if os.path.isfile(mfn) == False:
+                df.to_csv(mfn,index=False)
+            else:
+                df.to_csv(mfn, mode='a', index=False, header=False)
+
     def reset_watchdog(self):
         if not self.in_systemd:
             return
+        import systemd.daemon
         #systemd.daemon.notify(systemd.daemon.Notification.WATCHDOG)
         systemd.daemon.notify('WATCHDOG=1')
         logging.debug("Reset watchdog")
 
-    def generate_thumbnail(self, im):
+    def generate_thumbnail(self, frame):
         # save to config.thumbnail_dir
         fn = os.path.join(config.thumbnail_dir, self.name) + '.jpg'
         # only generate a thumbnail if there is none found
         if not os.path.exists(fn):
             # TODO configure downsampling
             logging.debug("Saving thumbnail to %s", fn)
-            #cv2.imwrite(fn, im[::8, ::8, ::-1])
-            cv2.imwrite(fn, im[::1, ::1, ::-1])
+            frame.write(fn)
         else:
             logging.debug("Thumbnail exists, not saving to %s", fn)
 
+    def check_capture_thread(self, error=None):
+        # called when no frame arrived in time
+        if not self.capture_thread.is_alive():
+            logging.info("Restarting capture thread: %s", error)
+            self.start_capture_thread()
+            # TODO restart record also?
+        else:
+            logging.debug("Frame grab timed out, waiting...[%s]" % error)
+
     def update(self):
+        if self.pipelined:
+            if self.pipeline_error is not None:
+                raise self.pipeline_error
+            # reset watchdog when frames make it through all stages
+            if self.n_persisted != self.last_n_persisted:
+                self.last_n_persisted = self.n_persisted
+                self.reset_watchdog()
+        times = self.timing.start_frame()
         try:
             # wait analysis period * 1.5
-            r, im, ts = self.capture_thread.next_image(timeout=self.analysis_period * 1.5)
+            with self.timing.time('capture_wait', times):
+                frame = self.frames.get(timeout=self.analysis_period * 1.5)
         except RuntimeError as e:
             # next image timed out
-            if not self.capture_thread.is_alive():
-                logging.info("Restarting capture thread: %s", e)
-                self.start_capture_thread()
-                # TODO restart record also?
-            else:
-                logging.info("Frame grab timed out, waiting...[%s]" % e)
+            self.check_capture_thread(e)
             return
-        if not r or im is None:  # error
-            #raise Exception("Snapshot error: %s" % im)
-            logging.warning("Image error: %s", im)
+        except cvcapture.CaptureError as e:
+            #raise Exception("Snapshot error: %s" % e)
+            logging.warning("Image error: %s", e)
+            self.timing.count('capture_errors')
+            return False
+        if self.pipelined:
+            self.queue_job(self.start_job(frame, times))
+            return True
+        if not self.process_image(frame, times):
             return False
-        
+
+        # reset watchdog
+        self.reset_watchdog()
+
+    def start_job(self, frame, times=None):
+        """Check config, trigger and crop then make a job for frame"""
+        if times is None:
+            times = self.timing.start_frame()
+        job = AnalysisJob(frame, times)
+        if frame.timestamp is not None:
+            self.timing.accumulate(
+                'latency', time.time() - frame.timestamp, times)
+        # frame delivery health
+        self.timing.counters['dropped_frames'] = self.frames.dropped
+        if self.record_frames is not None:
+            self.timing.counters['dropped_record_frames'] = \
+                self.record_frames.dropped
+
         self.reload_config()
 
         # have new image
@@ -522,38 +1304,95 @@ class Grabber:
             logging.info("Building trigger, recorder thread was stopped")
             self.build_trigger()
 
-        # allow trigger to buffer images
-        periodicName = self.trigger.new_image(im)
-
-        # TODO downsample and save image for ui to use
-        self.generate_thumbnail(im)
-
         self.frame_count += 1
         #print("Acquired:", self.frame_count)
 
-        # if first frame
-        if self.crop is None:
-            self.crop = self.build_crop(im)
+        # crop offsets (and gates) are computed once per resolution
+        shape = tuple(frame.shape[:2])
+        if shape not in self.crops:
+            self.crops[shape] = (
+                self.build_crop(frame), self.gates, self.tracker)
+        self.crop, self.gates, self.tracker = self.crops[shape]
 
-        # analyze frame
-        t = time.monotonic()
-        self.analyze_frame(im,periodicName)
-        logging.debug("Analysis delay: %.4f", (t - self.last_analysis_time))
-        self.last_analysis_time = t
+        # later stages use these even if they are rebuilt
+        job.crop = self.crop
+        job.gates = self.gates
+        job.trigger = self.trigger
+        job.cache = self.cache
+        job.tracker = self.tracker
+        job.shedder = self.shedder
+        return job
 
-        #if self.frame_count % self.analyze_every_n == 0:
-        #    # TODO need to catch errors, etc
-        #    t = time.monotonic()
-        #    if hasattr(self, 'last_analysis_time'):
-        #        dt = t - self.last_analysis_time
-        #        print("Analysis delay: %.4f" % dt)
-        #    self.last_analysis_time = t
-        #    self.analyze_frame(im)
+    def process_image(self, frame, times=None):
+        # run all stages for frame on this thread
+        job = self.start_job(frame, times)
+        for stage in analysis_stages:
+            getattr(self, stage + '_frame')(job)
+        return True
 
-        # reset watchdog
-        self.reset_watchdog()
+    def start_pipeline(self):
+        """Run each analysis stage in it's own thread
+
+        Stages are connected by bounded queues so preprocessing of the next
+        frame and persisting of the last overlap with inference. Each stage
+        has one thread so frames stay in order.
+        """
+        self.stage_queues = {
+            stage: queue.Queue(maxsize=self.queue_size)
+            for stage in analysis_stages}
+        for (i, stage) in enumerate(analysis_stages):
+            if i + 1 < len(analysis_stages):
+                next_stage = analysis_stages[i + 1]
+            else:
+                next_stage = None
+            threading.Thread(
+                target=self.run_stage, args=(stage, next_stage),
+                name='%s_%s' % (self.name, stage), daemon=True).start()
+
+    def run_stage(self, stage, next_stage):
+        func = getattr(self, stage + '_frame')
+        q = self.stage_queues[stage]
+        while True:
+            job = q.get()
+            try:
+                func(job)
+            except Exception as e:
+                # re-raised by update
+                logging.exception("Error in %s stage", stage)
+                self.pipeline_error = e
+                return
+            if next_stage is None:
+                self.n_persisted += 1
+            else:
+                self.stage_queues[next_stage].put(job)
+
+    def queue_job(self, job):
+        # block (dropping frames in the capture thread) if stages are behind
+        while True:
+            try:
+                self.stage_queues[analysis_stages[0]].put(job, timeout=1.0)
+                self.n_queued += 1
+                return
+            except queue.Full:
+                if self.pipeline_error is not None:
+                    raise self.pipeline_error
+
+    def wait_for_pipeline(self, timeout=10.0):
+        """Wait for all queued jobs to finish all stages"""
+        t0 = time.monotonic()
+        while (
+                self.n_persisted < self.n_queued and
+                self.pipeline_error is None):
+            if time.monotonic() - t0 > timeout:
+                logging.warning(
+                    "Timed out waiting for %i queued jobs",
+                    self.n_queued - self.n_persisted)
+                return
+            time.sleep(0.01)
 
     def run(self):
+        if self.pipelined:
+            self.start_pipeline()
         while True:
             try:
                 self.update()
@@ -563,6 +1402,15 @@ class Grabber:
 
 def cmdline_run():
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b', '--backend', default='cv',
+        choices=('cv', 'gst', 'synthetic'),
+        help=(
+            'capture backend, gst uses one pipeline for analysis '
+            'and recording, synthetic generates frames (for testing)'))
+    parser.add_argument(
+        '-B', '--broker', default=None, nargs='?', const=broker.default_address,
+        help='run inference through a broker (optional socket address)')
     parser.add_argument(
         '-c', '--capture_stills', default=False, action='store_true',
         help='save single images when triggered')
@@ -572,6 +1420,9 @@ def cmdline_run():
     parser.add_argument(
         '-f', '--fake', default=False, action='store_true',
         help='fake client detection')
+    parser.add_argument(
+        '-j', '--mjpeg', default=False, action='store_true',
+        help='pass through undecoded mjpeg frames (usb only)')
     parser.add_argument(
         '-l', '--loc', type=str, required=True,
         help='camera locator (ip address or /dev/videoX)')
@@ -587,6 +1438,9 @@ def cmdline_run():
     parser.add_argument(
         '-r', '--retry', default=False, action='store_true',
         help='retry on acquisition errors')
+    parser.add_argument(
+        '-S', '--serial', default=False, action='store_true',
+        help='run analysis stages serially (not in threads)')
     parser.add_argument(
         '-t', '--thumbnails', default=False, action='store_true',
         help='save downsampled images as thumbnails')
@@ -613,7 +1467,11 @@ def cmdline_run():
         args.loc, args.name, args.retry,
         fake_detection=args.fake,
         capture_stills=args.capture_stills,
-        in_systemd=args.in_systemd)
+        in_systemd=args.in_systemd,
+        passthrough=args.mjpeg,
+        backend=args.backend,
+        broker_address=args.broker,
+        pipelined=not args.serial)
     try:
         g.run()
     except KeyboardInterrupt:
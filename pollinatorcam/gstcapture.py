@@ -0,0 +1,201 @@
+"""
+Capture frames through a single gstreamer pipeline per camera
+
+The camera source is tee'd into:
+    - an appsink (appsink0) that delivers analysis frames
+    - the recording delay queue (queue0 ! fakesink0) used by
+      gstrecorder.GSTRecorder (pass pipeline=capture.pipeline)
+so there is one network session (or device open) and one decode.
+
+For rtsp (dahua) cameras the main stream is decoded to BGR.
+For usb cameras mjpeg is requested and frames are delivered as jpeg
+bytes (decoded on demand, see cvcapture.Frame).
+"""
+
+import logging
+import time
+
+import numpy
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+
+from . import cvcapture
+
+
+record_queue_string = (
+    'tee0. ! '
+    'queue name=queue0 max-size-bytes=0 max-size-buffers=0 leaky=2 silent=true max-size-time=7000000000 min-threshold-time=5000000000 ! '  # this is the 'delay'
+    'fakesink name=fakesink0 sync=false '
+)
+
+analysis_sink_string = (
+    'appsink name=appsink0 emit-signals=true max-buffers=1 drop=true sync=false '
+)
+
+rtsp_cmd_string = (
+    'rtspsrc name=src0 location="{url}" ! '
+    'capsfilter name=caps0 caps=application/x-rtp,media=video ! '
+    'tee name=tee0 ' +
+    record_queue_string +
+    'tee0. ! queue ! '
+    'rtph265depay ! h265parse ! avdec_h265 ! '
+    # only drop decoded frames (dropping packets corrupts the stream)
+    'queue max-size-buffers=2 leaky=2 ! '
+    'videoconvert ! video/x-raw,format=BGR ! ' +
+    analysis_sink_string
+)
+
+usb_cmd_string = (
+    'v4l2src device="{url}" {controls} ! '
+    'image/jpeg{caps} ! '
+    'tee name=tee0 ' +
+    record_queue_string +
+    'tee0. ! '
+    'queue max-size-buffers=2 leaky=2 ! ' +
+    analysis_sink_string
+)
+
+# capture properties (see cvcapture) to v4l2 controls
+v4l2_controls = {
+    'autofocus': 'focus_auto',
+    'focus': 'focus_absolute',
+}
+
+
+def usb_caps_string(properties):
+    caps = ''
+    if 'frame_width' in properties:
+        caps += ',width=%i' % properties['frame_width']
+    if 'frame_height' in properties:
+        caps += ',height=%i' % properties['frame_height']
+    if 'fps' in properties:
+        caps += ',framerate=%i/1' % properties['fps']
+    return caps
+
+
+def usb_controls_string(properties):
+    controls = [
+        '%s=%i' % (v4l2_controls[k], properties[k])
+        for k in v4l2_controls if k in properties]
+    if not len(controls):
+        return ''
+    # when autofocus is on, don't set focus
+    if properties.get('autofocus', 0) == 1:
+        controls = [c for c in controls if not c.startswith('focus_absolute')]
+    return 'extra-controls="c,%s"' % (','.join(controls), )
+
+
+class GstCaptureThread(cvcapture.CaptureThread):
+    _inited = False
+
+    def __init__(self, *args, **kwargs):
+        self.properties = kwargs.pop('properties', {})
+
+        super(GstCaptureThread, self).__init__(*args, **kwargs)
+
+        if not self._inited or not Gst.is_initialized():
+            Gst.init([])
+            self._inited = True
+
+        if hasattr(self.cam, 'rtsp_url'):
+            # main stream, shared with the recorder
+            self.url = self.cam.rtsp_url(channel=1, subtype=0)
+        else:
+            self.url = self.cam
+        self.loop = None
+        self._build_pipeline()
+
+    def _build_pipeline(self):
+        if 'rtsp' in self.url:
+            cmd = rtsp_cmd_string.format(url=self.url)
+        else:
+            cmd = usb_cmd_string.format(
+                url=self.url,
+                controls=usb_controls_string(self.properties),
+                caps=usb_caps_string(self.properties))
+        logging.debug("Building capture pipeline: %s", cmd)
+        self.pipeline = Gst.parse_launch(cmd)
+
+        self.appsink = self.pipeline.get_child_by_name('appsink0')
+        self.appsink.connect('new-sample', self.on_new_sample)
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self._on_message_cb = self.bus.connect('message', self.on_message)
+
+    def _teardown_pipeline(self):
+        self.bus.disconnect(self._on_message_cb)
+        self.bus.remove_signal_watch()
+
+    def set_properties(self, properties):
+        # v4l2src controls and caps are only applied when the
+        # pipeline starts so restart the capture thread to apply these
+        logging.warning(
+            "gstreamer capture properties are set at start, "
+            "restart capture to apply: %s", properties)
+        self.properties = properties
+
+    def on_new_sample(self, sink):
+        sample = sink.emit('pull-sample')
+        t = time.monotonic()
+        subscriptions, buffer = self.wanted(t)
+        if not (subscriptions or buffer):
+            # throw out frame
+            self.frame_count += 1
+            return Gst.FlowReturn.OK
+        ts = time.time()
+        buf = sample.get_buffer()
+        r, info = buf.map(Gst.MapFlags.READ)
+        if not r:
+            logging.warning("Failed to map capture buffer")
+            return Gst.FlowReturn.OK
+        try:
+            # copy out of the gstreamer owned buffer
+            im = numpy.frombuffer(info.data, dtype='u1').copy()
+        finally:
+            buf.unmap(info)
+        s = sample.get_caps().get_structure(0)
+        if s.get_name() == 'video/x-raw':
+            h = s.get_value('height')
+            w = s.get_value('width')
+            # rows can be padded
+            im = im.reshape(h, -1)[:, :w * 3].reshape(h, w, 3)
+        self.publish(im, ts, t, subscriptions, buffer)
+        return Gst.FlowReturn.OK
+
+    def on_message(self, bus, message):
+        t = message.type
+        if t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            logging.error("Capture pipeline error: %s[%s]", err, debug)
+            self.error = Exception("%s[%s]" % (err, debug))
+            if self.loop is not None:
+                self.loop.quit()
+        elif t == Gst.MessageType.EOS:
+            # a recorder can send EOS to it's own branch, only quit when
+            # the source is done
+            if message.src == self.pipeline:
+                self.error = Exception("End of stream")
+                if self.loop is not None:
+                    self.loop.quit()
+
+    def run(self):
+        # errors end the thread (even with retry) as a new pipeline
+        # also needs a new recorder, see Grabber.start_capture_thread
+        self.error = None
+        self.loop = GLib.MainLoop()
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self.loop.run()
+        self.pipeline.set_state(Gst.State.NULL)
+        if self.keep_running and self.error is not None:
+            self.publish_error(self.error)
+        self._teardown_pipeline()
+
+    def stop(self):
+        if self.is_alive():
+            self.keep_running = False
+            if self.loop is not None:
+                self.loop.quit()
+            self.join()
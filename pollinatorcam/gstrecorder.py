@@ -12,6 +12,7 @@ jitterbuffer dropping older than base time, only seems to happen at the beginnin
 all latency shit in rtspsrc seems to do nothing
 """
 
+import logging
 import os
 import subprocess
 import sys
@@ -37,21 +38,34 @@ rtsp_cmd_string = (  # TODO configure queue latency/max-size-time/etc?
 usb_cmd_string = (
     'v4l2src device="{url}" ! '
     # size/resolution selection?
-    'jpegdec ! '
+    'image/jpeg ! '
     'queue name=queue0 max-size-bytes=0 max-size-buffers=0 leaky=2 silent=true max-size-time=7000000000 min-threshold-time=5000000000 ! '  # this is the 'delay'
     'fakesink name=fakesink0 sync=false '
 )
 
+# elements (factory, name) linked after queue0 when saving
+rtsp_record_elements = (
+    ('rtph265depay', 'depay0'),
+    ('h265parse', 'parse0'),
+    ('capsfilter', 'caps1'),
+    ('mp4mux', 'mux0'),
+)
 
+usb_record_elements = (
+    ('jpegparse', 'parse0'),
+    ('mp4mux', 'mux0'),
+)
 
 
 class GSTRecorder(threading.Thread):
     _inited = False
     def __init__(self, *args, **kwargs):
         self.url = kwargs.pop('url')
+        # optional running pipeline (see gstcapture) with queue0 ! fakesink0
+        pipeline = kwargs.pop('pipeline', None)
         if 'daemon' not in kwargs:
             kwargs['daemon'] = True
-        super(Recorder, self).__init__(*args, **kwargs)
+        super(GSTRecorder, self).__init__(*args, **kwargs)
 
         if not self._inited or not Gst.is_initialized():
             Gst.init([])
@@ -59,21 +73,32 @@ class GSTRecorder(threading.Thread):
 
         if 'rtsp' in self.url:
             cmd_string = rtsp_cmd_string
+            self.record_elements = rtsp_record_elements
         else:
             cmd_string = usb_cmd_string
-        self.pipeline = Gst.parse_launch(
-            cmd_string.format(url=self.url))
+            self.record_elements = usb_record_elements
+
+        self.shared = pipeline is not None
+        if self.shared:
+            # the pipeline (and main loop) are owned by the capture thread
+            self.pipeline = pipeline
+        else:
+            self.pipeline = Gst.parse_launch(
+                cmd_string.format(url=self.url))
 
         self.queue = self.pipeline.get_child_by_name("queue0")
         #self.caps0 = self.pipeline.get_child_by_name("caps0")
         self.fakesink = self.pipeline.get_child_by_name("fakesink0")
 
-        self.bus = self.pipeline.get_bus()
-        self.bus.add_signal_watch()
-        self._on_message_cb = self.bus.connect("message", self.on_message)
+        if not self.shared:
+            self.bus = self.pipeline.get_bus()
+            self.bus.add_signal_watch()
+            self._on_message_cb = self.bus.connect(
+                "message", self.on_message)
 
         self.filename = None
         self.playmode = False
+        self.elements = []
 
     def teardown(self):
         if hasattr(self, 'bus'):
@@ -82,7 +107,7 @@ class GSTRecorder(threading.Thread):
             del self.bus
 
     def __del__(self):
-        if self.playmode:
+        if self.playmode and not self.shared:
             self.stop_pipeline()
 
     def on_message(self, bus, message):
@@ -98,7 +123,7 @@ class GSTRecorder(threading.Thread):
         elif t == Gst.MessageType.ERROR:
             self.pipeline.set_state(Gst.State.NULL)
             err, debug = message.parse_error()
-            print("Error: %s[%s]" % (err, debug))
+            logging.error("Recording pipeline error: %s[%s]", err, debug)
             self.playmode = False
             self.loop.quit()
         elif t & Gst.MessageType.LATENCY:
@@ -114,23 +139,13 @@ class GSTRecorder(threading.Thread):
         #print("=======================")
         #print("==== stop filesink ====")
         #print("=======================")
-        self.depay.set_locked_state(True)
-        self.parse.set_locked_state(True)
-        self.parse_caps.set_locked_state(True)
-        self.mux.set_locked_state(True)
-        self.filesink.set_locked_state(True)
-
-        self.depay.set_state(Gst.State.NULL)
-        self.parse.set_state(Gst.State.NULL)
-        self.parse_caps.set_state(Gst.State.NULL)
-        self.mux.set_state(Gst.State.NULL)
-        self.filesink.set_state(Gst.State.NULL)
-
-        self.pipeline.remove(self.depay)
-        self.pipeline.remove(self.parse)
-        self.pipeline.remove(self.parse_caps)
-        self.pipeline.remove(self.mux)
-        self.pipeline.remove(self.filesink)
+        for e in self.elements:
+            e.set_locked_state(True)
+        for e in self.elements:
+            e.set_state(Gst.State.NULL)
+        for e in self.elements:
+            self.pipeline.remove(e)
+        self.elements = []
 
         self.filename = None
 
@@ -144,20 +159,34 @@ class GSTRecorder(threading.Thread):
         print("Done dropping")
         return Gst.PadProbeReturn.REMOVE
 
+    def filesink_eos_cb(self, pad, info, fn):
+        if info.get_event().type != Gst.EventType.EOS:
+            return Gst.PadProbeReturn.OK
+        # remove elements from the main loop, not the streaming thread
+        GLib.idle_add(self.stop_shared_filesink, fn)
+        return Gst.PadProbeReturn.REMOVE
+
+    def stop_shared_filesink(self, fn):
+        # only stop the file that ended (a new one may have started)
+        if self.filename == fn:
+            self.stop_filesink()
+        return GLib.SOURCE_REMOVE
+
     def create_filesink(self, fn):
         # TODO use GstBin instead
-        self.depay = Gst.ElementFactory.make('rtph265depay', 'depay0')
-        self.parse = Gst.ElementFactory.make('h265parse', 'parse0')
-        # TODO connect pad probe to parse src pad, drop buffers until full frame
-        src_pad = self.parse.get_static_pad('src')
-        src_pad.add_probe(Gst.PadProbeType.BUFFER, self.drop_buffer_cb)
-        self.parse_caps = Gst.ElementFactory.make('capsfilter', 'caps1')
+        self.elements = [
+            Gst.ElementFactory.make(f, n) for (f, n) in self.record_elements]
+        self.parse = self.pipeline_element('parse0')
+        if self.record_elements is rtsp_record_elements:
+            # TODO connect pad probe to parse src pad, drop buffers until full frame
+            # (jpeg frames are all complete)
+            src_pad = self.parse.get_static_pad('src')
+            src_pad.add_probe(Gst.PadProbeType.BUFFER, self.drop_buffer_cb)
         #self.parse_caps.set_property(
         #    'caps',
         #    Gst.Caps('video/x-h265, stream-format=byte-stream, alignment=au')
         #)
         # TODO set parse caps alignment to au
-        self.mux = Gst.ElementFactory.make('mp4mux', 'mux0')
         self.filesink = Gst.ElementFactory.make('filesink', 'filesink0')
         self.filesink.set_property('location', fn)
         self.filesink.set_property('async', False)  # don't close async
@@ -168,16 +197,22 @@ class GSTRecorder(threading.Thread):
         #self.filesink.set_property('max-lateness', -1)
         #self.filesink.set_property('render-delay', 3 * Gst.SECOND)
         self.filename = fn
+        if self.shared:
+            self.filesink.get_static_pad('sink').add_probe(
+                Gst.PadProbeType.EVENT_DOWNSTREAM, self.filesink_eos_cb, fn)
+
+        self.elements.append(self.filesink)
 
-        #self.pipeline.add(self.depay, self.parse, self.mux, self.filesink)
-        self.pipeline.add(
-            self.depay, self.parse, self.parse_caps, self.mux, self.filesink)
+        for e in self.elements:
+            self.pipeline.add(e)
+        for (e0, e1) in zip(self.elements[:-1], self.elements[1:]):
+            e0.link(e1)
 
-        self.depay.link(self.parse)
-        self.parse.link(self.parse_caps)
-        #self.parse.link(self.mux)
-        self.parse_caps.link(self.mux)
-        self.mux.link(self.filesink)
+    def pipeline_element(self, name):
+        for e in self.elements:
+            if e.get_name() == name:
+                return e
+        return None
 
     def insert_filesink(self, pad, info, fn):
         print("insert_filesink")
@@ -188,13 +223,10 @@ class GSTRecorder(threading.Thread):
 
         self.create_filesink(fn)
 
-        # link pad [rtsp src pad] to depay
-        pad.link(self.depay.get_static_pad('sink'))
-        self.depay.sync_state_with_parent()
-        self.parse.sync_state_with_parent()
-        self.parse_caps.sync_state_with_parent()
-        self.mux.sync_state_with_parent()
-        self.filesink.sync_state_with_parent()
+        # link pad [queue src pad] to first record element
+        pad.link(self.elements[0].get_static_pad('sink'))
+        for e in self.elements:
+            e.sync_state_with_parent()
         return Gst.PadProbeReturn.REMOVE  # don't call again
 
     def insert_fakesink(self, pad, info):
@@ -205,7 +237,7 @@ class GSTRecorder(threading.Thread):
         m = Gst.Event.new_eos()
         r = peer.send_event(m)
         if not r:
-            print("Failed sending eos to insert_fakesink")
+            logging.warning("Failed sending eos to insert_fakesink")
 
         self.fakesink = Gst.ElementFactory.make('fakesink', 'fakesink0')
         self.fakesink.set_property('sync', False)
@@ -236,12 +268,23 @@ class GSTRecorder(threading.Thread):
         #GLib.timeout_add(500, self._set_latency)
         return
 
+    def stop(self):
+        if self.shared:
+            # leave the pipeline running (it's owned by the capture thread)
+            # errors and EOS are handled there, see filesink_eos_cb
+            if self.filename is not None:
+                self.stop_saving()
+            self.playmode = False
+            self.join()
+        elif self.playmode:
+            self.stop_pipeline()
+
     def stop_pipeline(self, and_join=True):
         m = Gst.Event.new_eos()
         #print("Made EOS")
         r = self.pipeline.send_event(m)
         if not r:
-            print("Failed to send eos to pipeline")
+            logging.warning("Failed to send eos to pipeline")
         #print("send_event(EOS) = %s" % r)
         #print("Sent EOS")
         if and_join:
@@ -282,6 +325,11 @@ class GSTRecorder(threading.Thread):
 
     def run(self):
         self.playmode = True
+        if self.shared:
+            # messages are dispatched by the capture thread main loop
+            while self.playmode:
+                time.sleep(0.1)
+            return
         self.loop = GLib.MainLoop()
         #GLib.timeout_add(500, self.periodic_cb)
 
@@ -308,7 +356,7 @@ def test_recorder(ip='192.168.0.4'):
     t = Ticker()
     for fn in ('test_file.mp4', 'test_file2.mp4'):
         # create recorder instance
-        r = Recorder(url=url)
+        r = GSTRecorder(url=url)
         # start running (begins filling circular buffer)
         r.start()
         time.sleep(1)  # wait a bit
@@ -348,8 +396,8 @@ def test_for_open_files(ip='192.168.0.103'):
     for index in range(10):
         fn = '%04i.mp4' % index
         print("Index: %i, fn: %s" % (index, fn))
-        #r = Recorder(filename=fn, ip=ip, pre_record_time=1000)
-        r = Recorder(url=url)
+        #r = GSTRecorder(filename=fn, ip=ip, pre_record_time=1000)
+        r = GSTRecorder(url=url)
         print("\tStarting")
         r.start()
         #time.sleep(1.0)
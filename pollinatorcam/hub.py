@@ -0,0 +1,189 @@
+"""
+Run several cameras in one process
+
+Each camera gets a Grabber (with it's own capture thread, config,
+trigger and output directories) but all grabbers share:
+    - one inference engine (see engine)
+    - one analysis thread (this one) that services cameras round-robin
+      as new frames arrive
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+from . import cvcapture
+from . import discover
+from . import engine
+from . import grabber
+
+
+class Hub:
+    def __init__(
+            self, locs, name='hub', in_systemd=False, engine_cfg=None,
+            **kwargs):
+        self.name = name
+        if engine_cfg is None:
+            engine_cfg = engine.default_cfg
+        self.engine = engine.build(self.name, **engine_cfg)
+
+        # set by any capture thread when it has a new frame
+        self.frame_event = threading.Event()
+
+        self.grabbers = []
+        for loc in locs:
+            logging.info("Adding camera %s to hub", loc)
+            self.grabbers.append(grabber.Grabber(
+                loc, shared_engine=self.engine, frame_event=self.frame_event,
+                in_systemd=False, **kwargs))
+        if not len(self.grabbers):
+            raise ValueError("Hub requires at least 1 camera")
+
+        # time the last frame was received for each camera
+        self.last_frame_times = [time.monotonic()] * len(self.grabbers)
+        # camera to service first (rotates each update)
+        self.next_index = 0
+
+        self.in_systemd = in_systemd
+        if self.in_systemd:
+            import systemd.daemon
+            systemd.daemon.notify('READY=1')
+            self.reset_watchdog()
+        logging.info("Process in systemd? %s", self.in_systemd)
+
+    def reset_watchdog(self):
+        if not self.in_systemd:
+            return
+        import systemd.daemon
+        systemd.daemon.notify('WATCHDOG=1')
+        logging.debug("Reset watchdog")
+
+    def check_captures(self):
+        # restart any capture thread that hasn't produced a frame in time
+        t = time.monotonic()
+        for (i, g) in enumerate(self.grabbers):
+            if t - self.last_frame_times[i] > g.analysis_period * 1.5:
+                g.check_capture_thread("No new frame within timeout")
+                self.last_frame_times[i] = t
+
+    def update(self):
+        timeout = min(g.analysis_period for g in self.grabbers) * 1.5
+        if not self.frame_event.wait(timeout=timeout):
+            self.check_captures()
+            return
+        self.frame_event.clear()
+
+        n = len(self.grabbers)
+        n_analyzed = 0
+        for o in range(n):
+            i = (self.next_index + o) % n
+            g = self.grabbers[i]
+            try:
+                frame = g.frames.get_nowait()
+            except cvcapture.CaptureError as e:
+                logging.warning("Image error[%s]: %s", g.name, e)
+                g.timing.count('capture_errors')
+                continue
+            if frame is None:
+                continue
+            self.last_frame_times[i] = time.monotonic()
+            if g.process_image(frame):
+                n_analyzed += 1
+        self.next_index = (self.next_index + 1) % n
+        self.check_captures()
+
+        if n_analyzed:
+            self.reset_watchdog()
+
+    def run(self):
+        while True:
+            try:
+                self.update()
+            except KeyboardInterrupt:
+                break
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-b', '--backend', default='cv',
+        choices=('cv', 'gst', 'synthetic'),
+        help=(
+            'capture backend, gst uses one pipeline for analysis '
+            'and recording, synthetic generates frames (for testing)'))
+    parser.add_argument(
+        '-c', '--capture_stills', default=False, action='store_true',
+        help='save single images when triggered')
+    parser.add_argument(
+        '-D', '--in_systemd', action='store_true',
+        help='running in sysd, reset watchdog')
+    parser.add_argument(
+        '-e', '--engine', default='tfliteserve',
+        choices=sorted(engine.engine_types),
+        help='inference engine, local runs the model in this process')
+    parser.add_argument(
+        '-f', '--fake', default=False, action='store_true',
+        help='fake client detection')
+    parser.add_argument(
+        '-j', '--mjpeg', default=False, action='store_true',
+        help='pass through undecoded mjpeg frames (usb only)')
+    parser.add_argument(
+        '-l', '--loc', type=str, action='append', default=[],
+        help=(
+            'camera locator (ip address or /dev/videoX), can be repeated. '
+            'If not provided, use all cameras from the last discover'))
+    parser.add_argument(
+        '-L', '--labels', default=None,
+        help='labels file for the local engine')
+    parser.add_argument(
+        '-m', '--model', default=None,
+        help='model file for the local engine')
+    parser.add_argument(
+        '-n', '--name', default='hub',
+        help='name used to connect to tfliteserve')
+    parser.add_argument(
+        '-p', '--password', default=None,
+        help='camera password')
+    parser.add_argument(
+        '-r', '--retry', default=False, action='store_true',
+        help='retry on acquisition errors')
+    parser.add_argument(
+        '-u', '--user', default=None,
+        help='camera username')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.password is not None:
+        os.environ['PCAM_PASSWORD'] = args.password
+    if args.user is not None:
+        os.environ['PCAM_USER'] = args.user
+
+    locs = args.loc
+    if not len(locs):
+        locs = sorted(discover.get_cameras().keys())
+        logging.info("Using discovered cameras: %s", locs)
+
+    engine_cfg = {'type': args.engine}
+    if args.engine == 'local':
+        engine_cfg.update({'model': args.model, 'labels': args.labels})
+
+    h = Hub(
+        locs, name=args.name,
+        in_systemd=args.in_systemd,
+        engine_cfg=engine_cfg,
+        retry=args.retry,
+        fake_detection=args.fake,
+        capture_stills=args.capture_stills,
+        passthrough=args.mjpeg,
+        backend=args.backend)
+    try:
+        h.run()
+    except KeyboardInterrupt:
+        pass
@@ -9,7 +9,12 @@ import numpy
 class MetaJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, numpy.ndarray):
+            if obj.dtype.names is not None:
+                # structured (detection) records as columns
+                return {n: obj[n].tolist() for n in obj.dtype.names}
             return obj.tolist()
+        elif isinstance(obj, numpy.generic):
+            return obj.item()
         elif isinstance(obj, datetime.datetime):
             return obj.__str__()
         return json.JSONEncoder.default(self, obj)
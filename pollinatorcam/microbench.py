@@ -0,0 +1,429 @@
+"""
+Microbenchmarks for per-frame functions
+
+Cases time the functions whose cost grows with the number of classes
+and rois (RunningThreshold, allow masks, the crop closure, detector
+output remapping and meta output). Each case is a setup function
+(registered with @case) that returns a callable to time.
+
+Results can be saved as a baseline (-s) and later runs compared
+against it (-b), a case is a regression if it's median time per call
+is more than threshold times the baseline. Baselines are only
+meaningful on the machine (and python/numpy versions) that made them:
+    python -m pollinatorcam microbench -s baseline.json
+    ... change code ...
+    python -m pollinatorcam microbench -b baseline.json
+
+Import time (-I) is checked by importing modules (see import_modules)
+in fresh interpreters. An import fails if it takes longer than the
+budget (-B seconds) or loads a dependency that should be lazy (see
+lazy_modules). With -a an audit hook also fails imports that do I/O
+(other than reading python modules), make directories or run
+processes.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import numpy
+
+from . import cvcapture
+from . import detection
+from . import engine
+from . import grabber
+from . import logger
+from . import trigger
+
+
+# name: setup function, setup returns a function to time
+cases = {}
+
+# classes of the multi-class (classifier) model and the fpn detector
+class_counts = (2, 2988)
+
+allow_string = '+0:1000,-42,+2291,+1103:1589,-1200:1210,+7'
+
+# temporary directory for cases that write files (see run)
+output_dir = None
+
+# modules whose import time is checked (see check_imports)
+import_modules = (
+    'pollinatorcam.config',
+    'pollinatorcam.trigger',
+    'pollinatorcam.grabber',
+    'pollinatorcam.ui',
+)
+
+# heavy (or hardware specific) dependencies only imported when used
+lazy_modules = ('pandas', 'tfliteserve', 'systemd', 'gi', 'requests')
+
+# run in a fresh interpreter: import a module, print a json report
+import_script = '''
+import importlib, json, sys, time
+audit = sys.argv[2] == '1'
+events = []
+source_exts = ('.py', '.pyc', '.so', '.pth')
+def hook(event, args):
+    # compiled (.pyc) caches written during import are not side effects
+    if not args or isinstance(args[0], int) or '__pycache__' in str(args[0]):
+        return
+    if event == 'open':
+        fn = str(args[0])
+        if fn.endswith(source_exts) or args[1] is None:
+            return
+        events.append('open %s %s' % (fn, args[1]))
+    elif event in (
+            'os.mkdir', 'os.remove', 'os.rename', 'shutil.copyfile',
+            'subprocess.Popen', 'socket.connect'):
+        events.append('%s %s' % (event, args[0]))
+if audit:
+    sys.addaudithook(hook)
+before = set(sys.modules)
+t0 = time.perf_counter()
+importlib.import_module(sys.argv[1])
+dt = time.perf_counter() - t0
+print(json.dumps({
+    'time': dt,
+    'modules': sorted(set(sys.modules) - before),
+    'events': events,
+}))
+'''
+
+
+def case(name):
+    def wrap(func):
+        cases[name] = func
+        return func
+    return wrap
+
+
+def random_scores(n_classes, n=64, seed=0):
+    rng = numpy.random.default_rng(seed)
+    return rng.random((n, 1, n_classes)) * 0.5
+
+
+def random_output(n_detections=25, n_classes=2, seed=0):
+    # detector output rows: label, score, ymin, xmin, ymax, xmax
+    rng = numpy.random.default_rng(seed)
+    o = numpy.empty((n_detections, 6), dtype='f4')
+    o[:, 0] = rng.integers(0, n_classes, n_detections)
+    o[:, 1] = rng.random(n_detections)
+    o[:, 2:4] = rng.random((n_detections, 2)) * 0.5
+    o[:, 4:] = o[:, 2:4] + 0.25
+    return o
+
+
+def stub_grabber(n_rois=1, n_classes=2, shape=(320, 320)):
+    """Grabber with only what build_crop and save_meta use (no camera)"""
+    g = object.__new__(grabber.Grabber)
+    g.name = 'microbench'
+    g.cfg = {
+        'rois': [
+            [i / n_rois, 0.0, min(1.0, 16. / 9. / n_rois)]
+            for i in range(n_rois)],
+        'tiles': None,
+        'gate': grabber.default_cfg['gate'],
+        'track': None,
+        'detector': grabber.default_cfg['detector'],
+    }
+    g.engine = engine.FakeEngine(
+        n_classes=n_classes, shape=shape, model_type='detector')
+    g.n_classes = n_classes
+    g.settings = {'save_all_detections': 1, 'csv': 1, 'hostname': 'bench'}
+    g.mdir = output_dir
+    return g
+
+
+def running_threshold(n_classes):
+    rt = trigger.RunningThreshold(n_classes, threshold=0.9)
+    bs = random_scores(n_classes)
+    # fill the buffers so check uses the running mean and std
+    for b in bs:
+        rt.check(b)
+    i = [0]
+
+    def f():
+        rt.check(bs[i[0] % len(bs)])
+        i[0] += 1
+    return f
+
+
+for n in class_counts:
+    case('running_threshold_%i' % n)(
+        lambda n=n: running_threshold(n))
+
+
+@case('parse_allow_mask')
+def parse_allow():
+    return lambda: trigger.parse_allow_mask(allow_string, check_consts=False)
+
+
+@case('make_allow_mask_2988')
+def make_allow():
+    ops = trigger.parse_allow_mask(allow_string, check_consts=False)
+    return lambda: trigger.make_allow_mask(2988, *ops)
+
+
+def crop(n_rois):
+    g = stub_grabber(n_rois)
+    im = numpy.random.default_rng(0).integers(
+        0, 256, (1080, 1920, 3), dtype='u1')
+    cf = g.build_crop(cvcapture.Frame(bgr=im))
+
+    def f():
+        # new frame each call (pyramid levels are per frame)
+        list(cf(cvcapture.Frame(bgr=im)))
+    return f
+
+
+for n in (1, 4):
+    case('build_crop_%iroi' % n)(lambda n=n: crop(n))
+
+
+def remap(n_classes, n_rois=4):
+    outputs = [
+        random_output(n_classes=n_classes, seed=i) for i in range(n_rois)]
+    coords = [(0, 480, 640 * i, 640 * i + 480) for i in range(n_rois)]
+
+    def f():
+        records = [
+            detection.from_output(o, n_classes, i, coords[i])[1]
+            for (i, o) in enumerate(outputs)]
+        detection.nms(numpy.concatenate(records))
+    return f
+
+
+for n in class_counts:
+    case('detector_remap_%i' % n)(lambda n=n: remap(n))
+
+
+def example_meta(n_detections=10):
+    records = detection.from_output(
+        random_output(n_detections), 2, 0, (0, 1080, 0, 1080))[1]
+    dt = datetime.datetime(2024, 6, 1, 12, 0, 0)
+    meta = {
+        'datetime': dt,
+        'timestamp': dt.strftime('%y%m%d_%H%M%S_%f'),
+        'still_filename': 'bench-240601-120000-000000-microbench.jpg',
+        'detection': True,
+        'records': records,
+        'bboxes': [(0, detection.bboxes(records))],
+    }
+    return meta, records
+
+
+@case('meta_json_encode')
+def meta_json():
+    meta, _ = example_meta()
+    return lambda: json.dumps(
+        {'meta': meta, 'last_meta': meta},
+        indent=True, cls=logger.MetaJSONEncoder)
+
+
+@case('csv_append')
+def csv_append():
+    g = stub_grabber()
+    meta, records = example_meta()
+    return lambda: g.save_meta(meta, None, records, True, ['NaN'])
+
+
+def time_case(func, repeat=5, min_time=0.2):
+    """Median and min seconds per call of func"""
+    timer = timeit.Timer(func)
+    # calls per repeat so each repeat takes at least min_time
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(t, 1e-9)))
+    times = numpy.array(timer.repeat(repeat, number)) / number
+    return {
+        'median': float(numpy.median(times)),
+        'min': float(numpy.min(times)),
+        'number': number,
+    }
+
+
+def run(names=None, repeat=5, min_time=0.2):
+    global output_dir
+    if names is None:
+        names = sorted(cases)
+    output_dir = tempfile.mkdtemp(prefix='pcam_microbench_')
+    results = {}
+    try:
+        for name in names:
+            try:
+                func = cases[name]()
+            except ImportError as e:
+                logging.warning("Skipping %s: %s", name, e)
+                continue
+            results[name] = time_case(func, repeat, min_time)
+            logging.info(
+                "%s: %.1f us", name, results[name]['median'] * 1e6)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'cases': results,
+    }
+
+
+def time_import(name, audit=False):
+    """Import name in a new interpreter, returns a report (or None)"""
+    p = subprocess.run(
+        [sys.executable, '-c', import_script, name, '1' if audit else '0'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if p.returncode != 0:
+        logging.warning(
+            "Failed to import %s: %s", name,
+            p.stderr.strip().splitlines()[-1])
+        return None
+    r = json.loads(p.stdout.strip().splitlines()[-1])
+    r['lazy'] = sorted({
+        m.split('.')[0] for m in r['modules']
+        if m.split('.')[0] in lazy_modules})
+    return r
+
+
+def check_imports(names=import_modules, budget=1.0, audit=False):
+    """Returns (reports, failures) for importing each module"""
+    reports = {}
+    failures = []
+    for name in names:
+        r = time_import(name, audit)
+        if r is None:
+            failures.append("%s failed to import" % (name, ))
+            continue
+        reports[name] = r
+        logging.info(
+            "import %s: %.3f s, %i modules", name, r['time'],
+            len(r['modules']))
+        if r['time'] > budget:
+            failures.append("%s took %.3f s (budget %.3f s)" % (
+                name, r['time'], budget))
+        if len(r['lazy']):
+            failures.append("%s imported %s" % (name, ', '.join(r['lazy'])))
+        for e in r['events']:
+            failures.append("%s did I/O on import: %s" % (name, e))
+    return reports, failures
+
+
+def compare(results, baseline, threshold=1.2):
+    """Returns (name, ratio) of cases slower than threshold * baseline
+
+    A baseline case can override the threshold with a 'threshold' key.
+    """
+    regressions = []
+    for (name, r) in results['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        b = baseline['cases'][name]
+        ratio = r['median'] / b['median']
+        t = b.get('threshold', threshold)
+        logging.info(
+            "%s: %.2fx baseline (threshold %.2fx)", name, ratio, t)
+        if ratio > t:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-a', '--audit', default=False, action='store_true',
+        help='with -I, fail imports that do I/O (uses an audit hook)')
+    parser.add_argument(
+        '-b', '--baseline', default=None,
+        help='compare to this baseline (json)')
+    parser.add_argument(
+        '-B', '--budget', default=1.0, type=float,
+        help='with -I, maximum seconds per module import')
+    parser.add_argument(
+        '-I', '--imports', default=False, action='store_true',
+        help='check import times instead of running cases')
+    parser.add_argument(
+        '-k', '--case', action='append', default=[],
+        help='only run cases matching this pattern, can be repeated')
+    parser.add_argument(
+        '-l', '--list', default=False, action='store_true',
+        help='list cases and exit')
+    parser.add_argument(
+        '-m', '--min_time', default=0.2, type=float,
+        help='minimum seconds per repeat')
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help='save results to this file (json)')
+    parser.add_argument(
+        '-r', '--repeat', default=5, type=int,
+        help='number of repeats per case')
+    parser.add_argument(
+        '-s', '--save_baseline', default=None,
+        help='save results as a new baseline (json)')
+    parser.add_argument(
+        '-t', '--threshold', default=1.2, type=float,
+        help='regression if median time > threshold * baseline')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    if args.imports:
+        reports, failures = check_imports(
+            budget=args.budget, audit=args.audit)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(reports, f, indent=True)
+        for f in failures:
+            logging.error("Import check failed: %s", f)
+        if len(failures):
+            sys.exit(1)
+        return
+
+    names = sorted(cases)
+    if len(args.case):
+        names = [
+            n for n in names
+            if any(fnmatch.fnmatch(n, p) for p in args.case)]
+    if args.list:
+        for n in names:
+            print(n)
+        return
+
+    results = run(names, args.repeat, args.min_time)
+    for fn in (args.output, args.save_baseline):
+        if fn is None:
+            continue
+        with open(fn, 'w') as f:
+            json.dump(results, f, indent=True)
+        logging.info("Saved results to %s", fn)
+
+    if args.baseline is not None:
+        if not os.path.exists(args.baseline):
+            raise IOError("Baseline not found: %s" % (args.baseline, ))
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for (name, ratio) in regressions:
+            logging.error(
+                "Regression in %s: %.2fx slower than baseline", name, ratio)
+        if len(regressions):
+            sys.exit(1)
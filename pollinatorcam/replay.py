@@ -0,0 +1,420 @@
+"""
+Re-analyze archived stills and videos (for example with a new model)
+
+Files are read from:
+    <data_dir>/stills/<camera>/<day>/*.jpg
+    <data_dir>/videos/<camera>/<day>/*.mp4 (or .avi)
+and run through the same crop, inference, RunningThreshold and output
+code as Grabber (without a camera, trigger recording or real-time
+pacing). Results are written to:
+    <output_dir>/detections/<camera>/<day>/
+
+Each <camera>/<day> (stills and videos together) is one unit of work,
+units are spread across a pool of processes (one unit per worker at a
+time) so no two workers write to the same output directory. Units
+where every file replayed are added to:
+    <output_dir>/replay_checkpoint.json
+so an interrupted replay resumes where it left off.
+
+Site settings are only read from a file given with -S (threshold and
+hostname), nothing outside of output_dir is modified.
+"""
+
+import argparse
+import copy
+import datetime
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import re
+import socket
+import time
+
+import cv2
+import numpy
+
+from . import config
+from . import cvcapture
+from . import engine
+from . import grabber
+from . import timing
+from . import trigger
+
+
+still_extensions = ('.jpg', '.jpeg', '.png')
+video_extensions = ('.mp4', '.avi')
+
+# <hostname>-<yymmdd>-<HHMMSS>-<ffffff>-<camera>.jpg (see still_filename)
+still_time_re = re.compile(r'(\d{6})-(\d{6})-(\d{6})')
+# <HHMMSS>_<ffffff>_<camera>.mp4 in a <yymmdd> directory (see video_filename)
+video_time_re = re.compile(r'^(\d{6})_(\d{6})')
+
+checkpoint_filename = 'replay_checkpoint.json'
+
+
+def file_timestamp(fn):
+    """Capture time (seconds since epoch) from a still or video filename"""
+    bn = os.path.basename(fn)
+    m = still_time_re.search(bn)
+    if m is not None:
+        s = '%s%s%s' % m.groups()
+    else:
+        m = video_time_re.match(bn)
+        day = os.path.basename(os.path.dirname(fn))
+        if m is None or not day.isdigit():
+            # fall back to the file modification time
+            return os.path.getmtime(fn)
+        s = day + '%s%s' % m.groups()
+    return datetime.datetime.strptime(s, '%y%m%d%H%M%S%f').timestamp()
+
+
+def iter_frames(fn, video_period=1.0):
+    """Frames from a still or (every video_period seconds of) a video"""
+    ts = file_timestamp(fn)
+    if os.path.splitext(fn)[1].lower() in still_extensions:
+        if fn.lower().endswith('.png'):
+            frame = cvcapture.Frame(bgr=cv2.imread(fn), timestamp=ts, index=0)
+        else:
+            # decoded on demand (with reduced decodes for rois)
+            frame = cvcapture.Frame(
+                jpeg=numpy.fromfile(fn, dtype='u1'), timestamp=ts, index=0)
+        frame.filename = fn
+        yield frame
+        return
+    cap = cv2.VideoCapture(fn)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.
+    step = max(1, int(round(fps * video_period)))
+    index = 0
+    try:
+        while cap.grab():
+            if index % step == 0:
+                r, im = cap.retrieve()
+                if not r:
+                    break
+                frame = cvcapture.Frame(
+                    bgr=im, timestamp=ts + index / fps, index=index)
+                frame.filename = fn
+                yield frame
+            index += 1
+    finally:
+        cap.release()
+
+
+def unit_key(camera, day):
+    return '%s/%s' % (camera, day)
+
+
+def find_units(data_dir, cameras=None, days=None, videos=True):
+    """List (camera, day, directories) units to replay
+
+    stills and videos of the same camera and day are one unit
+    """
+    kinds = ('stills', 'videos') if videos else ('stills', )
+    dirs = {}
+    for kind in kinds:
+        for d in sorted(glob.glob(os.path.join(data_dir, kind, '*', '*'))):
+            if not os.path.isdir(d):
+                continue
+            camera = os.path.basename(os.path.dirname(d))
+            day = os.path.basename(d)
+            if cameras and camera not in cameras:
+                continue
+            if days and day not in days:
+                continue
+            dirs.setdefault((camera, day), []).append(d)
+    return [(camera, day, dirs[(camera, day)]) for (camera, day) in sorted(dirs)]
+
+
+class ReplayTrigger(trigger.Trigger):
+    """Trigger state without recording, new_image returns the source file"""
+    def new_image(self, frame):
+        return getattr(frame, 'filename', 'NaN')
+
+    def save_image(self, frame, fn=None):
+        pass
+
+    def still_filename(self, meta):
+        return ''
+
+    def stop(self):
+        pass
+
+
+class Replayer(grabber.Grabber):
+    """Grabber analysis without a camera
+
+    Frames are analyzed as fast as possible in order (no pipeline),
+    meta times come from the frame (capture) timestamps.
+    """
+    def __init__(
+            self, name, output_dir, cfg=None, settings=None,
+            shared_engine=None):
+        self.name = name
+        if cfg is None:
+            cfg = grabber.default_cfg
+        self.cfg = copy.deepcopy(cfg)
+        # real-time only features: result reuse, tracking and deadlines
+        for k in ('cache', 'track', 'shed'):
+            self.cfg[k] = None
+        if settings is None:
+            settings = {
+                'save_all_detections': 1, 'csv': 0,
+                'hostname': socket.gethostname()}
+        self.settings = settings
+        self.fake_detection = False
+        self.capture_stills = False
+        self.pipelined = False
+        self.crop = None
+        self.gates = None
+        self.tracker = None
+        self.crops = {}
+        self.mdir = os.path.join(output_dir, 'detections', self.name)
+        if not os.path.exists(self.mdir):
+            os.makedirs(self.mdir)
+        self.timing = timing.StageTimes(
+            'replay_%s' % self.name, directory=os.path.join(output_dir, 'logs'))
+        self.analysis_period = 0.
+        self.last_analysis_time = time.monotonic()
+
+        self.build_engine(shared_engine)
+        self.build_analysis_rate()
+        self.build_cache()
+        self.shedder = None
+        kwargs = {
+            k: self.cfg['recording'][k]
+            for k in ('duty_cycle', 'post_time', 'min_time', 'max_time')
+            if k in self.cfg['recording']}
+        self.trigger = ReplayTrigger(**kwargs)
+
+    def set_analysis_period(self, period):
+        # no pacing, every frame is analyzed
+        self.analysis_period = period
+
+    def generate_thumbnail(self, frame):
+        pass
+
+    def frame_datetime(self, frame):
+        return datetime.datetime.fromtimestamp(frame.timestamp)
+
+    def meta_filename(self, d, meta):
+        # filename times are not unique (stills and video frames can share
+        # a time) so name results after the source file and frame index
+        fn = super(Replayer, self).meta_filename(d, meta)
+        source = os.path.splitext(os.path.basename(meta['source'] or ''))[0]
+        return '%s-%s-%i.json' % (
+            os.path.splitext(fn)[0], source, meta['source_index'])
+
+    def preprocess_frame(self, job):
+        super(Replayer, self).preprocess_frame(job)
+        job.meta['source'] = getattr(job.frame, 'filename', None)
+        job.meta['source_index'] = job.frame.index
+
+    def analyze(self, frame):
+        job = grabber.AnalysisJob(frame, self.timing.start_frame())
+        shape = tuple(frame.shape[:2])
+        if shape not in self.crops:
+            self.crops[shape] = (
+                self.build_crop(frame), self.gates, self.tracker)
+        job.crop, job.gates, job.tracker = self.crops[shape]
+        job.trigger = self.trigger
+        job.cache = self.cache
+        job.shedder = self.shedder
+        for stage in grabber.analysis_stages:
+            getattr(self, stage + '_frame')(job)
+        return job
+
+
+# per worker process engine (see init_worker)
+worker_engine = None
+
+
+def init_worker(engine_cfg):
+    global worker_engine
+    cfg = dict(engine_cfg)
+    worker_engine = engine.build(
+        'replay_%s' % os.getpid(), **cfg)
+
+
+def replay_unit(args):
+    """Analyze all files of one camera and day, returns a summary
+
+    summary['failed'] lists files that could not be (fully) replayed
+    """
+    (camera, day, directories, output_dir, cfg, settings, video_period) = args
+    t0 = time.monotonic()
+    r = Replayer(
+        camera, output_dir, cfg, settings, shared_engine=worker_engine)
+    fns = [
+        os.path.join(directory, fn)
+        for directory in directories for fn in os.listdir(directory)
+        if os.path.splitext(fn)[1].lower() in
+        still_extensions + video_extensions]
+    fns = sorted(fns, key=file_timestamp)
+    n_frames = 0
+    n_triggered = 0
+    failed = []
+    for fn in fns:
+        try:
+            for frame in iter_frames(fn, video_period):
+                job = r.analyze(frame)
+                n_frames += 1
+                n_triggered += int(job.set_trigger)
+        except Exception as e:
+            logging.warning("Failed to replay %s: %s", fn, e)
+            failed.append(fn)
+    r.timing.save()
+    return {
+        'unit': unit_key(camera, day),
+        'files': len(fns),
+        'failed': failed,
+        'frames': n_frames,
+        'triggered': n_triggered,
+        'time': time.monotonic() - t0,
+    }
+
+
+def load_checkpoint(output_dir):
+    fn = os.path.join(output_dir, checkpoint_filename)
+    if not os.path.exists(fn):
+        return {'done': []}
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+def save_checkpoint(output_dir, checkpoint):
+    fn = os.path.join(output_dir, checkpoint_filename)
+    # write then move so an interrupted save doesn't lose the checkpoint
+    tfn = fn + '.tmp'
+    with open(tfn, 'w') as f:
+        json.dump(checkpoint, f, indent=True)
+    os.replace(tfn, fn)
+
+
+def replay(
+        data_dir, output_dir, cfg=None, settings=None, cameras=None,
+        days=None, videos=True, video_period=1.0, jobs=None, resume=True):
+    if cfg is None:
+        cfg = grabber.default_cfg
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    checkpoint = load_checkpoint(output_dir) if resume else {'done': []}
+    done = set(checkpoint['done'])
+    units = [
+        u for u in find_units(data_dir, cameras, days, videos)
+        if unit_key(u[0], u[1]) not in done]
+    logging.info(
+        "Replaying %i camera days (%i already done)", len(units), len(done))
+    if not len(units):
+        return checkpoint
+    tasks = [
+        (camera, day, dirs, output_dir, cfg, settings, video_period)
+        for (camera, day, dirs) in units]
+    engine_cfg = cfg.get('engine', engine.default_cfg)
+    with multiprocessing.Pool(
+            jobs, initializer=init_worker, initargs=(engine_cfg, )) as pool:
+        for summary in pool.imap_unordered(replay_unit, tasks):
+            logging.info(
+                "Replayed %s: %i files, %i frames, %i triggered in %.1f s",
+                summary['unit'], summary['files'], summary['frames'],
+                summary['triggered'], summary['time'])
+            if len(summary['failed']):
+                # not done, the next (resumed) replay retries this unit
+                logging.warning(
+                    "%s: %i file(s) failed, not marking done",
+                    summary['unit'], len(summary['failed']))
+                continue
+            checkpoint['done'].append(summary['unit'])
+            save_checkpoint(output_dir, checkpoint)
+    return checkpoint
+
+
+def cmdline_run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--camera', action='append', default=[],
+        help='only replay this camera, can be repeated')
+    parser.add_argument(
+        '-C', '--config', default=None,
+        help='camera config (json) to use instead of the default')
+    parser.add_argument(
+        '-d', '--data_dir', default=config.data_dir,
+        help='directory containing stills and videos')
+    parser.add_argument(
+        '-D', '--day', action='append', default=[],
+        help='only replay this day (yymmdd), can be repeated')
+    parser.add_argument(
+        '-e', '--engine', default=None,
+        choices=sorted(engine.engine_types),
+        help='inference engine (overrides the config)')
+    parser.add_argument(
+        '-H', '--hostname', default=None,
+        help='hostname used in output filenames (default: from -S or this host)')
+    parser.add_argument(
+        '-j', '--jobs', default=None, type=int,
+        help='number of worker processes (default: number of cores)')
+    parser.add_argument(
+        '-L', '--labels', default=None,
+        help='labels file for the local engine')
+    parser.add_argument(
+        '-m', '--model', default=None,
+        help='model file for the local engine')
+    parser.add_argument(
+        '-o', '--output_dir', required=True,
+        help='directory for replay results')
+    parser.add_argument(
+        '-p', '--video_period', default=1.0, type=float,
+        help='analyze a video frame every N seconds')
+    parser.add_argument(
+        '-r', '--restart', default=False, action='store_true',
+        help='ignore the checkpoint and replay everything')
+    parser.add_argument(
+        '-S', '--settings', default=None,
+        help='site settings (json) to take the threshold and hostname from')
+    parser.add_argument(
+        '-s', '--stills_only', default=False, action='store_true',
+        help='do not replay videos')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='enable verbose output')
+    parser.add_argument(
+        '-x', '--csv', default=False, action='store_true',
+        help='save results as csv (instead of json)')
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    # only read site settings (grabber.load_settings also changes
+    # /etc/hostname)
+    site = {}
+    if args.settings is not None:
+        with open(args.settings, 'r') as f:
+            site = json.load(f)
+    cfg = copy.deepcopy(grabber.default_cfg)
+    if 'threshold' in site:
+        cfg['detector']['threshold'] = site['threshold']
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            cfg.update(json.load(f))
+    if args.engine is not None:
+        cfg['engine'] = {'type': args.engine}
+    if args.model is not None:
+        cfg['engine']['model'] = args.model
+    if args.labels is not None:
+        cfg['engine']['labels'] = args.labels
+
+    settings = {
+        'save_all_detections': 1,
+        'csv': int(args.csv),
+        'hostname': (
+            args.hostname or site.get('hostname') or socket.gethostname()),
+    }
+    replay(
+        args.data_dir, args.output_dir, cfg, settings,
+        cameras=args.camera, days=args.day, videos=not args.stills_only,
+        video_period=args.video_period, jobs=args.jobs,
+        resume=not args.restart)
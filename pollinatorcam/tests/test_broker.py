@@ -0,0 +1,44 @@
+import threading
+
+from pollinatorcam import broker
+
+
+def requests(name, n, priority=0):
+    done = threading.Event()
+    return [broker.Request(name, i, priority, done) for i in range(n)]
+
+
+def test_round_robin():
+    s = broker.Scheduler('round_robin', max_batch=4, max_wait=0)
+    s.put(requests('a', 4))
+    s.put(requests('b', 2))
+    batch = s.wait_for_batch(timeout=1)
+    assert [r.name for r in batch] == ['a', 'b', 'a', 'b']
+    assert s.depths() == {'a': 2, 'b': 0}
+    assert s.n_pending == 2
+
+
+def test_rotation():
+    s = broker.Scheduler('round_robin', max_batch=1, max_wait=0)
+    s.put(requests('a', 2))
+    s.put(requests('b', 2))
+    names = [s.wait_for_batch(timeout=1)[0].name for i in range(4)]
+    assert names == ['a', 'b', 'a', 'b']
+
+
+def test_priority():
+    s = broker.Scheduler('priority', max_batch=2, max_wait=0)
+    s.put(requests('a', 2, priority=0))
+    s.put(requests('b', 2, priority=1))
+    assert [r.name for r in s.wait_for_batch(timeout=1)] == ['b', 'a']
+
+
+def test_timeout_and_policy():
+    s = broker.Scheduler(max_wait=0)
+    assert s.wait_for_batch(timeout=0.01) == []
+    try:
+        broker.Scheduler('fifo')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("invalid policy accepted")
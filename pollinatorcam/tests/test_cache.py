@@ -0,0 +1,60 @@
+import numpy
+
+from pollinatorcam import cache
+
+
+def patch(seed):
+    return numpy.random.RandomState(seed).randint(
+        0, 255, (32, 32, 3)).astype('u1')
+
+
+def test_hit_and_miss():
+    c = cache.ResultCache(max_distance=4)
+    p = patch(0)
+    h = c.hash(p)
+    assert c.get(0, h, t=0) is None
+    c.put(0, h, numpy.ones(3), t=0)
+    assert numpy.all(c.get(0, c.hash(p), t=1) == 1)
+    # other rois don't share entries
+    assert c.get(1, h, t=1) is None
+    # a different patch misses
+    assert c.get(0, c.hash(patch(1)), t=1) is None
+    assert c.n_hits == 1
+    assert c.n_misses == 3
+    assert c.hit_rate == 0.25
+
+
+def test_output_is_copied():
+    c = cache.ResultCache()
+    h = c.hash(patch(0))
+    output = numpy.zeros(3)
+    c.put(0, h, output, t=0)
+    output[:] = 1
+    assert numpy.all(c.get(0, h, t=0) == 0)
+
+
+def test_max_age():
+    c = cache.ResultCache(max_age=10.)
+    h = c.hash(patch(0))
+    c.put(0, h, numpy.ones(1), t=0)
+    assert c.get(0, h, t=5) is not None
+    assert c.get(0, h, t=11) is None
+    assert len(c.entries) == 0
+
+
+def test_max_size_lru():
+    c = cache.ResultCache(max_size=2, max_distance=0)
+    hs = [c.hash(patch(i)) for i in range(3)]
+    c.put(0, hs[0], numpy.ones(1), t=0)
+    c.put(0, hs[1], numpy.ones(1), t=0)
+    # use 0 so 1 is the least recently used
+    assert c.get(0, hs[0], t=0) is not None
+    c.put(0, hs[2], numpy.ones(1), t=0)
+    assert c.get(0, hs[1], t=0) is None
+    assert c.get(0, hs[0], t=0) is not None
+
+
+def test_hamming():
+    a = numpy.array([0b1111, 0], dtype='u1')
+    b = numpy.array([[0b1111, 0], [0, 0], [0b1, 0b1]], dtype='u1')
+    assert list(cache.hamming(a, b)) == [0, 4, 4]
@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+from pollinatorcam import config
+
+
+def wait_for(f, timeout=3.0):
+    t0 = time.monotonic()
+    while not f():
+        if time.monotonic() - t0 > timeout:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture(params=['inotify', 'poll'])
+def watcher(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'working_cfg_dir', str(tmp_path))
+    w = config.ConfigWatcher(
+        str(tmp_path), poll_period=0.05,
+        use_inotify=request.param == 'inotify')
+    if request.param == 'inotify' and w.fd is None:
+        w.stop()
+        pytest.skip("inotify not available")
+    yield w
+    w.stop()
+
+
+def test_save_bumps_version(watcher):
+    watcher.watch('cam')
+    assert watcher.version('cam') == 0
+    # save_config writes a temporary file then renames it
+    config.save_config({'a': 1}, 'cam')
+    assert wait_for(lambda: watcher.version('cam') >= 1)
+    v = watcher.version('cam')
+    time.sleep(0.02)
+    config.save_config({'a': 2}, 'cam')
+    assert wait_for(lambda: watcher.version('cam') > v)
+
+
+def test_write_in_place(watcher):
+    fn = os.path.join(watcher.directory, 'cam')
+    with open(fn, 'w') as f:
+        f.write('{}')
+    watcher.watch('cam')
+    time.sleep(0.02)
+    with open(fn, 'w') as f:
+        f.write('{"a": 1}')
+    assert wait_for(lambda: watcher.version('cam') >= 1)
+
+
+def test_delete_and_unwatched(watcher):
+    config.save_config({}, 'cam')
+    watcher.watch('cam')
+    config.save_config({}, 'other')
+    os.remove(os.path.join(watcher.directory, 'cam'))
+    assert wait_for(lambda: watcher.version('cam') >= 1)
+    assert watcher.version('other') == 0
+
+
+def test_read_events(tmp_path):
+    w = config.ConfigWatcher(str(tmp_path), use_inotify=False)
+    w.stop()
+    w.watch('cam')
+    w.watch('other')
+    r, wr = os.pipe()
+    # names are nul padded (to 16 bytes here)
+    data = b''
+    for name in (b'cam', b'.cam.tmp', b'other', b'cam'):
+        padded = name + b'\0' * (16 - len(name))
+        data += config.inotify_event.pack(
+            1, config.IN_MOVED_TO, 0, len(padded)) + padded
+    os.write(wr, data)
+    os.close(wr)
+    w.fd = r
+    w.read_events()
+    w.fd = None
+    os.close(r)
+    assert w.version('cam') == 2
+    assert w.version('other') == 1
+    assert w.version('.cam.tmp') == 0
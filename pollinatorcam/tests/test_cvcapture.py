@@ -0,0 +1,96 @@
+import numpy
+import pytest
+
+from pollinatorcam import cvcapture
+
+
+def image(v=0):
+    return numpy.full((8, 8, 3), v, dtype='u1')
+
+
+def test_buffer_pre_time():
+    b = cvcapture.FrameBuffer(pre_time=1.0)
+    for i in range(20):
+        b.push(i * 0.1, image(i))
+    ts = [t for (t, im) in b.last()]
+    assert ts[-1] == pytest.approx(1.9)
+    assert ts[0] >= 0.9 - 1e-9
+    assert [t for (t, im) in b.since(1.5)] == pytest.approx([1.6, 1.7, 1.8, 1.9])
+
+
+def test_buffer_limits():
+    b = cvcapture.FrameBuffer(pre_time=100., max_frames=4)
+    for i in range(10):
+        b.push(i, image())
+    assert len(b) == 4
+    b = cvcapture.FrameBuffer(pre_time=100., max_bytes=image().nbytes * 3)
+    for i in range(10):
+        b.push(i, image())
+    assert len(b) == 3
+
+
+def test_buffer_period():
+    b = cvcapture.FrameBuffer(pre_time=100., period=0.2)
+    for i in range(30):
+        t = i / 30.
+        if b.wants(t):
+            b.push(t, image())
+    # every 6th frame
+    assert len(b) == 5
+
+
+def test_subscription_latest():
+    s = cvcapture.FrameSubscription('latest')
+    for i in range(3):
+        s.put(cvcapture.Frame(bgr=image(), index=i))
+    assert s.get(timeout=0).index == 2
+    assert s.dropped == 2
+    assert s.get_nowait() is None
+
+
+def test_subscription_all():
+    s = cvcapture.FrameSubscription('all', maxsize=2)
+    for i in range(3):
+        s.put(cvcapture.Frame(bgr=image(), index=i))
+    assert [s.get(timeout=0).index for i in range(2)] == [1, 2]
+    assert s.dropped == 1
+    with pytest.raises(RuntimeError):
+        s.get(timeout=0)
+
+
+def test_subscription_period():
+    # with rate == fps every frame is wanted (despite jitter)
+    s = cvcapture.FrameSubscription('latest', period=0.1)
+    ts = [i * 0.1 + (0.01 if i % 2 else -0.01) for i in range(100)]
+    assert offered(s, ts) == 100
+    s = cvcapture.FrameSubscription('latest', period=0.2)
+    assert offered(s, [i * 0.1 for i in range(100)]) == 50
+
+
+def offered(subscription, times):
+    # number of frames (at times) the subscription took
+    n = 0
+    for t in times:
+        if subscription.wants(t):
+            subscription.put(None, t)
+            n += 1
+    return n
+
+
+def test_subscription_paused_and_error():
+    s = cvcapture.FrameSubscription('all', paused=True)
+    assert not s.wants(0.)
+    s.paused = False
+    assert s.wants(0.)
+    s.put_error('failed')
+    with pytest.raises(cvcapture.CaptureError):
+        s.get(timeout=0)
+
+
+def test_reduce_level():
+    assert [cvcapture.reduce_level(s) for s in (0.5, 1, 3, 4, 16)] == [
+        1, 1, 2, 4, 8]
+    f = cvcapture.Frame(bgr=numpy.zeros((16, 16, 3), dtype='u1'))
+    assert f.reduced(4).shape == (4, 4, 3)
+    with pytest.raises(ValueError):
+        f.reduced(3)
@@ -0,0 +1,58 @@
+import numpy
+
+from pollinatorcam import detection
+
+
+def make_records(rows):
+    # rows of label, score, ymin, xmin, ymax, xmax
+    records = numpy.zeros(len(rows), dtype=detection.detection_dtype)
+    for (r, row) in zip(records, rows):
+        for (f, v) in zip(('label', 'score') + detection.bbox_fields, row):
+            r[f] = v
+    records['track'] = -1
+    return records
+
+
+def test_nms_merges_overlapping_same_label():
+    records = make_records([
+        (0, 0.5, 0, 0, 10, 10),
+        (0, 0.9, 1, 1, 11, 11),
+        (0, 0.7, 50, 50, 60, 60),
+    ])
+    kept = detection.nms(records, iou=0.5)
+    assert list(kept['score']) == [
+        numpy.float32(0.9), numpy.float32(0.7)]
+
+
+def test_nms_keeps_overlapping_different_labels():
+    records = make_records([
+        (0, 0.9, 0, 0, 10, 10),
+        (1, 0.8, 0, 0, 10, 10),
+    ])
+    kept = detection.nms(records, iou=0.5)
+    assert sorted(kept['label']) == [0, 1]
+
+
+def test_nms_chain_is_greedy():
+    # b overlaps a and c, a suppresses b so c is kept
+    records = make_records([
+        (0, 0.9, 0, 0, 10, 10),
+        (0, 0.8, 0, 5, 10, 15),
+        (0, 0.7, 0, 10, 10, 20),
+    ])
+    kept = detection.nms(records, iou=0.3)
+    assert list(kept['xmin']) == [0, 10]
+
+
+def test_nms_bounds_input():
+    n = 50
+    rows = [(0, 1. - i / 100., i * 20, 0, i * 20 + 10, 10) for i in range(n)]
+    kept = detection.nms(make_records(rows), max_records=10)
+    assert len(kept) == 10
+    assert kept['score'].min() == numpy.float32(1. - 9 / 100.)
+
+
+def test_nms_small_inputs():
+    assert len(detection.nms(detection.empty())) == 0
+    records = make_records([(0, 0.5, 0, 0, 1, 1)])
+    assert len(detection.nms(records)) == 1
@@ -0,0 +1,118 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+from pollinatorcam import engine
+
+
+def image(v, shape=(8, 8)):
+    return numpy.full(shape + (3, ), v, dtype='u1')
+
+
+def test_fake_classifier():
+    e = engine.build('test', type='fake', n_classes=3, shape=(8, 8))
+    assert e.meta['input']['shape'] == (1, 8, 8, 3)
+    assert not e.is_detector
+    dark, light = e.run_many([image(0), image(255)])
+    assert dark.shape == (1, 3)
+    assert numpy.all(dark == 1)
+    assert numpy.all(light == 0)
+    assert numpy.all(e.run(image(0)) == dark)
+
+
+def test_fake_detector():
+    e = engine.FakeEngine(n_classes=2, model_type='detector')
+    assert e.is_detector
+    dark, light = e.run_many([image(0), image(255)])
+    assert dark.shape == (1, 6)
+    assert dark[0, 1] > 0.5 > light[0, 1]
+    assert list(dark[0, 2:]) == [0.25, 0.25, 0.75, 0.75]
+
+
+def ssd_outputs(classes, scores):
+    n = len(scores)
+    boxes = numpy.tile(numpy.array([0.1, 0.2, 0.3, 0.4], 'f4'), (1, n, 1))
+    return (
+        boxes, numpy.array([classes], 'f4'), numpy.array([scores], 'f4'),
+        numpy.array([n], 'f4'))
+
+
+def test_detector_output_order():
+    boxes, classes, scores, count = ssd_outputs([1, 3], [0.9, 0.5])
+    expected = [[1, 0.9, 0.1, 0.2, 0.3, 0.4], [3, 0.5, 0.1, 0.2, 0.3, 0.4]]
+    # classes and scores can come in either order
+    for outputs in (
+            (boxes, classes, scores, count),
+            (scores, count, classes, boxes)):
+        o = engine.to_detector_output(list(outputs))
+        assert o.dtype == numpy.float32
+        numpy.testing.assert_allclose(o, expected, rtol=1e-6)
+
+
+def test_detector_output_count():
+    boxes, classes, scores, count = ssd_outputs([1, 2, 0], [0.9, 0.5, 0.1])
+    count[:] = 2
+    o = engine.to_detector_output([boxes, classes, scores, count])
+    assert len(o) == 2
+    o = engine.to_detector_output([boxes, classes, scores])
+    assert len(o) == 3
+
+
+def test_detector_output_invalid():
+    with pytest.raises(ValueError):
+        engine.to_detector_output([numpy.zeros((1, 4))])
+
+
+class Runner:
+    shape = (1, 8, 8, 3)
+    dtype = 'uint8'
+
+    def __call__(self, image):
+        # out of order completion (brighter images finish first)
+        time.sleep(0.02 * (1. - image.mean() / 255.))
+        return [numpy.array([[image.mean()]], 'f4')]
+
+
+class ThreadEngine(engine.LocalEngine):
+    def runner(self):
+        if not hasattr(self.local, 'runner'):
+            self.threads.append(threading.current_thread().name)
+            self.local.runner = Runner()
+        return self.local.runner
+
+
+@pytest.fixture
+def local_engine(tmp_path):
+    labels = tmp_path / 'labels.txt'
+    labels.write_text('a\nb\n')
+    ThreadEngine.threads = []
+    e = ThreadEngine(
+        str(tmp_path / 'model.tflite'), labels=str(labels),
+        model_type='classifier', threads=3)
+    yield e
+    e.close()
+
+
+def test_local_engine(local_engine):
+    e = local_engine
+    assert e.meta['input']['shape'] == Runner.shape
+    assert e.meta['labels'] == {0: 'a', 1: 'b'}
+    values = list(range(0, 250, 25))
+    outputs = e.run_many([image(v) for v in values])
+    # outputs are in image order
+    assert [float(o[0, 0]) for o in outputs] == values
+    # one runner per pool thread (none on the calling thread)
+    assert len(e.threads) <= 3
+    assert all(n.startswith('engine') for n in e.threads)
+
+
+@pytest.mark.parametrize('cfg, error', [
+    ({'type': 'unknown'}, ValueError),
+    ({'type': 'fake', 'model': 'x'}, TypeError),
+    ({'type': 'local'}, TypeError),
+])
+def test_build_invalid(cfg, error):
+    with pytest.raises(error):
+        engine.build('test', **cfg)
@@ -0,0 +1,81 @@
+import numpy
+import pytest
+
+from pollinatorcam import cvcapture
+from pollinatorcam import gate
+
+
+# left and right halves of a 64 x 64 frame
+rois = [(0, 64, 0, 32), (0, 64, 32, 64)]
+
+
+def frame(left, right):
+    im = numpy.empty((64, 64, 3), dtype='u1')
+    im[:, :32] = left
+    im[:, 32:] = right
+    return cvcapture.Frame(bgr=im)
+
+
+def noise(seed=0):
+    return numpy.random.RandomState(seed).randint(
+        0, 255, (64, 32, 1)).astype('u1')
+
+
+def gates(**kwargs):
+    # large force_period so only the first check is forced
+    g = gate.Gates(rois, scale=1, force_period=1000., **kwargs)
+    g.check(frame(0, 0))
+    return g
+
+
+def test_no_gates():
+    g = gate.Gates(rois, scale=1)
+    assert g.check(frame(0, 255)) == [None, None]
+
+
+def test_luminance():
+    g = gates(luminance={'min_mean': 50, 'max_mean': 200})
+    assert g.check(frame(10, 100)) == ['dark', None]
+    assert g.check(frame(250, 100)) == ['bright', None]
+
+
+def test_blur():
+    g = gates(blur={'min_var': 10.0})
+    assert g.check(frame(noise(), 128)) == [None, 'blur']
+
+
+def test_motion():
+    g = gate.Gates(
+        rois, scale=1, force_period=1000.,
+        motion={'threshold': 15, 'min_fraction': 0.01, 'alpha': 0.05})
+    # first frame sets the background (and is forced)
+    assert g.check(frame(100, 100)) == [None, None]
+    assert g.check(frame(100, 100)) == ['static', 'static']
+    assert g.check(frame(100, 200)) == ['static', None]
+
+
+def test_force_period():
+    g = gate.Gates(
+        rois, scale=1, force_period=0., luminance={'min_mean': 50})
+    for i in range(3):
+        assert g.check(frame(0, 0)) == [None, None]
+    g = gate.Gates(
+        rois, scale=1, force_period=None, luminance={'min_mean': 50})
+    assert g.check(frame(0, 0)) == ['dark', 'dark']
+
+
+def test_first_gate_reason():
+    g = gates(luminance={'min_mean': 50}, blur={'min_var': 10.0})
+    # flat and dark, luminance is checked first
+    assert g.check(frame(0, 0)) == ['dark', 'dark']
+
+
+def test_scaled_slices():
+    g = gate.Gates(rois, scale=8, force_period=None, luminance={})
+    assert g.check(frame(0, 100)) == ['dark', None]
+    assert g.slices[1][1] == slice(4, 8)
+
+
+def test_unknown_gate():
+    with pytest.raises(ValueError):
+        gate.Gates(rois, sharpness={})
@@ -0,0 +1,55 @@
+import time
+
+import numpy
+
+from pollinatorcam import cvcapture
+from pollinatorcam import grabber
+
+
+def test_levels_follow_latency():
+    s = grabber.LoadShedder(max_latency=1.0, hold_time=0.0, alpha=1.0)
+    # first sample only sets the load state
+    assert s.update(0.9) == 0
+    assert s.update(0.9) == 1
+    assert s.update(0.9) == 1
+    assert s.update(0.9) == 1
+    # already at the highest level
+    assert s.update(0.9) == 0
+    assert s.level == len(s.levels) - 1
+    assert not s.thumbnails
+    assert s.update(0.1) == 0
+    assert s.update(0.1) == -1
+    assert s.level == len(s.levels) - 2
+
+
+def test_hold_time():
+    s = grabber.LoadShedder(max_latency=1.0, hold_time=60.0, alpha=1.0)
+    s.update(0.9)
+    assert s.update(0.9) == 0
+    assert s.level == 0
+
+
+def test_shed_rois_rotates():
+    s = grabber.LoadShedder(roi_fraction=0.5)
+    skip = [None, None, None, 'gate']
+    assert s.shed_rois(skip) is skip
+    s.level = 1
+    analyzed = []
+    for i in range(3):
+        r = s.shed_rois(skip)
+        assert r[3] == 'gate'
+        analyzed.extend(i for (i, v) in enumerate(r) if v is None)
+    # every roi is analyzed over a few frames
+    assert set(analyzed) == {0, 1, 2}
+
+
+def test_scale_period_and_stale():
+    s = grabber.LoadShedder(max_latency=1.0, rate_scale=0.5)
+    assert s.scale_period(1.0) == 1.0
+    s.level = 2
+    assert s.scale_period(1.0) == 2.0
+    frame = cvcapture.Frame(
+        bgr=numpy.zeros((4, 4, 3), dtype='u1'), timestamp=time.time() - 2)
+    assert s.is_stale(frame)
+    frame.timestamp = time.time()
+    assert not s.is_stale(frame)
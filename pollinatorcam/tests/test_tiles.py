@@ -0,0 +1,49 @@
+import pytest
+
+from pollinatorcam import grabber
+
+
+def test_tiles_cover_frame():
+    h, w = 480, 640
+    coords = grabber.tile_coords(h, w, size=0.5, overlap=0.2)
+    assert min(t for (t, b, l, r) in coords) == 0
+    assert max(b for (t, b, l, r) in coords) == h
+    assert min(l for (t, b, l, r) in coords) == 0
+    assert max(r for (t, b, l, r) in coords) == w
+    for (t, b, l, r) in coords:
+        assert b - t == r - l == 240
+
+
+def test_tiles_overlap():
+    coords = grabber.tile_coords(100, 1000, size=1.0, overlap=0.25)
+    lefts = sorted(set(l for (t, b, l, r) in coords))
+    for (a, b) in zip(lefts[:-1], lefts[1:]):
+        # stride is at most (1 - overlap) * size
+        assert b - a <= 75
+
+
+def test_single_tile():
+    assert grabber.tile_coords(100, 100, size=1.0) == [(0, 100, 0, 100)]
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'h': 0, 'w': 100},
+    {'h': 100, 'w': -1},
+    {'h': 100, 'w': 100, 'size': 0},
+    {'h': 100, 'w': 100, 'size': 1.5},
+    {'h': 100, 'w': 100, 'overlap': 1.0},
+    {'h': 100, 'w': 100, 'overlap': -0.1},
+])
+def test_invalid_tiles(kwargs):
+    with pytest.raises(ValueError):
+        grabber.tile_coords(**kwargs)
+
+
+def test_tiles_use_nms():
+    assert grabber.nms_kwargs({'tiles': None, 'nms': None}) is None
+    assert grabber.nms_kwargs({'nms': {'iou': 0.3}}) == {'iou': 0.3}
+    tiles = {'size': 0.5, 'overlap': 0.2}
+    assert grabber.nms_kwargs({'tiles': tiles, 'nms': None}) == \
+        grabber.default_tile_nms
+    assert grabber.nms_kwargs({'tiles': tiles, 'nms': {'iou': 0.3}}) == \
+        {'iou': 0.3}
@@ -0,0 +1,87 @@
+import numpy
+
+from pollinatorcam import detection
+from pollinatorcam import tracker
+
+
+shape = (120, 160)
+
+
+def scene(dx=0, dy=0):
+    # textured 40 x 40 square at (40 + dy, 40 + dx) on a flat background
+    gray = numpy.full(shape, 50, dtype='u1')
+    patch = numpy.random.RandomState(0).randint(
+        100, 255, (40, 40)).astype('u1')
+    gray[40 + dy:80 + dy, 40 + dx:80 + dx] = patch
+    return gray
+
+
+def records(boxes, label=0, score=0.8):
+    r = numpy.zeros(len(boxes), dtype=detection.detection_dtype)
+    for (i, box) in enumerate(boxes):
+        r[i]['label'] = label
+        r[i]['score'] = score
+        for (f, v) in zip(detection.bbox_fields, box):
+            r[i][f] = v
+    r['track'] = -1
+    return r
+
+
+def test_follows_translation():
+    t = tracker.Tracker(detect_every=10, scale=1)
+    assert t.needs_detection()
+    r = t.update(scene(), shape, records([(40, 40, 80, 80)]))
+    assert list(r['track']) == [0]
+    assert not t.needs_detection()
+    for i in range(1, 4):
+        tracked = t.track(scene(dx=3 * i, dy=2 * i), shape)
+    assert len(tracked) == 1
+    assert tracked['track'][0] == 0
+    numpy.testing.assert_allclose(
+        detection.bboxes(tracked)[0], (46, 49, 86, 89), atol=1.)
+    # score is the detector score scaled by (decayed) confidence
+    assert 0.5 < tracked['score'][0] < 0.8
+
+
+def test_id_persists_across_detections():
+    t = tracker.Tracker(scale=1)
+    t.update(scene(), shape, records([(40, 40, 80, 80)]))
+    t.track(scene(dx=2), shape)
+    # overlapping detection keeps the id, others start new tracks
+    r = t.update(scene(dx=4), shape, records([
+        (40, 44, 80, 84), (0, 100, 20, 120)]))
+    assert list(r['track']) == [0, 1]
+    # a different label never associates
+    r = t.update(scene(dx=4), shape, records([(40, 44, 80, 84)], label=1))
+    assert list(r['track']) == [2]
+    assert [tr.id for tr in t.tracks] == [2]
+
+
+def test_decay_needs_detection():
+    t = tracker.Tracker(
+        detect_every=100, min_confidence=0.5, decay=0.8, scale=1)
+    t.update(scene(), shape, records([(40, 40, 80, 80)]))
+    n = 0
+    while not t.needs_detection():
+        t.track(scene(), shape)
+        n += 1
+    # 0.8 ** 4 < 0.5 < 0.8 ** 3
+    assert n == 4
+    assert t.tracks[0].confidence < 0.5
+
+
+def test_detect_every():
+    t = tracker.Tracker(detect_every=2, decay=1.0, scale=1)
+    t.update(scene(), shape, records([(40, 40, 80, 80)]))
+    t.track(scene(), shape)
+    assert not t.needs_detection()
+    t.track(scene(), shape)
+    assert t.needs_detection()
+
+
+def test_lost_track():
+    t = tracker.Tracker(scale=1)
+    # nothing to track in a flat region
+    t.update(scene(), shape, records([(0, 100, 20, 120)]))
+    assert t.track(scene(), shape)['score'][0] == 0
+    assert t.needs_detection()
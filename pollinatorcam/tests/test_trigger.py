@@ -0,0 +1,27 @@
+import pytest
+
+from pollinatorcam import trigger
+
+
+def test_parse_slice_bounds_are_ints():
+    assert trigger.parse_allow_mask('+2:5') == [(True, ('slice', 2, 5))]
+
+
+def test_allow_mask_with_slices():
+    ops = trigger.parse_allow_mask('+2:5,-3,+8', check_consts=False)
+    mask = trigger.make_allow_mask(10, *ops)
+    assert list(mask.nonzero()[0]) == [2, 4, 8]
+    # a leading deny starts from allowing everything
+    ops = trigger.parse_allow_mask('-0:8')
+    assert list(trigger.make_allow_mask(10, *ops).nonzero()[0]) == [8, 9]
+
+
+def test_empty_allow_string():
+    assert trigger.parse_allow_mask('') == []
+    assert trigger.make_allow_mask(3).all()
+
+
+@pytest.mark.parametrize('allow', ['2', '+1:2:3', '+a:3', '+unknown'])
+def test_invalid_allow_string(allow):
+    with pytest.raises(ValueError):
+        trigger.parse_allow_mask(allow)
@@ -0,0 +1,166 @@
+"""
+Per-frame stage timing
+
+Time spent in each stage of analyzing a frame is accumulated during the
+frame (start_frame/end_frame) and then stored in a fixed size rolling
+window per stage. When several frames are in flight (see Grabber
+pipelined), pass the dict returned by start_frame as frame.
+
+Recording a sample is an array assignment. Percentiles are only
+computed when a report is made, so this can be left on.
+
+Reports are periodically saved as json to:
+    <directory>/<name>_timing.json
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy
+
+
+stages = (
+    'capture_wait',  # blocked waiting for a frame
+    'latency',  # frame age (since capture) when analysis started
+    'decode',  # jpeg decoding
+    'gate',  # pre-inference checks (excluding decode)
+    'crop',  # cropping and resizing rois (excluding decode)
+    'cache',  # hashing rois and cache lookups (see cache)
+    'track',  # optical flow tracking (see tracker)
+    'inference',  # client.run
+    'detector',  # output remapping and RunningThreshold
+    'still',  # trigger.new_image and saving stills
+    'thumbnail',
+    'meta',  # csv/json writing
+    'total',
+)
+
+percentiles = (50, 95, 99)
+
+
+class StageTimer:
+    __slots__ = ('times', 'stage', 'frame', 't0')
+
+    def __init__(self, times, stage, frame=None):
+        self.times = times
+        self.stage = stage
+        self.frame = frame
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.times.accumulate(
+            self.stage, time.perf_counter() - self.t0, self.frame)
+
+
+class StageTimes:
+    def __init__(
+            self, name, directory=None, window=1024, save_period=60.0):
+        self.name = name
+        self.directory = directory
+        self.window = window
+        self.save_period = save_period
+        self.last_save_time = time.monotonic()
+
+        self.samples = {}
+        self.n_samples = {}
+        self.frame = {}
+        # event counts (dropped frames, etc)
+        self.counters = {}
+
+    def time(self, stage, frame=None):
+        """Time a block of code, use as:
+            with times.time('inference'):
+                ...
+        """
+        return StageTimer(self, stage, frame)
+
+    def start_frame(self):
+        self.frame = {}
+        return self.frame
+
+    def accumulate(self, stage, dt, frame=None):
+        # add dt to the current (or provided) frame
+        if frame is None:
+            frame = self.frame
+        frame[stage] = frame.get(stage, 0.) + dt
+
+    def add(self, stage, dt):
+        # add a sample directly to the rolling window
+        if stage not in self.samples:
+            self.samples[stage] = numpy.full(self.window, numpy.nan)
+            self.n_samples[stage] = 0
+        self.samples[stage][self.n_samples[stage] % self.window] = dt
+        self.n_samples[stage] += 1
+
+    def end_frame(self, frame=None):
+        if frame is None:
+            frame = self.frame
+            self.frame = {}
+        for stage in frame:
+            self.add(stage, frame[stage])
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        r = {
+            'name': self.name,
+            'time': time.time(),
+            'window': self.window,
+            'stages': {},
+            'counters': dict(self.counters),
+        }
+        for stage in self.samples:
+            n = min(self.n_samples[stage], self.window)
+            a = self.samples[stage][:n]
+            s = {
+                'n': self.n_samples[stage],
+                'mean': float(numpy.mean(a)),
+                'max': float(numpy.max(a)),
+            }
+            for (p, v) in zip(
+                    percentiles, numpy.percentile(a, percentiles)):
+                s['p%i' % p] = float(v)
+            r['stages'][stage] = s
+        return r
+
+    def save(self):
+        if self.directory is None:
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fn = os.path.join(self.directory, '%s_timing.json' % self.name)
+        logging.debug("Saving timing to %s", fn)
+        # write then move so readers never see a partial file
+        tfn = fn + '.tmp'
+        with open(tfn, 'w') as f:
+            json.dump(self.report(), f)
+        os.replace(tfn, fn)
+
+    def maybe_save(self):
+        t = time.monotonic()
+        if t - self.last_save_time < self.save_period:
+            return
+        self.last_save_time = t
+        try:
+            self.save()
+        except Exception as e:
+            logging.warning("Failed to save timing: %s", e)
+
+
+def load_reports(directory):
+    reports = {}
+    if not os.path.exists(directory):
+        return reports
+    for fn in sorted(os.listdir(directory)):
+        if not fn.endswith('_timing.json'):
+            continue
+        with open(os.path.join(directory, fn), 'r') as f:
+            r = json.load(f)
+        reports[r['name']] = r
+    return reports
@@ -0,0 +1,166 @@
+"""
+Carry detector boxes forward between detector runs
+
+After the detector finds something the Tracker follows each detection
+(a track) with sparse (Lucas-Kanade) optical flow on a small grayscale
+copy of the frame (see cvcapture.Frame.reduced). While tracks are
+confident the detector is not run, instead each track produces a
+record (see detection.detection_dtype) with:
+    score = detector score * track confidence
+Track confidence decays every tracked frame (decay) and drops with the
+fraction of points lost. The detector is run again when:
+    - there are no tracks
+    - detect_every frames were tracked since the last detector run
+    - any track confidence is below min_confidence
+Detections are associated to existing tracks (same label, iou above
+iou) to keep their track id, new detections start new tracks and
+tracks without a detection are dropped.
+"""
+
+import logging
+
+import cv2
+import numpy
+
+from . import detection
+
+
+class Track:
+    __slots__ = ('id', 'label', 'score', 'roi', 'box', 'confidence', 'points')
+
+    def __init__(self, id, record):
+        self.id = id
+        self.points = None
+        self.set_detection(record)
+
+    def set_detection(self, record):
+        self.label = int(record['label'])
+        self.score = float(record['score'])
+        self.roi = int(record['roi'])
+        self.box = numpy.array(
+            [record[f] for f in detection.bbox_fields], dtype='f8')
+        self.confidence = 1.0
+
+
+class Tracker:
+    def __init__(
+            self, detect_every=10, min_confidence=0.5, decay=0.95,
+            iou=0.3, scale=4, max_points=20, min_points=3):
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.iou = iou
+        # track on a 1/scale copy of the frame
+        self.scale = scale
+        self.max_points = max_points
+        self.min_points = min_points
+
+        self.tracks = []
+        self.next_id = 0
+        self.n_tracked = 0
+        # previous small grayscale frame
+        self.gray = None
+
+    def prepare(self, frame):
+        """Small grayscale copy of frame used for tracking"""
+        return cv2.cvtColor(frame.reduced(self.scale), cv2.COLOR_BGR2GRAY)
+
+    def needs_detection(self):
+        if not len(self.tracks):
+            return True
+        if self.n_tracked >= self.detect_every:
+            return True
+        return any(t.confidence < self.min_confidence for t in self.tracks)
+
+    def find_points(self, gray, track, sy, sx):
+        t, l, b, r = track.box * (sy, sx, sy, sx)
+        t, l = max(int(t), 0), max(int(l), 0)
+        b, r = min(int(b) + 1, gray.shape[0]), min(int(r) + 1, gray.shape[1])
+        if b <= t or r <= l:
+            return None
+        mask = numpy.zeros(gray.shape, dtype='u1')
+        mask[t:b, l:r] = 1
+        return cv2.goodFeaturesToTrack(
+            gray, self.max_points, 0.01, 2, mask=mask)
+
+    def update(self, gray, shape, records):
+        """Start or update tracks from detector records
+
+        Track ids are written to records['track']
+        """
+        sy = gray.shape[0] / shape[0]
+        sx = gray.shape[1] / shape[1]
+        tracks = []
+        if len(records) and len(self.tracks):
+            ious = detection.iou(
+                detection.bboxes(records).astype('f8'),
+                numpy.array([t.box for t in self.tracks]))
+            # only associate detections and tracks with the same label
+            ious[
+                records['label'][:, None] !=
+                numpy.array([t.label for t in self.tracks])[None, :]] = 0
+            # greedy association, best overlap first
+            for i in numpy.argsort(-ious, axis=None):
+                (ri, ti) = numpy.unravel_index(i, ious.shape)
+                if ious[ri, ti] <= self.iou:
+                    break
+                if records['track'][ri] != -1 or self.tracks[ti] is None:
+                    continue
+                track = self.tracks[ti]
+                self.tracks[ti] = None
+                track.set_detection(records[ri])
+                records['track'][ri] = track.id
+                tracks.append(track)
+        for ri in numpy.nonzero(records['track'] == -1)[0]:
+            track = Track(self.next_id, records[ri])
+            self.next_id += 1
+            records['track'][ri] = track.id
+            tracks.append(track)
+        for track in tracks:
+            track.points = self.find_points(gray, track, sy, sx)
+        logging.debug(
+            "Tracker: %i tracks, dropped %i", len(tracks),
+            sum(t is not None for t in self.tracks))
+        self.tracks = tracks
+        self.gray = gray
+        self.n_tracked = 0
+        return records
+
+    def track(self, gray, shape):
+        """Move tracks to the new frame, returns synthesized records"""
+        sy = gray.shape[0] / shape[0]
+        sx = gray.shape[1] / shape[1]
+        tracked = [
+            t for t in self.tracks
+            if t.points is not None and len(t.points) >= self.min_points]
+        for t in self.tracks:
+            if t not in tracked:
+                # nothing to follow
+                t.confidence = 0.
+        if len(tracked) and self.gray is not None:
+            points = numpy.concatenate([t.points for t in tracked])
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.gray, gray, points, None)
+            status = status[:, 0].astype(bool)
+            i = 0
+            for t in tracked:
+                n = len(t.points)
+                good = status[i:i + n]
+                if good.sum() < self.min_points:
+                    t.confidence = 0.
+                else:
+                    dx, dy = numpy.median(
+                        (new_points[i:i + n] - t.points)[good], axis=0)[0]
+                    t.box += (dy / sy, dx / sx, dy / sy, dx / sx)
+                    t.confidence *= self.decay * good.mean()
+                    t.points = new_points[i:i + n][good]
+                i += n
+        self.gray = gray
+        self.n_tracked += 1
+
+        records = numpy.zeros(len(self.tracks), dtype=detection.detection_dtype)
+        for (i, t) in enumerate(self.tracks):
+            records[i] = (
+                t.label, t.score * t.confidence,
+                t.box[0], t.box[1], t.box[2], t.box[3], t.roi, t.id)
+        return records
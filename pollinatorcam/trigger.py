@@ -26,20 +26,22 @@ Duty cycle limit only during triggered period
 """
 
 import datetime
+import functools
 #import json
 import logging
 import time
 import os
 
-import cv2
 import numpy
 
-from . import gstrecorder
 from . import cvrecorder
 
-hstname = open('/etc/hostname','r')
-hstname1 = hstname.readlines()[-1].split('\n')[0]
-hstname.close()
+
+@functools.lru_cache(maxsize=None)
+def hostname():
+    # last line of /etc/hostname (read on first use, not import)
+    with open('/etc/hostname', 'r') as f:
+        return f.readlines()[-1].split('\n')[0]
 
 mask_consts = {
 #    'insects': [('slice', 75, 1067), 2291],
@@ -141,7 +143,7 @@ def parse_allow_mask(allow_string, check_consts=True):
                     raise ValueError(
                         "Invalid allow string token (slice not digit): %s"
                         % (token, ))
-            op = ('slice', sub_tokens[0], sub_tokens[1])
+            op = ('slice', int(sub_tokens[0]), int(sub_tokens[1]))
         elif operation.isdigit():  # index
             op = int(operation)
         else:  # name
@@ -314,7 +316,8 @@ class TriggeredRecording(Trigger):
     def __init__(
             self, url, video_directory, still_directory, name,
             duty_cycle=0.1, post_time=1.0, min_time=3.0, max_time=10.0,
-            save_video=True, periodic_still=False):
+            save_video=True, periodic_still=False, frame_buffer=None,
+            frames=None, pipeline=None):
         self.video_directory = video_directory
         self.still_directory = still_directory
         self.name = name
@@ -330,7 +333,12 @@ class TriggeredRecording(Trigger):
         self.periodic_still = periodic_still
 
         self.url = url
-        # TODO pre record time
+        # cvcapture.FrameBuffer holding frames from before the trigger
+        self.frame_buffer = frame_buffer
+        # cvcapture.FrameSubscription the recorder can record every frame from
+        self.frames = frames
+        # gstcapture pipeline the recorder can share
+        self.pipeline = pipeline
         self.index = -1
 
         if self.save_video:
@@ -343,6 +351,10 @@ class TriggeredRecording(Trigger):
         #self.recorder = something
         raise NotImplementedError("Abstract base class")
 
+    def stop(self):
+        # stop any recorder threads
+        pass
+
     def video_filename(self, meta):
         if 'datetime' in meta:
             dt = meta['datetime']
@@ -364,7 +376,7 @@ class TriggeredRecording(Trigger):
         if not os.path.exists(d):
             os.makedirs(d)
         return os.path.join(
-            d,hstname1+'-%s-%s-%s.jpg' % (dt.strftime('%y%m%d'),dt.strftime('%H%M%S-%f'), self.name))
+            d,hostname()+'-%s-%s-%s.jpg' % (dt.strftime('%y%m%d'),dt.strftime('%H%M%S-%f'), self.name))
 
     def activate(self, t):
         super(TriggeredRecording, self).activate(t)
@@ -398,17 +410,17 @@ class TriggeredRecording(Trigger):
             self.recorder.stop_saving()
             self.filename = None
 
-    def new_image(self, im):
+    def new_image(self, frame):
         # allow object to optionally buffer images
         pass
 
-    def save_image(self, im):
+    def save_image(self, frame, fn=None):
         self.meta['camera_name'] = self.name
-        fn = self.still_filename(self.meta)
+        if fn is None:
+            fn = self.still_filename(self.meta)
         logging.info("Saving still to %s", fn)
         # TODO save image, in thread?
-        # swap RGB->BGR
-        cv2.imwrite(fn, im[:, :, ::-1])
+        frame.write(fn)
         return fn
 
 
@@ -416,19 +428,31 @@ class GSTTriggeredRecording(TriggeredRecording):
     def build_recorder(self):
         # need to tell recorder pre/post/etc
         logging.debug("Building GST recorder")
-        self.recorder = gstrecorder.GSTRecorder(url=self.url)
+        # gstreamer (gi) is only imported when used
+        from . import gstrecorder
+        self.recorder = gstrecorder.GSTRecorder(
+            url=self.url, pipeline=self.pipeline)
         self.recorder.start()
 
+    def stop(self):
+        if hasattr(self, 'recorder'):
+            self.recorder.stop()
+
 
 class CVTriggeredRecording(TriggeredRecording):
     def build_recorder(self):
         logging.debug("Building CV recorder")
-        self.recorder = cvrecorder.CVRecorder(url=self.url)
+        self.recorder = cvrecorder.CVRecorder(
+            url=self.url, buffer=self.frame_buffer, frames=self.frames)
         self.recorder.start()
 
-    def new_image(self, im):
+    def stop(self):
+        if hasattr(self, 'recorder'):
+            self.recorder.stop()
+
+    def new_image(self, frame):
         if hasattr(self, 'recorder'):
-            self.recorder.new_image(im)
+            self.recorder.new_image(frame)
 
         # check if image should be saved based on timer
         if self.periodic_still:
@@ -436,7 +460,7 @@ class CVTriggeredRecording(TriggeredRecording):
             if (
                     not hasattr(self, 'last_still_time') or
                     t - self.last_still_time >= self.periodic_still):
-                self.save_image(im)
+                self.save_image(frame)
                 #self.periodic_name = self.still_filename(self.meta)
                 self.last_still_time = t
                 return self.still_filename(self.meta)
@@ -26,7 +26,7 @@ import flask
 
 from . import config
 from . import discover
-from . import grabber
+from . import timing
 
 
 this_dir = os.path.dirname(os.path.abspath(os.path.realpath(__file__)))
@@ -52,7 +52,7 @@ def temperature():
 
 @app.route("/disk_usage", methods=["GET"])
 def disk_info():
-    du = shutil.disk_usage(grabber.data_dir)
+    du = shutil.disk_usage(config.data_dir)
     return flask.jsonify({
         'total': du.total,
         'used': du.used,
@@ -118,7 +118,7 @@ def camera_list(date=None):
     # get systemd status and uptime of all ips
     #service_states = discover.status_of_all_camera_services()
 
-    detections_path = os.path.join(grabber.data_dir, 'detections')
+    detections_path = os.path.join(config.data_dir, 'detections')
 
     # load last 'discover' result
     cfg = config.load_config(discover.cfg_name, {})
@@ -151,6 +151,18 @@ def camera_list(date=None):
     return flask.jsonify(cams)
 
 
+@app.route("/timing", methods=["GET"])
+@app.route("/timing/<name>", methods=["GET"])
+def stage_timing(name=None):
+    # per-camera stage timing percentiles (see timing.py)
+    reports = timing.load_reports(config.log_dir)
+    if name is None:
+        return flask.jsonify(reports)
+    if name not in reports:
+        return flask.abort(404)
+    return flask.jsonify(reports[name])
+
+
 @app.route("/snapshot/<name>", methods=["GET"])
 @app.route("/snapshot/<name>/", methods=["GET"])
 @app.route("/snapshot/<name>/<date>", methods=["GET"])
@@ -185,7 +197,7 @@ def snapshot(name, date=None):
     else:
         # get most recent day
         path = os.path.join(
-            grabber.data_dir,
+            config.data_dir,
             name,
             date.strftime('%Y-%m-%d'),
             'pic_001')
@@ -0,0 +1,9 @@
+#!/bin/bash
+
+source $HOME/.bashrc
+source $HOME/.virtualenvs/autopolls/bin/activate
+
+cd $HOME/AP/Autopolls
+
+# pcam@ services use the broker when started with -B
+exec python3 -m pollinatorcam broker -p priority -v
@@ -0,0 +1,17 @@
+#!/bin/bash
+
+source $HOME/.bashrc
+source $HOME/.virtualenvs/autopolls/bin/activate
+
+cd $HOME/AP/Autopolls
+
+# exec here to use same PID to allow systemd watchdog
+# without -l all cameras from the last pcam-discover scan are used
+MODELSTATUS=`cat /home/pi/Desktop/configs | jq '.model_inference'`
+
+if [ $MODELSTATUS == 0 ]
+then
+	exec python3 -m pollinatorcam hub -cDfr -v
+else
+	exec python3 -m pollinatorcam hub -cDr -v
+fi